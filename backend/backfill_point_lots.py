@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Create expiry lots for balances earned before point_lots existed.
+
+Spending consumes lots oldest first, so what is left of a balance is its
+newest credits. For every user whose balance exceeds their unspent lots this
+walks the user's credits without a lot newest first and turns them into lots
+until they cover the difference; the oldest one is partial. Balances the
+ledger cannot explain become one lot dated at the oldest credit seen. Lots
+that would already be past their expiry get at least --grace-days before the
+sweep expires them. Re-running it is a no-op.
+
+Usage:
+    python backfill_point_lots.py [--batch-size 500] [--grace-days 30] [--history 1000]
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from server import (
+    POINT_EXPIRY_MONTHS, POINT_LOT_TRANSACTION_TYPES, PointTransaction, client, db,
+    find_ledger, make_point_lot
+)
+
+
+async def lots_for_user(user, uncovered: int, lotted: set, history: int, earliest_expiry: datetime):
+    balance = uncovered
+    credits = await find_ledger(
+        {"to_user_id": user["id"], "transaction_type": {"$in": sorted(POINT_LOT_TRANSACTION_TYPES)}}, limit=history,
+        since=user.get("created_at") or datetime(2000, 1, 1)
+    )
+    lots = []
+    oldest = user.get("created_at") or datetime.utcnow()
+    for credit in credits:
+        if balance <= 0:
+            break
+        if credit["id"] in lotted:
+            continue
+        lot = make_point_lot(PointTransaction(**credit))
+        if not lot:
+            continue
+        lot["remaining"] = min(lot["amount"], balance)
+        balance -= lot["remaining"]
+        oldest = credit["created_at"]
+        lots.append(lot)
+
+    if balance > 0:
+        lots.append(make_point_lot(PointTransaction(
+            id=f"backfill:{user['id']}", from_user_id=user["id"], to_user_id=user["id"], amount=balance,
+            reason="Balance before point expiry", company_id=user.get("company_id") or "",
+            transaction_type="manager_award", created_at=oldest
+        )))
+        lots[-1]["transaction_id"] = None
+
+    for lot in lots:
+        lot["expires_at"] = max(lot["expires_at"], earliest_expiry)
+    return lots
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Backfill point_lots from existing balances")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--grace-days", type=int, default=30, help="Minimum days before a backfilled lot expires")
+    parser.add_argument("--history", type=int, default=1000, help="Most credits read per user")
+    args = parser.parse_args()
+
+    earliest_expiry = datetime.utcnow() + timedelta(days=args.grace_days)
+    started = time.monotonic()
+    users_done = lots_written = 0
+    last_id = ""
+    try:
+        while True:
+            users = await db.users.find(
+                {"id": {"$gt": last_id}, "point_balance": {"$gt": 0}},
+                {"_id": 0, "id": 1, "company_id": 1, "point_balance": 1, "created_at": 1}
+            ).sort("id", 1).limit(args.batch_size).to_list(args.batch_size)
+            if not users:
+                break
+            last_id = users[-1]["id"]
+
+            # Lots written since the rollout (or by an earlier run) already cover part of the balance
+            covered = {
+                row["_id"]: row async for row in db.point_lots.aggregate([
+                    {"$match": {"user_id": {"$in": [user["id"] for user in users]}}},
+                    {"$group": {
+                        "_id": "$user_id",
+                        "remaining": {"$sum": "$remaining"},
+                        "transaction_ids": {"$addToSet": "$transaction_id"}
+                    }}
+                ])
+            }
+            lots = []
+            for user in users:
+                existing = covered.get(user["id"], {"remaining": 0, "transaction_ids": []})
+                uncovered = user["point_balance"] - existing["remaining"]
+                if uncovered > 0:
+                    lots.extend(await lots_for_user(
+                        user, uncovered, set(existing["transaction_ids"]), args.history, earliest_expiry
+                    ))
+                    users_done += 1
+            if lots:
+                await db.point_lots.insert_many(lots, ordered=False)
+                lots_written += len(lots)
+    finally:
+        client.close()
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"Backfilled {lots_written} lots for {users_done} users in {elapsed:.1f}s "
+          f"(expiry after {POINT_EXPIRY_MONTHS} months, at the earliest {earliest_expiry:%Y-%m-%d})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Notification digest throughput: users digested per second by SMTP pool size.
+
+Creates --users users, each with one closed digest bucket of --events events,
+then runs send_digests once per --pool-sizes entry against the SMTP server at
+SMTP_HOST:SMTP_PORT and reports users digested per second. A local debugging
+server is enough, e.g. `python -m aiosmtpd -n -l localhost:1025`. Run it with
+DB_NAME pointing at a disposable database; it drops the collections it writes.
+
+Usage:
+    DB_NAME=effydoc_bench python bench_digests.py [--users 5000] [--events 8] [--pool-sizes 1,4,8]
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import server
+from server import SMTPPool, User, UserRole, client, db, send_digests
+
+COLLECTIONS = ["users", "digest_buckets", "scheduler_locks"]
+
+
+async def reset():
+    for name in COLLECTIONS:
+        await db[name].drop()
+
+
+async def load(users: int, events: int):
+    await reset()
+    people = [
+        User(email=f"bench{i}@company.com", name=f"Bench {i}", role=UserRole.EMPLOYEE, company_id="bench-company")
+        for i in range(users)
+    ]
+    await db.users.insert_many([person.model_dump() for person in people])
+    await db.users.create_index("id")
+
+    bucket_start = server.digest_bucket_start(datetime.utcnow() - timedelta(hours=server.DIGEST_BUCKET_HOURS))
+    recognitions = [
+        {"kind": "recognition", "amount": 10, "reason": f"Recognition {n}", "from_name": "Bench Manager", "at": bucket_start}
+        for n in range(events)
+    ]
+    await db.digest_buckets.insert_many([
+        {
+            "_id": f"{person.id}:{bucket_start:%Y%m%d%H}", "user_id": person.id, "company_id": "bench-company",
+            "bucket_start": bucket_start, "bucket_end": bucket_start + timedelta(hours=server.DIGEST_BUCKET_HOURS),
+            "status": "pending", "attempts": 0, "events": recognitions[:server.DIGEST_MAX_EVENTS],
+            "event_count": events, "counts": {"recognition": events}, "points": 10 * events
+        }
+        for person in people
+    ])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Measure notification digest throughput by SMTP pool size")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=8, help="Events per user's bucket")
+    parser.add_argument("--pool-sizes", default="1,4,8", help="Comma-separated SMTP pool sizes to compare")
+    args = parser.parse_args()
+
+    try:
+        for size in [int(value) for value in args.pool_sizes.split(",")]:
+            await load(args.users, args.events)
+            server.smtp_pool = SMTPPool(size)
+            started = time.perf_counter()
+            await send_digests()
+            elapsed = time.perf_counter() - started
+            await asyncio.to_thread(server.smtp_pool.close)
+
+            sent = await db.digest_buckets.count_documents({"status": "sent"})
+            pending = await db.digest_buckets.count_documents({"status": "pending"})
+            print(f"pool {size:>3}: {sent:,} digests in {elapsed:.2f}s ({sent / elapsed:,.0f} users/s), "
+                  f"{server.smtp_pool.opened} connections, {pending:,} left pending")
+    finally:
+        await reset()
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Load test of point ledger writes with and without group commit.
+
+Fires --concurrency concurrent award-shaped writes (ledger row, recipient
+balance $inc, manager cap $inc) through write_ledger against a scratch
+database and reports throughput and latency percentiles for each mode.
+Run it with DB_NAME pointing at a disposable database; it drops the
+collections it writes.
+
+Usage:
+    DB_NAME=effydoc_bench python bench_ledger_writes.py [--writes 20000] [--concurrency 200] [--recipients 50]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import server
+from server import PointTransaction, client, db, ledger_writer, write_ledger
+
+
+async def run(writes: int, concurrency: int, recipients: int, batched: bool):
+    await db.point_transactions.drop()
+    await db.users.drop()
+    manager_ids = [f"bench-manager-{i}" for i in range(max(1, recipients // 8))]
+    recipient_ids = [f"bench-user-{i}" for i in range(recipients)]
+    await db.users.insert_many([{"id": user_id, "point_balance": 0, "point_cap": 0} for user_id in manager_ids + recipient_ids])
+    await db.users.create_index("id")
+
+    server.LEDGER_BATCH_ENABLED = batched
+    rng = random.Random(1)
+    latencies = []
+    remaining = iter(range(writes))
+
+    async def worker():
+        for _ in remaining:
+            transaction = PointTransaction(
+                from_user_id=rng.choice(manager_ids),
+                to_user_id=rng.choice(recipient_ids),
+                amount=rng.randint(1, 50),
+                reason="Load test",
+                company_id="bench-company"
+            )
+            started = time.perf_counter()
+            await write_ledger(transaction, {
+                transaction.to_user_id: {"point_balance": transaction.amount},
+                transaction.from_user_id: {"point_cap": -transaction.amount}
+            })
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await ledger_writer.drain()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    balance = sum([user["point_balance"] async for user in db.users.find({}, {"point_balance": 1})])
+    ledger = await db.point_transactions.count_documents({})
+    label = "group commit" if batched else "per-call writes"
+    print(f"{label:16} {writes / elapsed:>10,.0f} writes/s   p50 {percentile(0.5):7.2f} ms   "
+          f"p99 {percentile(0.99):7.2f} ms   rows {ledger:,}   credited {balance:,}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare ledger write throughput with and without group commit")
+    parser.add_argument("--writes", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--recipients", type=int, default=50, help="Fewer recipients means hotter documents")
+    args = parser.parse_args()
+
+    try:
+        await run(args.writes, args.concurrency, args.recipients, batched=False)
+        await run(args.writes, args.concurrency, args.recipients, batched=True)
+    finally:
+        await db.point_transactions.drop()
+        await db.users.drop()
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
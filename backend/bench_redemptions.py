@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Flash-redemption load test: many employees redeeming one limited reward at once.
+
+Creates --users employees with enough points, a reward with --stock units and
+fires one redemption per employee through redeem_reward with --concurrency in
+flight. Reports throughput and latency, then checks that exactly --stock
+redemptions succeeded, stock ended at zero and every debit has its ledger row.
+Run it with DB_NAME pointing at a disposable database; it drops the
+collections it writes.
+
+Usage:
+    DB_NAME=effydoc_bench python bench_redemptions.py [--users 5000] [--stock 100] [--concurrency 500]
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi import HTTPException
+
+from server import (
+    PointTransaction, Reward, User, UserRole, client, db, ledger_writer, make_point_lot, redeem_reward
+)
+
+COLLECTIONS = ["users", "rewards", "redemptions", "point_transactions", "point_lots", "entity_versions"]
+POINTS_COST = 100
+
+
+async def reset():
+    for name in COLLECTIONS:
+        await db[name].drop()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test reward redemption under contention on one item")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--stock", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=500)
+    args = parser.parse_args()
+
+    try:
+        await reset()
+        users = [
+            User(email=f"bench{i}@company.com", name=f"Bench {i}", role=UserRole.EMPLOYEE,
+                 company_id="bench-company", point_balance=POINTS_COST)
+            for i in range(args.users)
+        ]
+        await db.users.insert_many([user.model_dump() for user in users])
+        await db.users.create_index("id")
+        # Redemptions spend lots, so every balance needs one behind it
+        await db.point_lots.insert_many([
+            make_point_lot(PointTransaction(from_user_id="bench-manager", to_user_id=user.id, amount=POINTS_COST,
+                                            reason="Bench credit", company_id="bench-company"))
+            for user in users
+        ])
+        await db.point_lots.create_index([("user_id", 1), ("expires_at", 1)])
+        reward = Reward(name="Limited hoodie", description="Flash drop", points_cost=POINTS_COST,
+                        stock=args.stock, company_id="bench-company", created_by="bench-admin")
+        await db.rewards.insert_one(reward.model_dump())
+        await db.rewards.create_index("id", unique=True)
+
+        outcomes = {}
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def redeem(user: User):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await redeem_reward(reward.id, user)
+                    outcome = "redeemed"
+                except HTTPException as e:
+                    outcome = e.detail
+                latencies.append(time.perf_counter() - started)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(redeem(user) for user in users))
+        await ledger_writer.drain()
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+        print(f"{args.users:,} attempts on {args.stock:,} units in {elapsed:.2f}s "
+              f"({args.users / elapsed:,.0f} attempts/s, p50 {percentile(0.5):.1f} ms, p99 {percentile(0.99):.1f} ms)")
+        for outcome, count in sorted(outcomes.items()):
+            print(f"  {outcome}: {count:,}")
+
+        stock = (await db.rewards.find_one({"id": reward.id}))["stock"]
+        debited = await db.users.count_documents({"point_balance": 0})
+        lots_spent = await db.point_lots.count_documents({"remaining": 0})
+        ledger_rows = await db.point_transactions.count_documents({"transaction_type": "redemption"})
+        redemptions = await db.redemptions.count_documents({})
+        expected = min(args.stock, args.users)
+        checks = {
+            "redemptions succeeded": (outcomes.get("redeemed", 0), expected),
+            "stock left": (stock, args.stock - expected),
+            "users debited": (debited, expected),
+            "lots spent": (lots_spent, expected),
+            "ledger rows": (ledger_rows, expected),
+            "redemption records": (redemptions, expected),
+        }
+        for name, (actual, wanted) in checks.items():
+            print(f"  {'ok  ' if actual == wanted else 'FAIL'} {name}: {actual:,} (expected {wanted:,})")
+    finally:
+        await reset()
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Microbenchmark of the per-request CPU spent building and serializing responses.
+
+Compares FastAPI's default path (jsonable_encoder + json.dumps) with
+FastJSONResponse, and the pydantic v1 style .dict() with model_dump(), on
+payloads shaped like the profile and dashboard responses.
+
+Usage:
+    python bench_serialization.py [--transactions 100] [--number 200]
+"""
+import argparse
+import json
+import timeit
+import uuid
+import warnings
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from server import Badge, FastJSONResponse, PointTransaction, User, UserRole
+
+
+def build_profile(transaction_count: int):
+    company_id = str(uuid.uuid4())
+    employee = User(email="jane@company.com", name="Jane Smith", role=UserRole.EMPLOYEE, company_id=company_id)
+    now = datetime.utcnow()
+    transactions = []
+    for i in range(transaction_count):
+        transaction = PointTransaction(
+            from_user_id=str(uuid.uuid4()),
+            to_user_id=employee.id,
+            amount=10 + i % 40,
+            reason="Great teamwork on the release",
+            company_id=company_id,
+            created_at=now - timedelta(days=i)
+        ).model_dump()
+        transaction["_id"] = uuid.uuid4().hex[:24]
+        transaction["from_user_name"] = "Manager Smith"
+        transaction["from_user_role"] = "manager"
+        transactions.append(transaction)
+    badges = [
+        {
+            "earned_at": now,
+            "badge": Badge(name=f"Badge {i}", description="Earned points", icon="*",
+                           badge_type="points_based", company_id=company_id, points_required=50 * i).model_dump(),
+            "awarded_by": None
+        }
+        for i in range(5)
+    ]
+    return {
+        "employee": employee.model_dump(),
+        "manager": {"id": str(uuid.uuid4()), "name": "Manager Smith", "email": "manager@company.com"},
+        "company": {"id": company_id, "name": "Demo Company Inc", "point_name": "DemoPoints"},
+        "statistics": {"total_points_received": 2500, "current_balance": 2500, "badges_earned": 5},
+        "point_transactions": transactions,
+        "badges": badges
+    }
+
+
+def per_call_ms(fn, number: int) -> float:
+    return timeit.timeit(fn, number=number) / number * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response serialization paths")
+    parser.add_argument("--transactions", type=int, default=100)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    profile = build_profile(args.transactions)
+    default_body = JSONResponse(jsonable_encoder(profile)).body
+    fast_body = FastJSONResponse(profile).body
+    assert json.loads(default_body) == json.loads(fast_body), "serializers disagree"
+
+    default_ms = per_call_ms(lambda: JSONResponse(jsonable_encoder(profile)), args.number)
+    fast_ms = per_call_ms(lambda: FastJSONResponse(profile), args.number)
+    print(f"profile with {args.transactions} transactions")
+    print(f"  jsonable_encoder + JSONResponse  {default_ms:8.3f} ms")
+    print(f"  FastJSONResponse                 {fast_ms:8.3f} ms  ({default_ms / fast_ms:.0f}x)")
+
+    transaction = PointTransaction(from_user_id="a", to_user_id="b", amount=10, reason="r", company_id="c")
+    number = args.number * 50
+    dict_us = per_call_ms(transaction.dict, number) * 1000
+    dump_us = per_call_ms(transaction.model_dump, number) * 1000
+    print("PointTransaction document")
+    print(f"  .dict()                          {dict_us:8.2f} us")
+    print(f"  .model_dump()                    {dump_us:8.2f} us  ({dict_us / dump_us:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
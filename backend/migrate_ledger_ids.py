@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Online migration of point ledger ids from 36-character strings to binary UUIDs.
+
+Run the API with LEDGER_ID_STORAGE=dual while this runs, then switch it to
+binary once every collection reports zero remaining string ids.
+
+Usage:
+    python migrate_ledger_ids.py [--batch-size 1000] [--pause 0.05] [--compact] [--report-only]
+"""
+import argparse
+import asyncio
+import time
+
+from pymongo import UpdateOne
+
+from server import (
+    LEDGER_ID_FIELDS, client, db, ledger_archive_names, ledger_id_to_binary
+)
+
+STRING_ID_FILTER = {"$or": [{field: {"$type": "string"}} for field in LEDGER_ID_FIELDS]}
+
+
+async def collection_sizes(name: str):
+    stats = await db.command("collStats", name)
+    return {
+        "documents": stats.get("count", 0),
+        "data_bytes": stats.get("size", 0),
+        "index_bytes": stats.get("totalIndexSize", 0),
+        "indexes": stats.get("indexSizes", {})
+    }
+
+
+async def migrate_collection(name: str, batch_size: int, pause: float) -> int:
+    """Convert string ids in batches ordered by _id; safe to stop and re-run"""
+    collection = db[name]
+    migrated = 0
+    last_id = None
+    started = time.monotonic()
+
+    while True:
+        query = dict(STRING_ID_FILTER)
+        if last_id is not None:
+            query = {"$and": [STRING_ID_FILTER, {"_id": {"$gt": last_id}}]}
+        batch = await collection.find(
+            query, {field: 1 for field in LEDGER_ID_FIELDS}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for document in batch:
+            # Match on the old values so a concurrent rewrite is never clobbered
+            match = {"_id": document["_id"]}
+            changes = {}
+            for field in LEDGER_ID_FIELDS:
+                binary = ledger_id_to_binary(document.get(field))
+                if binary is not None:
+                    match[field] = document[field]
+                    changes[field] = binary
+            if changes:
+                operations.append(UpdateOne(match, {"$set": changes}))
+
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            migrated += result.modified_count
+        last_id = batch[-1]["_id"]
+        await asyncio.sleep(pause)
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"{name}: migrated {migrated} documents in {elapsed:.1f}s ({migrated / elapsed:.0f} docs/s)")
+    return migrated
+
+
+def print_report(name: str, before, after):
+    print(f"\n{name}")
+    print(f"  {'':24} {'before':>14} {'after':>14}")
+    print(f"  {'data bytes':24} {before['data_bytes']:>14,} {after['data_bytes']:>14,}")
+    print(f"  {'total index bytes':24} {before['index_bytes']:>14,} {after['index_bytes']:>14,}")
+    for index, size in sorted(before["indexes"].items()):
+        print(f"  {index:24} {size:>14,} {after['indexes'].get(index, 0):>14,}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migrate point ledger ids to binary UUIDs")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.05, help="Seconds to sleep between batches")
+    parser.add_argument("--compact", action="store_true", help="Compact each collection afterwards so freed index space is reported")
+    parser.add_argument("--report-only", action="store_true", help="Only print sizes and remaining string ids")
+    args = parser.parse_args()
+
+    try:
+        names = ["point_transactions"] + await ledger_archive_names()
+        for name in names:
+            before = await collection_sizes(name)
+            if not args.report_only:
+                await migrate_collection(name, args.batch_size, args.pause)
+                if args.compact:
+                    await db.command("compact", name)
+            after = await collection_sizes(name)
+            print_report(name, before, after)
+            remaining = await db[name].count_documents(STRING_ID_FILTER)
+            print(f"  string ids remaining: {remaining}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Reconcile stored point balances, caps and point lots against the point ledger.
+
+Usage:
+    python reconcile_balances.py [--company-id COMPANY_ID] [--repair]
+"""
+import argparse
+import asyncio
+import json
+
+from server import client, reconcile_balances
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Reconcile point balances against point_transactions")
+    parser.add_argument("--company-id", help="Only reconcile users of this company")
+    parser.add_argument("--repair", action="store_true", help="Overwrite drifted balances and caps with ledger values and correct their lots")
+    args = parser.parse_args()
+
+    try:
+        report = await reconcile_balances(company_id=args.company_id, repair=args.repair)
+    finally:
+        client.close()
+
+    report.pop("_id", None)
+    print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
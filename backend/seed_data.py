@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""Seed Mongo directly with production-shaped synthetic data.
+
+Generates companies with power-law sizes, admin -> manager -> employee org
+trees, tasks, a time-ordered point ledger where a few people receive most of
+the recognition, the user_badges those balances earn and the matching
+point_balance / point_cap values. Every credit gets its point lot; lots that
+reach their expiry before --end are written already expired, with their expiry
+ledger rows and balance debits, as the expiry sweep would have left them. Each
+person completes a task at most once. Output is deterministic for a given
+--seed and --end. Rows older than the hot window go straight to the yearly
+ledger archives.
+
+Usage:
+    python seed_data.py [--companies 50] [--users 100000] [--transactions 1000000]
+                        [--seed 42] [--batch-size 5000] [--concurrency 8] [--drop]
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from server import (
+    DEFAULT_BADGES, DEFAULT_POINT_CAP, LEDGER_ARCHIVE_PREFIX, POINT_EXPIRY_MONTHS, POINT_EXPIRY_NAMESPACE,
+    BadgeType, UserRole, add_months, client, db, encode_ledger_document, ensure_archive_indexes,
+    ensure_indexes, hash_password, ledger_hot_cutoff, month_start, point_cap_renewal_period
+)
+
+FIRST_NAMES = [
+    "Aarav", "Priya", "John", "Jane", "Wei", "Mei", "Carlos", "Lucia", "Olga", "Ivan",
+    "Fatima", "Omar", "Kenji", "Yuki", "Amara", "Kwame", "Sofia", "Liam", "Noah", "Emma"
+]
+LAST_NAMES = [
+    "Nair", "Sharma", "Smith", "Johnson", "Chen", "Wang", "Garcia", "Lopez", "Petrova", "Ivanov",
+    "Khan", "Hassan", "Tanaka", "Sato", "Okafor", "Mensah", "Rossi", "Murphy", "Brown", "Miller"
+]
+DEPARTMENTS = ["Engineering", "Sales", "Marketing", "Support", "Finance", "Operations", "HR", "Product"]
+REASONS = [
+    "Excellent work on the quarterly report", "Great teamwork during the product launch",
+    "Outstanding customer service", "Innovation in process improvement", "Mentoring new team members",
+    "Meeting project deadline ahead of schedule", "Creative problem solving",
+    "Going above and beyond expectations"
+]
+TASK_TITLES = [
+    "Complete security training", "Write a knowledge base article", "Run a lunch and learn",
+    "Submit quarterly self review", "Refer a candidate", "Close ten support tickets",
+    "Organize a team offsite", "Ship a customer-facing improvement"
+]
+SEED_DROP_COLLECTIONS = [
+    "companies", "users", "badges", "user_badges", "tasks", "point_transactions",
+    "balance_snapshots", "point_cap_renewals", "entity_versions", "scheduler_runs", "point_lots",
+    "rewards", "redemptions", "webhook_endpoints", "webhook_outbox", "digest_buckets", "refresh_tokens",
+    "revocations", "idempotency_keys", "reconciliation_reports"
+]
+MANAGER_SPAN = 8  # direct reports per manager
+TASK_COMPLETION_SHARE = 0.2
+
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def zipf_cum_weights(count: int, exponent: float):
+    total = 0.0
+    weights = []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        weights.append(total)
+    return weights
+
+
+def company_sizes(rng: random.Random, companies: int, users: int, exponent: float):
+    """Split users across companies by a Zipf law, at least MANAGER_SPAN + 2 each"""
+    minimum = MANAGER_SPAN + 2
+    weights = [1.0 / rank ** exponent for rank in range(1, companies + 1)]
+    spare = max(users - minimum * companies, 0)
+    sizes = [minimum + int(spare * weight / sum(weights)) for weight in weights]
+    sizes[0] += max(users - sum(sizes), 0)
+    rng.shuffle(sizes)
+    return sizes
+
+
+class ExpirySchedule:
+    """Credits that expire before --end, in expiry order, until their expiry leaves the balance.
+    Expiry follows generation order, so this is a FIFO; typed arrays keep it to a few
+    bytes per credit where holding the lot documents took gigabytes at 10M transactions"""
+
+    def __init__(self):
+        self.expires_at = array("d")
+        self.amounts = array("l")
+        self.owners = []
+        self.head = 0
+
+    def push(self, expires_at: datetime, amount: int, owner):
+        self.expires_at.append(expires_at.replace(tzinfo=timezone.utc).timestamp())
+        self.amounts.append(amount)
+        self.owners.append(owner)
+
+    def pop_due(self, until: datetime):
+        """Yield (amount, owner) for every credit expiring by until"""
+        bound = until.replace(tzinfo=timezone.utc).timestamp()
+        while self.head < len(self.amounts) and self.expires_at[self.head] <= bound:
+            yield self.amounts[self.head], self.owners[self.head]
+            self.head += 1
+        if self.head > 100_000 and self.head * 2 > len(self.amounts):
+            del self.expires_at[:self.head], self.amounts[:self.head], self.owners[:self.head]
+            self.head = 0
+
+
+class SeedCompany:
+    """One company's documents plus the lookup tables the ledger generator samples from"""
+
+    def __init__(self, rng: random.Random, index: int, size: int, created_at: datetime,
+                 password_hash: str, exponent: float):
+        self.id = make_uuid(rng)
+        slug = f"company{index:04d}"
+        self.document = {
+            "id": self.id,
+            "name": f"Company {index:04d}",
+            "point_name": "effyPoints",
+            "logo_url": None,
+            "catalog_version": 1,
+            "created_at": created_at,
+            "is_active": True
+        }
+        self.badges = sorted(
+            (
+                {
+                    "id": make_uuid(rng),
+                    "name": badge["name"],
+                    "description": badge["description"],
+                    "icon": badge["icon"],
+                    "badge_type": BadgeType.POINTS_BASED.value,
+                    "company_id": self.id,
+                    "points_required": badge["points_required"],
+                    "is_active": True,
+                    "created_at": created_at
+                }
+                for badge in DEFAULT_BADGES
+            ),
+            key=lambda badge: badge["points_required"]
+        )
+
+        def person(role: UserRole, manager_id=None):
+            number = len(self.users)
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            return {
+                "id": make_uuid(rng),
+                "email": f"{first.lower()}.{last.lower()}.{number}@{slug}.example.com",
+                "name": f"{first} {last}",
+                "role": role.value,
+                "company_id": self.id,
+                "manager_id": manager_id,
+                "department": rng.choice(DEPARTMENTS),
+                "point_balance": 0,
+                "point_cap": DEFAULT_POINT_CAP,
+                "point_cap_renewal_type": rng.choice(["request", "automatic"]),
+                "point_cap_renewed_at": None,
+                "point_cap_renewal_period": None,
+                "is_active": True,
+                "created_at": created_at,
+                "password": password_hash
+            }
+
+        self.users = []
+        admin = person(UserRole.COMPANY_ADMIN)
+        self.users.append(admin)
+        managers = max(1, (size - 1) // (MANAGER_SPAN + 1))
+        for _ in range(managers):
+            self.users.append(person(UserRole.MANAGER, admin["id"]))
+        manager_ids = [user["id"] for user in self.users[1:]]
+        while len(self.users) < size:
+            self.users.append(person(UserRole.EMPLOYEE, rng.choice(manager_ids)))
+
+        self.tasks = [
+            {
+                "id": make_uuid(rng),
+                "title": title,
+                "description": f"{title} this quarter",
+                "points_reward": rng.choice([10, 15, 20, 25, 50]),
+                "company_id": self.id,
+                "created_by": rng.choice(manager_ids),
+                "is_active": True,
+                "created_at": created_at
+            }
+            for title in TASK_TITLES
+        ]
+
+        # Everyone but the admin can be recognized; popularity follows a Zipf law
+        self.recipients = self.users[1:]
+        rng.shuffle(self.recipients)
+        self.recipient_weights = zipf_cum_weights(len(self.recipients), exponent)
+
+
+async def insert_batch(collection, documents, semaphore: asyncio.Semaphore, counters):
+    try:
+        await collection.insert_many(documents, ordered=False)
+        counters[collection.name] = counters.get(collection.name, 0) + len(documents)
+    finally:
+        semaphore.release()
+
+
+async def drop_seeded_collections():
+    names = await db.list_collection_names()
+    for name in names:
+        if name in SEED_DROP_COLLECTIONS or name.startswith(LEDGER_ARCHIVE_PREFIX):
+            await db.drop_collection(name)
+
+
+async def seed(args):
+    rng = random.Random(args.seed)
+    now = args.end or datetime.utcnow().replace(microsecond=0)
+    history_start = now - timedelta(days=args.days)
+    hot_cutoff = ledger_hot_cutoff(now)
+    period_start = month_start(now)
+    password_hash = hash_password(args.password)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    pending = set()
+    counters = {}
+
+    async def submit(collection, documents):
+        await semaphore.acquire()
+        task = asyncio.create_task(insert_batch(collection, documents, semaphore, counters))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    started = time.monotonic()
+    sizes = company_sizes(rng, args.companies, args.users, args.company_exponent)
+    companies = [
+        SeedCompany(rng, index, size, history_start, password_hash, args.recipient_exponent)
+        for index, size in enumerate(sizes)
+    ]
+    company_weights = []
+    total = 0
+    for company in companies:
+        total += len(company.users)
+        company_weights.append(total)
+
+    await db.companies.insert_many([company.document for company in companies])
+    await db.badges.insert_many([badge for company in companies for badge in company.badges])
+    await db.tasks.insert_many([task for company in companies for task in company.tasks])
+
+    # Running per-user state, keyed by the user documents themselves
+    spent_this_period = {}
+    next_badge = {}
+    user_badges = []
+    completions = set()  # (user id, task id); the API refuses a second completion
+    batches = {}
+    archive_names = set()
+    expiries = ExpirySchedule()
+
+    async def write(name, document):
+        if name.startswith(LEDGER_ARCHIVE_PREFIX):
+            archive_names.add(name)
+        batch = batches.setdefault(name, [])
+        batch.append(document)
+        if len(batch) >= args.batch_size:
+            await submit(db[name], batches.pop(name))
+
+    def ledger_name(created_at):
+        return "point_transactions" if created_at >= hot_cutoff else f"{LEDGER_ARCHIVE_PREFIX}{created_at.year}"
+
+    def expire_credits(until):
+        """Take credits out of balances once they expire, as the expiry sweep does"""
+        for amount, owner in expiries.pop_due(until):
+            owner["point_balance"] -= amount
+
+    for index in range(args.transactions):
+        # Evenly spaced timestamps keep the ledger (and badge earn times) in order
+        created_at = history_start + timedelta(
+            seconds=(index + rng.random()) * args.days * 86400 / args.transactions
+        )
+        expire_credits(created_at)
+        company = companies[rng.choices(range(len(companies)), cum_weights=company_weights)[0]]
+        recipient = company.recipients[
+            rng.choices(range(len(company.recipients)), cum_weights=company.recipient_weights)[0]
+        ]
+
+        transaction_type = "task_completion" if rng.random() < TASK_COMPLETION_SHARE else "manager_award"
+        open_tasks = [task for task in company.tasks if (recipient["id"], task["id"]) not in completions]
+        if not open_tasks:
+            transaction_type = "manager_award"
+        if transaction_type == "manager_award":
+            giver_id = recipient["manager_id"]
+            amount = min(int(5 * rng.paretovariate(1.6)), 100)
+            if created_at >= period_start:
+                # Awards in the current cap period cannot exceed the giver's cap
+                remaining = DEFAULT_POINT_CAP - spent_this_period.get(giver_id, 0)
+                amount = min(amount, remaining)
+                if amount > 0:
+                    spent_this_period[giver_id] = spent_this_period.get(giver_id, 0) + amount
+                elif open_tasks:
+                    transaction_type = "task_completion"
+                else:
+                    # Capped giver and nothing left to complete: no credit at this instant
+                    continue
+        if transaction_type == "task_completion":
+            task = rng.choice(open_tasks)
+            completions.add((recipient["id"], task["id"]))
+            giver_id = task["created_by"]
+            amount = task["points_reward"]
+            reason = f"Task completed: {task['title']}"
+        else:
+            reason = rng.choice(REASONS)
+
+        recipient["point_balance"] += amount
+        position = next_badge.get(recipient["id"], 0)
+        while position < len(company.badges) and company.badges[position]["points_required"] <= recipient["point_balance"]:
+            user_badges.append({
+                "id": make_uuid(rng),
+                "user_id": recipient["id"],
+                "badge_id": company.badges[position]["id"],
+                "earned_at": created_at,
+                "awarded_by": None
+            })
+            position += 1
+        next_badge[recipient["id"]] = position
+
+        transaction_id = make_uuid(rng)
+        await write(ledger_name(created_at), encode_ledger_document({
+            "id": transaction_id,
+            "from_user_id": giver_id,
+            "to_user_id": recipient["id"],
+            "amount": amount,
+            "reason": reason,
+            "company_id": company.id,
+            "transaction_type": transaction_type,
+            "created_at": created_at
+        }))
+        # The seed never spends lots, so each lot's final state is known as it is generated
+        lot = {
+            "id": make_uuid(rng),
+            "user_id": recipient["id"],
+            "company_id": company.id,
+            "transaction_id": transaction_id,
+            "amount": amount,
+            "remaining": amount,
+            "awarded_at": created_at,
+            "expires_at": add_months(created_at, POINT_EXPIRY_MONTHS),
+            "expired_at": None
+        }
+        if lot["expires_at"] <= now:
+            lot.update({
+                "remaining": 0, "expired_amount": amount, "expired_at": lot["expires_at"],
+                "expiry_recorded": True, "debited": True
+            })
+            await write(ledger_name(lot["expires_at"]), encode_ledger_document({
+                "id": str(uuid.uuid5(POINT_EXPIRY_NAMESPACE, lot["id"])),
+                "from_user_id": recipient["id"],
+                "to_user_id": recipient["id"],
+                "amount": -amount,
+                "reason": f"Points expired (awarded {created_at:%Y-%m-%d})",
+                "company_id": company.id,
+                "transaction_type": "expiry",
+                "created_at": lot["expires_at"]
+            }))
+            expiries.push(lot["expires_at"], amount, recipient)
+        await write("point_lots", lot)
+        if (index + 1) % 1_000_000 == 0:
+            elapsed = time.monotonic() - started
+            print(f"  {index + 1:,} transactions generated ({(index + 1) / elapsed:,.0f}/s)")
+
+    expire_credits(now)
+    for name, batch in batches.items():
+        await submit(db[name], batch)
+
+    users = []
+    for company in companies:
+        for user in company.users:
+            if user["role"] in (UserRole.MANAGER.value, UserRole.COMPANY_ADMIN.value):
+                user["point_cap_renewed_at"] = period_start
+                user["point_cap_renewal_period"] = point_cap_renewal_period(period_start)
+                user["point_cap"] = DEFAULT_POINT_CAP - spent_this_period.get(user["id"], 0)
+            users.append(user)
+    for collection, documents in ((db.users, users), (db.user_badges, user_badges)):
+        for offset in range(0, len(documents), args.batch_size):
+            await submit(collection, documents[offset:offset + args.batch_size])
+
+    if pending:
+        await asyncio.gather(*pending)
+    written = time.monotonic() - started
+
+    # Building indexes once after the bulk load is far cheaper than maintaining them per insert
+    await ensure_indexes()
+    for name in archive_names:
+        await ensure_archive_indexes(name)
+
+    print(f"Seeded in {written:.1f}s, indexed in {time.monotonic() - started - written:.1f}s")
+    print(f"  companies: {len(companies):,}")
+    for name, count in sorted(counters.items()):
+        print(f"  {name}: {count:,}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Seed Mongo with high-volume synthetic recognition data")
+    parser.add_argument("--companies", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100_000, help="Total users across all companies")
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=730, help="Days of ledger history to generate")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="Timestamp of the newest ledger row (default: now)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed; the same seed yields the same data")
+    parser.add_argument("--company-exponent", type=float, default=1.0, help="Zipf exponent for company sizes")
+    parser.add_argument("--recipient-exponent", type=float, default=1.1, help="Zipf exponent for recognition received")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8, help="insert_many batches in flight")
+    parser.add_argument("--password", default="password", help="Password for every seeded user")
+    parser.add_argument("--drop", action="store_true", help="Drop application collections before seeding")
+    args = parser.parse_args()
+
+    try:
+        if args.drop:
+            await drop_seeded_collections()
+        await seed(args)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
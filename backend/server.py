@@ -1,20 +1,48 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Header, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import sys
+import asyncio
+import contextvars
+import threading
+import weakref
+import hmac
+import socket
+import time
+import hashlib
+import ipaddress
+import json
+import math
+import base64
+import bisect
+import calendar
+import re
 import logging
+import smtplib
+from email.message import EmailMessage
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
-from datetime import datetime, timedelta
+import random
+import secrets
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
 import jwt
 import bcrypt
+import httpx
 from enum import Enum
-from bson import ObjectId
+from collections import OrderedDict
+from bson import Binary, ObjectId, UuidRepresentation
+from pymongo import ReadPreference, ReturnDocument, UpdateOne, monitoring
+from pymongo.collation import Collation
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure, PyMongoError
 from fastapi.encoders import jsonable_encoder
+import pydantic_core
 
 # Custom JSON encoder to handle ObjectId
 class CustomJSONEncoder:
@@ -27,9 +55,90 @@ class CustomJSONEncoder:
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Profiled requests carry their RequestProfile in this context variable; Motor
+# runs driver calls in a copy of the caller's context, so the listener sees it
+active_profile: contextvars.ContextVar = contextvars.ContextVar("active_profile", default=None)
+
+class ProfileCommandListener(monitoring.CommandListener):
+    """Feeds Mongo commands into the active request profile; a no-op otherwise"""
+
+    def started(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, True)
+
+    def failed(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, False)
+
+# ASGI scope of the request being served, for attributing Mongo commands to routes
+current_request_scope: contextvars.ContextVar = contextvars.ContextVar("current_request_scope", default=None)
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Hands reads slower than SLOW_QUERY_THRESHOLD_MS to the slow query recorder"""
+
+    def __init__(self):
+        self.pending: Dict[Any, Any] = {}
+        self.loop = None
+        self.queue = None
+        self.dropped = 0
+
+    def attach(self, loop):
+        self.queue = asyncio.Queue(maxsize=SLOW_QUERY_QUEUE_SIZE)
+        self.loop = loop
+
+    def detach(self):
+        self.loop = None
+        self.pending.clear()
+
+    def started(self, event):
+        if self.loop is None or event.command_name not in SLOW_QUERY_COMMANDS:
+            return
+        self.pending[(event.connection_id, event.request_id)] = (event, current_request_scope.get())
+
+    def succeeded(self, event):
+        started = self.pending.pop((event.connection_id, event.request_id), None) if self.pending else None
+        loop = self.loop
+        if started is None or loop is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < SLOW_QUERY_THRESHOLD_MS:
+            return
+        started_event, scope = started
+        route = scope.get("route") if scope else None
+        slow_query = {
+            "at": datetime.utcnow(),
+            "method": scope["method"] if scope else None,
+            "route": route.path if route else (scope["path"] if scope else "background"),
+            "command": started_event.command_name,
+            "collection": str(started_event.command.get(started_event.command_name)),
+            "database": started_event.database_name,
+            "duration_ms": duration_ms,
+            "command_document": started_event.command
+        }
+        loop.call_soon_threadsafe(self.enqueue, slow_query)
+
+    def failed(self, event):
+        if self.pending:
+            self.pending.pop((event.connection_id, event.request_id), None)
+
+    def enqueue(self, slow_query):
+        try:
+            self.queue.put_nowait(slow_query)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+slow_query_listener = SlowQueryListener()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[ProfileCommandListener(), slow_query_listener])
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -42,6 +151,193 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
+ACCESS_TOKEN_TTL_SECONDS = int(os.environ.get('ACCESS_TOKEN_TTL_SECONDS', '900'))
+REFRESH_TOKEN_TTL_DAYS = int(os.environ.get('REFRESH_TOKEN_TTL_DAYS', '30'))
+REFRESH_REUSE_GRACE_SECONDS = 10  # a just-rotated refresh token replayed by a second tab is not treated as theft
+
+# Token revocation: every worker mirrors the revocations collection into a Bloom
+# filter, polling for new entries every REVOCATION_SYNC_SECONDS
+REVOCATION_SYNC_SECONDS = float(os.environ.get('REVOCATION_SYNC_SECONDS', '2'))
+REVOCATION_SYNC_OVERLAP_SECONDS = 30  # re-read window for entries written by a worker with a lagging clock
+REVOCATION_REBUILD_SECONDS = int(os.environ.get('REVOCATION_REBUILD_SECONDS', '600'))
+REVOCATION_BLOOM_CAPACITY = int(os.environ.get('REVOCATION_BLOOM_CAPACITY', '100000'))
+REVOCATION_BLOOM_ERROR_RATE = 0.001
+
+# Scheduler
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_LOCK_TTL_SECONDS = int(os.environ.get('SCHEDULER_LOCK_TTL_SECONDS', '120'))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Point caps
+DEFAULT_POINT_CAP = int(os.environ.get('DEFAULT_POINT_CAP', '500'))
+POINT_CAP_RENEWAL_PERIOD = os.environ.get('POINT_CAP_RENEWAL_PERIOD', 'monthly')  # daily, weekly or monthly
+POINT_CAP_RENEWAL_INTERVAL_SECONDS = int(os.environ.get('POINT_CAP_RENEWAL_INTERVAL_SECONDS', '300'))
+POINT_CAP_RENEWAL_BATCH_SIZE = int(os.environ.get('POINT_CAP_RENEWAL_BATCH_SIZE', '1000'))
+
+# Ledger reconciliation
+RECONCILIATION_BATCH_SIZE = int(os.environ.get('RECONCILIATION_BATCH_SIZE', '500'))
+RECONCILIATION_PAUSE_SECONDS = float(os.environ.get('RECONCILIATION_PAUSE_SECONDS', '0.05'))
+RECONCILIATION_SETTLE_SECONDS = float(os.environ.get('RECONCILIATION_SETTLE_SECONDS', '2'))
+RECONCILIATION_REPORT_LIMIT = 1000
+
+# Ledger archival
+LEDGER_HOT_MONTHS = int(os.environ.get('LEDGER_HOT_MONTHS', '12'))
+LEDGER_ARCHIVE_PREFIX = "point_transactions_archive_"
+LEDGER_ARCHIVE_BATCH_SIZE = int(os.environ.get('LEDGER_ARCHIVE_BATCH_SIZE', '1000'))
+LEDGER_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('LEDGER_ARCHIVE_INTERVAL_SECONDS', '3600'))
+
+# Ledger id storage: "string" (36-char ids), "dual" (write binary UUIDs, match
+# both forms while migrate_ledger_ids.py runs) or "binary"
+LEDGER_ID_STORAGE = os.environ.get('LEDGER_ID_STORAGE', 'string')
+LEDGER_ID_FIELDS = ("id", "from_user_id", "to_user_id", "company_id")
+
+# Ledger group commit: ledger rows and balance increments arriving within the
+# window (or until the batch is full) are flushed together as unordered bulk writes
+LEDGER_BATCH_ENABLED = os.environ.get('LEDGER_BATCH_ENABLED', 'true').lower() == 'true'
+LEDGER_BATCH_WINDOW_SECONDS = float(os.environ.get('LEDGER_BATCH_WINDOW_MS', '5')) / 1000
+LEDGER_BATCH_MAX_OPS = int(os.environ.get('LEDGER_BATCH_MAX_OPS', '500'))
+
+# Point expiry
+POINT_EXPIRY_MONTHS = int(os.environ.get('POINT_EXPIRY_MONTHS', '12'))
+POINT_EXPIRY_INTERVAL_SECONDS = int(os.environ.get('POINT_EXPIRY_INTERVAL_SECONDS', '3600'))
+POINT_EXPIRY_BATCH_SIZE = int(os.environ.get('POINT_EXPIRY_BATCH_SIZE', '500'))
+POINT_LOT_TRANSACTION_TYPES = {"manager_award", "task_completion", "bonus"}
+
+# Notification digests (point SMTP_HOST/SMTP_PORT at a local debugging server,
+# e.g. `python -m aiosmtpd -n -l localhost:1025`, to inspect them)
+DIGESTS_ENABLED = os.environ.get('DIGESTS_ENABLED', 'true').lower() == 'true'
+DIGEST_BUCKET_HOURS = int(os.environ.get('DIGEST_BUCKET_HOURS', '24'))
+DIGEST_INTERVAL_SECONDS = int(os.environ.get('DIGEST_INTERVAL_SECONDS', '900'))
+DIGEST_BATCH_SIZE = int(os.environ.get('DIGEST_BATCH_SIZE', '500'))
+DIGEST_MAX_EVENTS = 20  # events listed per digest
+DIGEST_MAX_ATTEMPTS = int(os.environ.get('DIGEST_MAX_ATTEMPTS', '5'))
+DIGEST_RETENTION_SECONDS = int(os.environ.get('DIGEST_RETENTION_SECONDS', str(30 * 86400)))
+DIGEST_FROM_ADDRESS = os.environ.get('DIGEST_FROM_ADDRESS', 'Effydoc <no-reply@effydoc.local>')
+DIGEST_APP_URL = os.environ.get('DIGEST_APP_URL', 'http://localhost:3000')
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '1025'))
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'false').lower() == 'true'
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '4'))
+SMTP_TIMEOUT_SECONDS = float(os.environ.get('SMTP_TIMEOUT_SECONDS', '30'))
+
+# Balance snapshots
+BALANCE_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('BALANCE_SNAPSHOT_INTERVAL_SECONDS', '3600'))
+BALANCE_SNAPSHOT_BATCH_SIZE = int(os.environ.get('BALANCE_SNAPSHOT_BATCH_SIZE', '500'))
+
+# Catalog cache
+CATALOG_CACHE_TTL_SECONDS = float(os.environ.get('CATALOG_CACHE_TTL_SECONDS', '60'))
+
+# Cache invalidation bus (needs a replica set, e.g. a local single-node one
+# started with `mongod --replSet rs0` and MONGO_URL=mongodb://localhost:27017/?replicaSet=rs0)
+CACHE_BUS_ENABLED = os.environ.get('CACHE_BUS_ENABLED', 'true').lower() == 'true'
+# Workers lease numbered slots "<CACHE_BUS_ID>:<n>"; a restarted worker takes a slot back
+# with its resume token. Set CACHE_BUS_ID when hostnames change across restarts
+CACHE_BUS_ID = os.environ.get('CACHE_BUS_ID', socket.gethostname())
+CACHE_BUS_SLOT_LEASE_SECONDS = float(os.environ.get('CACHE_BUS_SLOT_LEASE_SECONDS', '30'))
+CACHE_BUS_TOKEN_RETENTION_SECONDS = int(os.environ.get('CACHE_BUS_TOKEN_RETENTION_SECONDS', '86400'))  # unused slots expire
+CACHE_BUS_COLLECTIONS = ["users", "companies", "badges", "webhook_endpoints"]
+# User fields baked into access tokens; balance and cap $incs are not watched
+CACHE_BUS_USER_FIELDS = ["is_active", "role", "name", "company_id"]
+CACHE_BUS_TOKEN_FLUSH_SECONDS = float(os.environ.get('CACHE_BUS_TOKEN_FLUSH_SECONDS', '1'))
+
+# Idempotency keys
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_LRU_SIZE = int(os.environ.get('IDEMPOTENCY_LRU_SIZE', '10000'))
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '30'))
+
+# Admission control
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # "memory" or "mongo"
+
+def parse_rate_limit(name: str, default: str):
+    """Read a "rate:burst" limit, in requests per second, from the environment"""
+    rate, burst = os.environ.get(name, default).split(":")
+    return float(rate), float(burst)
+
+# Token refreshes: every session refreshes once per ACCESS_TOKEN_TTL_SECONDS, so a
+# user's bucket fits RATE_LIMIT_REFRESH_SESSIONS_PER_USER sessions and an address
+# (an office NAT, say) RATE_LIMIT_REFRESH_SESSIONS_PER_CLIENT of them, with room to burst
+REFRESH_SESSIONS_PER_USER = int(os.environ.get('RATE_LIMIT_REFRESH_SESSIONS_PER_USER', '20'))
+REFRESH_SESSIONS_PER_CLIENT = int(os.environ.get('RATE_LIMIT_REFRESH_SESSIONS_PER_CLIENT', '2000'))
+
+# Reverse proxies (IPs or CIDRs) whose X-Forwarded-For / X-Real-IP headers name the real client
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get('TRUSTED_PROXIES', '').split(",") if proxy.strip()
+]
+
+# Routes that check or set passwords; everything else is bucketed by its caller
+AUTH_ROUTES = {("POST", "/api/auth/login"), ("POST", "/api/auth/register"), ("POST", "/api/companies")}
+
+# (route class, scope) -> (tokens per second, bucket size)
+RATE_LIMITS = {
+    # Password routes per address: room for an office behind one NAT signing in at 9am
+    ("auth", "client"): parse_rate_limit('RATE_LIMIT_AUTH_CLIENT', '2:100'),
+    # Password routes sent with a live token (the frontend keeps sending the last one), per
+    # user and on top of the address bucket
+    ("auth", "user"): parse_rate_limit('RATE_LIMIT_AUTH_USER', '1:10'),
+    # Callers without a valid token on any other route
+    ("anonymous", "client"): parse_rate_limit('RATE_LIMIT_ANONYMOUS_CLIENT', '20:40'),
+    ("refresh", "user"): (REFRESH_SESSIONS_PER_USER / ACCESS_TOKEN_TTL_SECONDS, REFRESH_SESSIONS_PER_USER),
+    ("refresh", "client"): (REFRESH_SESSIONS_PER_CLIENT / ACCESS_TOKEN_TTL_SECONDS, max(10, REFRESH_SESSIONS_PER_CLIENT // 10)),
+    ("writes", "user"): parse_rate_limit('RATE_LIMIT_WRITES_USER', '10:50'),
+    ("writes", "company"): parse_rate_limit('RATE_LIMIT_WRITES_COMPANY', '200:400'),
+    ("reads", "user"): parse_rate_limit('RATE_LIMIT_READS_USER', '50:100'),
+    ("reads", "company"): parse_rate_limit('RATE_LIMIT_READS_COMPANY', '500:1000'),
+}
+
+# Per-worker caps on concurrent requests to expensive endpoints
+CONCURRENCY_LIMITS = [
+    ("POST", re.compile(r"^/api/auth/login$"), "login", int(os.environ.get('CONCURRENCY_LIMIT_LOGIN', '4'))),
+    ("GET", re.compile(r"^/api/users/[^/]+/profile$"), "profile", int(os.environ.get('CONCURRENCY_LIMIT_PROFILE', '16'))),
+]
+
+# Request profiling
+# A super admin profiles one request by sending X-Profile-Signature: a value from
+# sign_profile_request(user_id), i.e. "<expires>.<HMAC-SHA256 of user_id:expires>"
+# keyed by PROFILING_SECRET. An empty secret disables the hook.
+PROFILING_SECRET = os.environ.get('PROFILING_SECRET', '')
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5')) / 1000
+PROFILE_MAX_TIMELINE = 5000  # Mongo commands kept per profile
+PROFILE_RETENTION_SECONDS = int(os.environ.get('PROFILE_RETENTION_SECONDS', str(7 * 86400)))
+
+# Slow query capture
+SLOW_QUERY_ENABLED = os.environ.get('SLOW_QUERY_ENABLED', 'true').lower() == 'true'
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_THRESHOLD_MS', '100'))
+SLOW_QUERY_COMMANDS = {"find", "aggregate", "count"}
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS = float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS', '600'))
+SLOW_QUERY_COLLECTION_BYTES = int(os.environ.get('SLOW_QUERY_COLLECTION_BYTES', str(64 * 1024 * 1024)))
+SLOW_QUERY_QUEUE_SIZE = 1000
+
+# Webhooks
+WEBHOOKS_ENABLED = os.environ.get('WEBHOOKS_ENABLED', 'true').lower() == 'true'
+WEBHOOK_EVENTS = {"points.awarded", "task.completed", "badge.earned"}
+WEBHOOK_ENDPOINT_CACHE_SECONDS = float(os.environ.get('WEBHOOK_ENDPOINT_CACHE_SECONDS', '30'))
+WEBHOOK_POLL_SECONDS = float(os.environ.get('WEBHOOK_POLL_SECONDS', '1'))
+WEBHOOK_CLAIM_SIZE = int(os.environ.get('WEBHOOK_CLAIM_SIZE', '500'))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '50'))  # events per POST
+WEBHOOK_DESTINATION_CONCURRENCY = int(os.environ.get('WEBHOOK_DESTINATION_CONCURRENCY', '4'))  # per host:port
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('WEBHOOK_MAX_IN_FLIGHT', '64'))  # per worker
+WEBHOOK_TIMEOUT_SECONDS = float(os.environ.get('WEBHOOK_TIMEOUT_SECONDS', '10'))
+WEBHOOK_LEASE_SECONDS = int(os.environ.get('WEBHOOK_LEASE_SECONDS', '60'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '12'))
+WEBHOOK_BACKOFF_BASE_SECONDS = float(os.environ.get('WEBHOOK_BACKOFF_BASE_SECONDS', '2'))
+WEBHOOK_BACKOFF_MAX_SECONDS = float(os.environ.get('WEBHOOK_BACKOFF_MAX_SECONDS', '3600'))
+WEBHOOK_RETENTION_SECONDS = int(os.environ.get('WEBHOOK_RETENTION_SECONDS', str(7 * 86400)))
+# Loopback, private and link-local destinations are refused unless explicitly allowed (local development)
+WEBHOOK_ALLOW_PRIVATE_DESTINATIONS = os.environ.get('WEBHOOK_ALLOW_PRIVATE_DESTINATIONS', 'false').lower() == 'true'
+
+# Directory
+DIRECTORY_COLLATION = Collation(locale="en", strength=2)  # case-insensitive name/email ordering
+DIRECTORY_PAGE_SIZE = 50
+DIRECTORY_MAX_PAGE_SIZE = 200
+DIRECTORY_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "email": 1, "role": 1, "department": 1,
+    "manager_id": 1, "point_balance": 1
+}
 
 # Enums
 class UserRole(str, Enum):
@@ -65,8 +361,10 @@ class User(BaseModel):
     manager_id: Optional[str] = None
     department: Optional[str] = None
     point_balance: int = 0
-    point_cap: int = 500
+    point_cap: int = DEFAULT_POINT_CAP
     point_cap_renewal_type: str = "request"  # "request" or "automatic"
+    point_cap_renewed_at: Optional[datetime] = None
+    point_cap_renewal_period: Optional[str] = None
     is_active: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -88,6 +386,7 @@ class Company(BaseModel):
     name: str
     point_name: str = "effyPoints"
     logo_url: Optional[str] = None
+    catalog_version: int = 0  # bumped whenever the company or its badges change
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
 
@@ -146,6 +445,58 @@ class TaskCreate(BaseModel):
     description: str
     points_reward: int
 
+class Reward(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    description: str
+    points_cost: int
+    stock: Optional[int] = None  # None means unlimited
+    company_id: str
+    created_by: str
+    is_active: bool = True
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class RewardCreate(BaseModel):
+    name: str
+    description: str
+    points_cost: int
+    stock: Optional[int] = None
+
+class Redemption(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    reward_id: str
+    reward_name: str
+    user_id: str
+    company_id: str
+    points_cost: int
+    transaction_id: str
+    status: str = "pending"  # pending until fulfilled by an admin
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WebhookEndpoint(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    company_id: str
+    url: str
+    secret: str = Field(default_factory=lambda: secrets.token_hex(32))
+    events: List[str] = []  # empty means every event
+    is_active: bool = True
+    created_by: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WebhookEndpointCreate(BaseModel):
+    url: str
+    events: List[str] = []
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
+
+class ReconciliationRequest(BaseModel):
+    company_id: Optional[str] = None
+    repair: bool = False
+
 # Helper functions
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -153,33 +504,523 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_jwt_token(user_id: str, email: str, role: str, company_id: str = None) -> str:
+def create_jwt_token(user: Dict[str, Any]) -> str:
+    """Short-lived access token carrying every claim routes read, so checking it needs no lookup"""
+    now = datetime.utcnow()
     payload = {
-        'user_id': user_id,
-        'email': email,
-        'role': role,
-        'company_id': company_id,
-        'exp': datetime.utcnow() + timedelta(days=7)
+        'user_id': user["id"],
+        'email': user["email"],
+        'name': user["name"],
+        'role': UserRole(user["role"]).value,
+        'company_id': user.get("company_id"),
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + timedelta(seconds=ACCESS_TOKEN_TTL_SECONDS)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def hash_refresh_token(refresh_token: str) -> str:
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+async def issue_refresh_token(user_id: str, family_id: Optional[str] = None) -> str:
+    """Opaque single-use refresh token; only its hash is stored. Rotations share the login's family"""
+    refresh_token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    await db.refresh_tokens.insert_one({
+        "_id": hash_refresh_token(refresh_token),
+        "user_id": user_id,
+        "family_id": family_id or str(uuid.uuid4()),
+        "created_at": now,
+        "expires_at": now + timedelta(days=REFRESH_TOKEN_TTL_DAYS),
+        "used_at": None
+    })
+    return refresh_token
+
+async def issue_tokens(user: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "token": create_jwt_token(user),
+        "refresh_token": await issue_refresh_token(user["id"]),
+        "expires_in": ACCESS_TOKEN_TTL_SECONDS
+    }
+
+def decode_access_token(token: str) -> Dict[str, Any]:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get('user_id')
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user_data = await db.users.find_one({"id": user_id})
-        if not user_data:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        return User(**user_data)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if not payload.get('user_id'):
         raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+# Stored fields no caller needs back: the password hash and the expiry sweep's bookkeeping
+USER_RECORD_PROJECTION = {"_id": 0, "password": 0, "pending_expiries": 0}
+
+async def find_active_user(user_id: str, projection: Dict[str, int]) -> Dict[str, Any]:
+    user_data = await db.users.find_one({"id": user_id}, projection)
+    if not user_data:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not user_data.get("is_active", True):
+        raise HTTPException(status_code=401, detail="User is deactivated")
+    return user_data
+
+async def load_active_user(user_id: str) -> User:
+    return User(**await find_active_user(user_id, USER_RECORD_PROJECTION))
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Caller built from the access token's claims; balances and caps are not loaded"""
+    payload = decode_access_token(credentials.credentials)
+    if 'jti' not in payload:
+        # Seven-day tokens from before refresh tokens carry no jti or name and
+        # are checked against the user document until they expire
+        return await load_active_user(payload['user_id'])
+    if await revocations.is_revoked(payload):
+        raise HTTPException(status_code=401, detail="Token revoked")
+    
+    return User(
+        id=payload['user_id'],
+        email=payload['email'],
+        name=payload['name'],
+        role=payload['role'],
+        company_id=payload.get('company_id')
+    )
+
+async def get_current_user_record(current_user: User = Depends(get_current_user)):
+    """Caller's full user document, for routes that return the user itself"""
+    return await load_active_user(current_user.id)
+
+def get_current_user_fields(*fields: str):
+    """Dependency for routes that read a few stored fields, e.g. point_balance: the
+    token's claims with only those fields loaded from the user document"""
+    projection = {"_id": 0, "is_active": 1, **{field: 1 for field in fields}}
+
+    async def current_user_fields(current_user: User = Depends(get_current_user)):
+        user_data = await find_active_user(current_user.id, projection)
+        return current_user.model_copy(update=user_data)
+
+    return current_user_fields
+
+# Cache invalidation bus
+# Every worker tails one change stream over the cached collections and evicts
+# the keys each change touches from its own in-process caches
+cache_invalidators: Dict[str, List[Any]] = {collection: [] for collection in CACHE_BUS_COLLECTIONS}
+cache_flushers: List[Any] = []
+cache_bus_tasks = []
+
+def on_cache_invalidation(collection: str):
+    """Register a handler called with every change event on collection"""
+    def register(handler):
+        cache_invalidators[collection].append(handler)
+        return handler
+    return register
+
+def on_cache_flush(handler):
+    """Register a handler that empties a cache when invalidations may have been missed"""
+    cache_flushers.append(handler)
+    return handler
+
+def flush_caches():
+    for handler in cache_flushers:
+        handler()
+
+cache_bus_slot = {"id": None, "owner": uuid.uuid4().hex}
+
+async def claim_cache_bus_slot() -> Dict[str, Any]:
+    """Lease the lowest-numbered slot no live worker holds and return its document.
+    Slots are numbered per CACHE_BUS_ID, so a restarted worker gets one back once its
+    lease is released (on shutdown) or lapses (after a crash)"""
+    index = 0
+    while True:
+        slot_id = f"{CACHE_BUS_ID}:{index}"
+        now = datetime.utcnow()
+        try:
+            slot = await db.cache_bus_tokens.find_one_and_update(
+                {"_id": slot_id, "$or": [{"owner": cache_bus_slot["owner"]}, {"lease_until": {"$not": {"$gt": now}}}]},
+                {"$set": {
+                    "owner": cache_bus_slot["owner"],
+                    "lease_until": now + timedelta(seconds=CACHE_BUS_SLOT_LEASE_SECONDS),
+                    "updated_at": now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Held by a live worker
+            index += 1
+            continue
+        cache_bus_slot["id"] = slot_id
+        return slot
+
+async def save_cache_bus_token(resume_token, release: bool = False) -> bool:
+    """Store the token and extend (or release) the slot lease; False if the slot was lost"""
+    now = datetime.utcnow()
+    lease_until = now if release else now + timedelta(seconds=CACHE_BUS_SLOT_LEASE_SECONDS)
+    fields = {"lease_until": lease_until, "updated_at": now}
+    if resume_token is not None:
+        fields["resume_token"] = resume_token
+    result = await db.cache_bus_tokens.update_one(
+        {"_id": cache_bus_slot["id"], "owner": cache_bus_slot["owner"]}, {"$set": fields}
+    )
+    return result.matched_count == 1
+
+async def run_cache_invalidation_bus():
+    """Tail change streams and evict affected cache keys, resuming from the slot's stored token"""
+    slot = await claim_cache_bus_slot()
+    resume_token = slot.get("resume_token")
+    # Only events that invalidate something: no post-image lookups, and user
+    # updates only when a field tokens carry changes
+    pipeline = [{"$match": {"$or": [
+        {
+            "ns.coll": "users",
+            "operationType": "update",
+            "$or": [{f"updateDescription.updatedFields.{field}": {"$exists": True}} for field in CACHE_BUS_USER_FIELDS]
+        },
+        {
+            "ns.coll": {"$in": [collection for collection in CACHE_BUS_COLLECTIONS if collection != "users"]},
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+        }
+    ]}}]
+
+    while True:
+        if resume_token is None:
+            # Nothing to resume from, so changes since this slot last ran cannot be replayed
+            flush_caches()
+        try:
+            # try_next wakes up at least every max_await_time_ms, so the token (which advances
+            # on idle batches too) and the slot lease are saved even when nothing changes
+            async with db.watch(pipeline, resume_after=resume_token, max_await_time_ms=1000) as stream:
+                flushed_at = time.monotonic()
+                while stream.alive:
+                    change = await stream.try_next()
+                    if change is not None:
+                        collection = change.get("ns", {}).get("coll")
+                        for handler in cache_invalidators.get(collection, []):
+                            handler(change)
+                    resume_token = stream.resume_token or resume_token
+                    if time.monotonic() - flushed_at >= CACHE_BUS_TOKEN_FLUSH_SECONDS:
+                        if not await save_cache_bus_token(resume_token):
+                            # The lease lapsed (a stalled loop) and another worker took the slot
+                            logger.warning(f"Lost cache bus slot {cache_bus_slot['id']}, claiming another")
+                            await claim_cache_bus_slot()
+                            await save_cache_bus_token(resume_token)
+                        flushed_at = time.monotonic()
+        except asyncio.CancelledError:
+            await save_cache_bus_token(resume_token, release=True)
+            raise
+        except OperationFailure as e:
+            if e.code == 40573:
+                # Standalone server without change streams; caches fall back to their TTLs
+                logger.warning("Change streams unavailable, cache invalidation bus disabled")
+                return
+            if e.code in (260, 280, 286):
+                # The resume point fell off the oplog, so invalidations were lost
+                logger.warning("Cache bus resume token expired, flushing caches")
+                resume_token = None
+                continue
+            logger.exception("Cache invalidation bus failed, retrying")
+            await asyncio.sleep(1)
+        except PyMongoError:
+            logger.exception("Cache invalidation bus failed, retrying")
+            await asyncio.sleep(1)
+
+# Token revocation
+# Revoking writes a revocations entry that lives as long as the tokens it
+# rejects. Workers answer "not revoked" from the Bloom filter without a round
+# trip and confirm hits against Mongo, so a false positive costs one read
+revocation_tasks = []
+pending_revocations = set()
+
+class BloomFilter:
+    """Fixed-size Bloom filter with about error_rate false positives at capacity"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+class RevocationSet:
+    """This worker's view of the revocations collection"""
+
+    def __init__(self):
+        self.bloom = BloomFilter(REVOCATION_BLOOM_CAPACITY, REVOCATION_BLOOM_ERROR_RATE)
+        self.synced_at: Optional[datetime] = None
+        self.rebuilt_at = float("-inf")
+
+    async def is_revoked(self, payload: Dict[str, Any]) -> bool:
+        hits = [key for key in (f"user:{payload['user_id']}", f"token:{payload['jti']}") if key in self.bloom]
+        if not hits:
+            return False
+        async for entry in db.revocations.find({"_id": {"$in": hits}}):
+            # A user revocation rejects only tokens issued before it, so reactivated users can sign in again.
+            # iat has whole seconds, so tokens from the revocation's own second are rejected too
+            if entry["kind"] == "token" or payload['iat'] <= calendar.timegm(entry["revoked_at"].utctimetuple()):
+                return True
+        return False
+
+    async def sync(self):
+        """Add entries written since the last sync; rebuild now and then so expired entries drop out"""
+        started = datetime.utcnow()
+        if time.monotonic() - self.rebuilt_at >= REVOCATION_REBUILD_SECONDS:
+            bloom = BloomFilter(REVOCATION_BLOOM_CAPACITY, REVOCATION_BLOOM_ERROR_RATE)
+            async for entry in db.revocations.find({}, {"_id": 1}):
+                bloom.add(entry["_id"])
+            self.bloom = bloom
+            self.rebuilt_at = time.monotonic()
+        else:
+            since = self.synced_at - timedelta(seconds=REVOCATION_SYNC_OVERLAP_SECONDS)
+            # written_at, not revoked_at: a revocation replayed from an old change event carries an old revoked_at
+            async for entry in db.revocations.find({"written_at": {"$gt": since}}, {"_id": 1}):
+                self.bloom.add(entry["_id"])
+        self.synced_at = started
+
+revocations = RevocationSet()
+
+async def revoke(key: str, kind: str, expires_at: datetime, revoked_at: Optional[datetime] = None):
+    """Record a revocation effective at revoked_at (default now). $max keeps the latest cutoff,
+    so repeating a revocation with the same or an older time changes nothing"""
+    now = datetime.utcnow()
+    await db.revocations.update_one(
+        {"_id": key},
+        {"$set": {"kind": kind, "written_at": now}, "$max": {"revoked_at": revoked_at or now, "expires_at": expires_at}},
+        upsert=True
+    )
+    revocations.bloom.add(key)
+
+async def revoke_user(user_id: str, end_sessions: bool = True, revoked_at: Optional[datetime] = None):
+    """Reject the user's access tokens issued so far and, unless told otherwise, end their
+    refresh sessions; without that clients just refresh into tokens with current claims"""
+    await revoke(
+        f"user:{user_id}", "user", datetime.utcnow() + timedelta(seconds=ACCESS_TOKEN_TTL_SECONDS + 60), revoked_at
+    )
+    if end_sessions:
+        await db.refresh_tokens.delete_many({"user_id": user_id})
+
+async def revoke_access_token(payload: Dict[str, Any]):
+    if 'jti' in payload:
+        await revoke(f"token:{payload['jti']}", "token", datetime.utcfromtimestamp(payload['exp']) + timedelta(seconds=60))
+
+async def run_revocation_sync():
+    while True:
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+        try:
+            await revocations.sync()
+        except PyMongoError as e:
+            logger.warning(f"Revocation sync failed: {e}")
+
+def change_time(change: Dict[str, Any]) -> datetime:
+    """When a change event's write happened: wallTime, or clusterTime's seconds before MongoDB 6.0"""
+    if change.get("wallTime"):
+        return change["wallTime"]
+    if change.get("clusterTime"):
+        return datetime.utcfromtimestamp(change["clusterTime"].time)
+    return datetime.utcnow()
+
+async def revoke_changed_user(object_id: Any, deactivated: bool, changed_at: datetime):
+    user = await db.users.find_one({"_id": object_id}, {"_id": 0, "id": 1, "is_active": 1})
+    if user:
+        # A replayed deactivation of a user reactivated since must not end their new sessions
+        await revoke_user(user["id"], deactivated and user.get("is_active") is False, changed_at)
+
+@on_cache_invalidation("users")
+def revoke_changed_user_tokens(change: Dict[str, Any]):
+    # Changes made outside the API (e.g. directly in Mongo) still take effect within seconds:
+    # deactivation ends the user's sessions, other claim changes force a refresh. Every worker
+    # sees the event and replays can repeat it; all of them write the event's own time, so the
+    # cutoff is the same however often it is applied
+    updated = change.get("updateDescription", {}).get("updatedFields", {})
+    object_id = change.get("documentKey", {}).get("_id")
+    if object_id is None or not any(field in updated for field in CACHE_BUS_USER_FIELDS):
+        return
+    task = asyncio.get_running_loop().create_task(
+        revoke_changed_user(object_id, updated.get("is_active") is False, change_time(change))
+    )
+    pending_revocations.add(task)
+    task.add_done_callback(pending_revocations.discard)
+
+# Company catalog cache
+class CompanyCatalog:
+    """Cached company config and badge definitions stamped with catalog_version"""
+
+    def __init__(self, company: Company, badges: List[Dict[str, Any]]):
+        self.company = company
+        self.version = company.catalog_version
+        self.badges = {badge["id"]: badge for badge in badges}
+        self.points_badges = sorted(
+            (badge for badge in badges
+             if badge.get("badge_type") == BadgeType.POINTS_BASED.value and badge.get("is_active", True)),
+            key=lambda badge: badge.get("points_required") or 0
+        )
+        # Sorted threshold ladder for O(log n) next-badge lookups
+        self.points_thresholds = [badge.get("points_required") or 0 for badge in self.points_badges]
+        self.checked_at = time.monotonic()
+
+catalog_cache: Dict[str, CompanyCatalog] = {}
+# Mongo _id of every cached company and badge document -> company id, since
+# change events without a post-image carry only the _id
+catalog_owners: Dict[Any, str] = {}
+
+async def get_company_catalog(company_id: str) -> Optional[CompanyCatalog]:
+    """Company and badge catalog from memory, revalidated against the version stamp after the TTL"""
+    cached = catalog_cache.get(company_id)
+    if cached and time.monotonic() - cached.checked_at < CATALOG_CACHE_TTL_SECONDS:
+        return cached
+
+    if cached:
+        stamp = await db.companies.find_one({"id": company_id}, {"_id": 0, "catalog_version": 1})
+        if stamp and stamp.get("catalog_version", 0) == cached.version:
+            cached.checked_at = time.monotonic()
+            return cached
+
+    # Read the stamp before the badges so a concurrent bump forces another reload
+    company_data = await db.companies.find_one({"id": company_id})
+    if not company_data:
+        catalog_cache.pop(company_id, None)
+        return None
+    catalog_owners[company_data.pop("_id")] = company_id
+
+    badges = await db.badges.find({"company_id": company_id}).to_list(None)
+    for badge in badges:
+        catalog_owners[badge["_id"]] = company_id
+        if "_id" in badge and isinstance(badge["_id"], ObjectId):
+            badge["_id"] = str(badge["_id"])
+
+    catalog = CompanyCatalog(Company(**company_data), badges)
+    catalog_cache[company_id] = catalog
+    return catalog
+
+async def get_badge(badge_id: str, company_id: Optional[str]):
+    """Badge definition from the company catalog, falling back to Mongo for badges outside it"""
+    if company_id:
+        catalog = await get_company_catalog(company_id)
+        if catalog and badge_id in catalog.badges:
+            return catalog.badges[badge_id]
+
+    badge = await db.badges.find_one({"id": badge_id})
+    if badge and "_id" in badge and isinstance(badge["_id"], ObjectId):
+        badge["_id"] = str(badge["_id"])
+    return badge
+
+async def bump_catalog_version(company_id: str):
+    """Mark cached copies of a company's catalog as stale everywhere"""
+    await db.companies.update_one({"id": company_id}, {"$inc": {"catalog_version": 1}})
+    catalog_cache.pop(company_id, None)
+
+@on_cache_invalidation("companies")
+@on_cache_invalidation("badges")
+def invalidate_company_catalog(change: Dict[str, Any]):
+    # Inserts and replaces carry the document; other events only its _id, which
+    # maps to a company only if this worker has its catalog cached
+    document = change.get("fullDocument") or {}
+    company_id = document.get("id") if change["ns"]["coll"] == "companies" else document.get("company_id")
+    company_id = company_id or catalog_owners.get(change.get("documentKey", {}).get("_id"))
+    if company_id:
+        catalog_cache.pop(company_id, None)
+
+@on_cache_flush
+def flush_company_catalogs():
+    catalog_cache.clear()
+    catalog_owners.clear()
+
+# Response serialization
+class FastJSONResponse(JSONResponse):
+    """JSON rendered by pydantic-core: models use their compiled serializers and
+    plain documents are walked in Rust instead of by jsonable_encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return pydantic_core.to_json(content, fallback=str)
+
+def fast_json(content: Any, response: Optional[Response] = None) -> FastJSONResponse:
+    """Return content as-is, skipping FastAPI's jsonable_encoder pass; headers set
+    on the injected response (such as ETags) are carried over"""
+    return FastJSONResponse(content, headers=dict(response.headers) if response else None)
+
+# Entity versions
+# Change counters in entity_versions back the ETags of polled endpoints;
+# writers bump them after the write, readers read them before the data
+async def bump_versions(*keys: str):
+    if keys:
+        await db.entity_versions.bulk_write([
+            UpdateOne({"_id": key}, {"$inc": {"v": 1}}, upsert=True) for key in keys
+        ], ordered=False)
+
+async def get_versions(*keys: str) -> List[int]:
+    versions = {doc["_id"]: doc["v"] async for doc in db.entity_versions.find({"_id": {"$in": list(keys)}})}
+    return [versions.get(key, 0) for key in keys]
+
+def make_etag(*parts) -> str:
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak If-None-Match comparison"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [value.strip().removeprefix("W/") for value in header.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+# Per-request user lookups
+class UserLookup:
+    """Display fields of users referenced by a response, loaded with batched $in queries
+    and shared by every loader serving the same request"""
+
+    def __init__(self):
+        self.users: Dict[str, Optional[Dict[str, Any]]] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+
+    async def load(self, user_ids):
+        user_ids = set(user_ids)
+        # Ids another concurrent loader is already fetching are awaited, not re-queried
+        waits = {self.pending[user_id] for user_id in user_ids if user_id in self.pending}
+        missing = [user_id for user_id in user_ids if user_id not in self.users and user_id not in self.pending]
+
+        if missing:
+            future = asyncio.get_running_loop().create_future()
+            for user_id in missing:
+                self.pending[user_id] = future
+            try:
+                found = {
+                    user["id"]: user
+                    async for user in db.users.find({"id": {"$in": missing}}, {"_id": 0, "id": 1, "name": 1, "role": 1})
+                }
+                for user_id in missing:
+                    self.users[user_id] = found.get(user_id)
+            finally:
+                for user_id in missing:
+                    self.pending.pop(user_id, None)
+                future.set_result(None)
+
+        if waits:
+            await asyncio.gather(*waits)
+
+    def name(self, user_id: str) -> str:
+        user = self.users.get(user_id)
+        return user.get("name", "Unknown") if user else "Unknown"
+
+    def role(self, user_id: str) -> str:
+        user = self.users.get(user_id)
+        return user.get("role", "Unknown") if user else "Unknown"
 
 # Default badges
 DEFAULT_BADGES = [
@@ -198,26 +1039,24 @@ async def create_default_badges(company_id: str):
             **badge_data,
             company_id=company_id
         )
-        badges.append(badge.dict())
+        badges.append(badge.model_dump())
     
     if badges:
         await db.badges.insert_many(badges)
+        await bump_catalog_version(company_id)
 
 async def check_and_award_badges(user_id: str, company_id: str):
     """Check if user qualifies for any new badges and award them"""
     # Get user's current points
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "point_balance": 1})
     if not user:
         return
     
     current_points = user.get("point_balance", 0)
     
     # Get all point-based badges for the company
-    badges = await db.badges.find({
-        "company_id": company_id,
-        "badge_type": "points_based",
-        "is_active": True
-    }).to_list(100)
+    catalog = await get_company_catalog(company_id)
+    badges = catalog.points_badges if catalog else []
     
     # Get badges already earned by user
     earned_badges = await db.user_badges.find({"user_id": user_id}).to_list(100)
@@ -225,6 +1064,7 @@ async def check_and_award_badges(user_id: str, company_id: str):
     
     # Check which badges user qualifies for
     badges_awarded = False
+    new_badges = []
     for badge in badges:
         if (badge["id"] not in earned_badge_ids and 
             badge.get("points_required", 0) <= current_points):
@@ -234,10 +1074,2188 @@ async def check_and_award_badges(user_id: str, company_id: str):
                 user_id=user_id,
                 badge_id=badge["id"]
             )
-            await db.user_badges.insert_one(user_badge.dict())
-            badges_awarded = True
-            
-    return badges_awarded
+            await db.user_badges.insert_one(user_badge.model_dump())
+            badges_awarded = True
+            new_badges.append({"user_id": user_id, "badge_id": badge["id"], "badge_name": badge.get("name"),
+                               "earned_at": user_badge.earned_at})
+            await add_to_digest(user_id, company_id, {"kind": "badge", "badge_name": badge.get("name")})
+
+    if badges_awarded:
+        await bump_versions(f"user_badges:{user_id}", f"profile:{user_id}")
+        for new_badge in new_badges:
+            await emit_webhook_event(company_id, "badge.earned", new_badge)
+
+    return badges_awarded
+
+# Idempotency keys
+# Responses are stored per (user, route, Idempotency-Key) in a TTL-indexed
+# collection with an LRU in front; concurrent duplicates wait for one execution
+idempotency_lru: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+idempotency_inflight: Dict[str, asyncio.Future] = {}
+
+def remember_idempotent_response(key: str, record: Dict[str, Any]):
+    idempotency_lru[key] = record
+    idempotency_lru.move_to_end(key)
+    while len(idempotency_lru) > IDEMPOTENCY_LRU_SIZE:
+        idempotency_lru.popitem(last=False)
+
+def replay_idempotent_response(record: Dict[str, Any], request_hash: str, replayed: bool = True):
+    if record["request_hash"] != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    if record["status_code"] >= 400:
+        raise HTTPException(status_code=record["status_code"], detail=record["body"]["detail"])
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return JSONResponse(content=record["body"], status_code=record["status_code"], headers=headers)
+
+async def claim_idempotency_key(key: str, request_hash: str) -> Optional[Dict[str, Any]]:
+    """Claim key for execution, or wait for and return the record another worker stored"""
+    now = datetime.utcnow()
+    try:
+        await db.idempotency_keys.insert_one({
+            "_id": key,
+            "state": "in_progress",
+            "request_hash": request_hash,
+            "created_at": now
+        })
+        return None
+    except DuplicateKeyError:
+        pass
+
+    deadline = time.monotonic() + IDEMPOTENCY_LOCK_SECONDS
+    delay = 0.02
+    while time.monotonic() < deadline:
+        record = await db.idempotency_keys.find_one({"_id": key})
+        if record is None:
+            # The owner failed and released the key
+            return await claim_idempotency_key(key, request_hash)
+        if record["state"] == "completed":
+            return record
+        if record["created_at"] < datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS):
+            # The owner died mid-request; take the key over
+            claimed = await db.idempotency_keys.find_one_and_update(
+                {"_id": key, "state": "in_progress", "created_at": record["created_at"]},
+                {"$set": {"request_hash": request_hash, "created_at": datetime.utcnow()}}
+            )
+            if claimed:
+                return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+    raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+
+async def run_idempotent(idempotency_key: Optional[str], scope: str, user_id: str, payload: Dict[str, Any], handler):
+    """Run handler once per Idempotency-Key; retries get the stored response back"""
+    if not idempotency_key:
+        return await handler()
+
+    key = f"{user_id}:{scope}:{idempotency_key}"
+    request_hash = hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+    record = idempotency_lru.get(key)
+    if record:
+        idempotency_lru.move_to_end(key)
+        return replay_idempotent_response(record, request_hash)
+
+    inflight = idempotency_inflight.get(key)
+    if inflight:
+        record = await asyncio.shield(inflight)
+        if record is None:
+            # The first execution failed without a response worth replaying
+            return await run_idempotent(idempotency_key, scope, user_id, payload, handler)
+        return replay_idempotent_response(record, request_hash)
+
+    future = asyncio.get_running_loop().create_future()
+    idempotency_inflight[key] = future
+    record = None
+    try:
+        record = await claim_idempotency_key(key, request_hash)
+        replayed = record is not None
+        if record is None:
+            try:
+                result = await handler()
+                record = {"status_code": 200, "body": jsonable_encoder(result)}
+            except HTTPException as e:
+                record = {"status_code": e.status_code, "body": {"detail": e.detail}}
+            except Exception:
+                await db.idempotency_keys.delete_one({"_id": key, "state": "in_progress"})
+                raise
+            record["request_hash"] = request_hash
+            await db.idempotency_keys.update_one(
+                {"_id": key},
+                {"$set": {"state": "completed", **record}}
+            )
+        remember_idempotent_response(key, record)
+        return replay_idempotent_response(record, request_hash, replayed)
+    finally:
+        future.set_result(record)
+        idempotency_inflight.pop(key, None)
+
+# Scheduler
+SCHEDULED_JOBS = []  # (name, interval_seconds, job) tuples started on app startup
+scheduler_tasks = []
+
+async def acquire_leader_lock(name: str) -> bool:
+    """Take or extend the named scheduler lease so only one worker runs a job"""
+    now = datetime.utcnow()
+    try:
+        await db.scheduler_locks.find_one_and_update(
+            {
+                "_id": name,
+                "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now}}]
+            },
+            {"$set": {
+                "owner": WORKER_ID,
+                "expires_at": now + timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS)
+            }},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+async def release_leader_lock(name: str):
+    await db.scheduler_locks.delete_one({"_id": name, "owner": WORKER_ID})
+
+async def run_periodic_job(name: str, interval_seconds: int, job):
+    """Run a job every interval on whichever worker holds its leader lock"""
+    while True:
+        try:
+            if await acquire_leader_lock(name):
+                await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Scheduled job {name} failed")
+        await asyncio.sleep(interval_seconds)
+
+def point_cap_renewal_period(now: datetime) -> str:
+    """Key of the renewal period containing now"""
+    if POINT_CAP_RENEWAL_PERIOD == "daily":
+        return now.strftime("%Y-%m-%d")
+    if POINT_CAP_RENEWAL_PERIOD == "weekly":
+        year, week, _ = now.isocalendar()
+        return f"{year}-W{week:02d}"
+    return now.strftime("%Y-%m")
+
+async def renew_point_caps_for(user_ids: List[str], now: datetime) -> int:
+    """Reset the caps of automatic renewal users not yet renewed in now's period.
+    The reset and the period marker are one conditional update, so whichever of the
+    job and a user's first award of the period gets there first renews, exactly once,
+    and awards after it are never wiped. Returns how many were renewed"""
+    period = point_cap_renewal_period(now)
+    result = await db.users.bulk_write([
+        UpdateOne(
+            {
+                "id": user_id,
+                "point_cap_renewal_type": "automatic",
+                # Periods sort chronologically, so a delayed run for an older period is a no-op
+                "point_cap_renewal_period": {"$not": {"$gte": period}}
+            },
+            {"$set": {
+                "point_cap": DEFAULT_POINT_CAP,
+                "point_cap_renewal_period": period,
+                "point_cap_renewed_at": now
+            }}
+        )
+        for user_id in user_ids
+    ], ordered=False)
+    if not result.modified_count:
+        return 0
+    
+    # Users this call renewed carry its timestamp; skip the lookup when every one was renewed
+    renewed = user_ids
+    if result.modified_count < len(user_ids):
+        renewed = [
+            user["id"] async for user in db.users.find(
+                {"id": {"$in": user_ids}, "point_cap_renewed_at": now}, {"_id": 0, "id": 1}
+            )
+        ]
+    if not renewed:
+        return result.modified_count
+    # Keep a renewal history so caps can be answered as of past dates
+    await db.point_cap_renewals.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "period": period},
+            {"$setOnInsert": {"renewed_at": now, "point_cap": DEFAULT_POINT_CAP}},
+            upsert=True
+        )
+        for user_id in renewed
+    ], ordered=False)
+    await bump_versions(*(f"profile:{user_id}" for user_id in renewed))
+    return result.modified_count
+
+async def renew_point_caps():
+    """Renew point caps of all automatic renewal users, company by company"""
+    now = datetime.utcnow()
+    period = point_cap_renewal_period(now)
+    run_id = f"point_cap_renewal:{period}"
+
+    run = await db.scheduler_runs.find_one({"_id": run_id})
+    if run and run.get("status") == "completed":
+        return
+    if not run:
+        run = {
+            "_id": run_id,
+            "job": "point_cap_renewal",
+            "period": period,
+            "status": "running",
+            "checkpoint": {"company_id": "", "user_id": ""},
+            "users_renewed": 0,
+            "started_at": now
+        }
+        await db.scheduler_runs.insert_one(run)
+
+    # Resume from the last checkpoint written by this or a previous leader
+    checkpoint = run["checkpoint"]
+    users_renewed = run.get("users_renewed", 0)
+    renewed_this_pass = 0
+    started = datetime.utcnow()
+
+    companies = await db.companies.find(
+        {"id": {"$gte": checkpoint["company_id"]}},
+        {"_id": 0, "id": 1}
+    ).sort("id", 1).to_list(None)
+
+    for company in companies:
+        company_id = company["id"]
+        last_user_id = checkpoint["user_id"] if company_id == checkpoint["company_id"] else ""
+
+        while True:
+            users = await db.users.find(
+                {
+                    "company_id": company_id,
+                    "point_cap_renewal_type": "automatic",
+                    "id": {"$gt": last_user_id}
+                },
+                {"_id": 0, "id": 1}
+            ).sort("id", 1).limit(POINT_CAP_RENEWAL_BATCH_SIZE).to_list(POINT_CAP_RENEWAL_BATCH_SIZE)
+            if not users:
+                break
+
+            # Users already renewed this period are skipped, so replaying a batch is harmless
+            renewed = await renew_point_caps_for([user["id"] for user in users], now)
+            renewed_this_pass += renewed
+            users_renewed += renewed
+            last_user_id = users[-1]["id"]
+
+            await db.scheduler_runs.update_one(
+                {"_id": run_id},
+                {"$set": {
+                    "checkpoint": {"company_id": company_id, "user_id": last_user_id},
+                    "users_renewed": users_renewed
+                }}
+            )
+
+            # Stop if the lease was lost; the next leader resumes from the checkpoint
+            if not await acquire_leader_lock("point_cap_renewal"):
+                logger.warning(f"Lost point cap renewal lock at company {company_id}")
+                return
+
+    elapsed = max((datetime.utcnow() - started).total_seconds(), 1e-6)
+    throughput = renewed_this_pass / elapsed
+    await db.scheduler_runs.update_one(
+        {"_id": run_id},
+        {"$set": {
+            "status": "completed",
+            "finished_at": datetime.utcnow(),
+            "users_renewed": users_renewed,
+            "users_per_second": round(throughput, 1)
+        }}
+    )
+    logger.info(
+        f"Renewed point caps for {renewed_this_pass} users in period {period} "
+        f"in {elapsed:.1f}s ({throughput:.0f} users/s)"
+    )
+
+SCHEDULED_JOBS.append(("point_cap_renewal", POINT_CAP_RENEWAL_INTERVAL_SECONDS, renew_point_caps))
+
+# Ledger id codec
+# The API always sees string ids; in binary storage the ledger keeps them as
+# 16-byte BSON UUIDs, which also shrinks every index over them
+def ledger_id_to_binary(value: Any) -> Optional[Binary]:
+    if not isinstance(value, str):
+        return None
+    try:
+        return Binary.from_uuid(uuid.UUID(value), UuidRepresentation.STANDARD)
+    except ValueError:
+        return None
+
+def ledger_id_forms(value: Any) -> List[Any]:
+    """Stored representations a ledger id may have under the current storage mode"""
+    if LEDGER_ID_STORAGE == "string":
+        return [value]
+    binary = ledger_id_to_binary(value)
+    if binary is None:
+        return [value]
+    return [binary, value] if LEDGER_ID_STORAGE == "dual" else [binary]
+
+def encode_ledger_condition(condition: Any) -> Any:
+    if isinstance(condition, dict):
+        encoded = {}
+        for operator, value in condition.items():
+            if operator in ("$in", "$nin"):
+                encoded[operator] = [form for item in value for form in ledger_id_forms(item)]
+            elif operator in ("$eq", "$ne"):
+                forms = ledger_id_forms(value)
+                if len(forms) == 1:
+                    encoded[operator] = forms[0]
+                else:
+                    encoded["$in" if operator == "$eq" else "$nin"] = forms
+            else:
+                encoded[operator] = condition[operator]
+        return encoded
+    forms = ledger_id_forms(condition)
+    return forms[0] if len(forms) == 1 else {"$in": forms}
+
+def encode_ledger_query(query: Dict[str, Any]) -> Dict[str, Any]:
+    """Rewrite id conditions of a ledger filter to match the stored representation"""
+    if LEDGER_ID_STORAGE == "string":
+        return query
+    encoded = {}
+    for key, value in query.items():
+        if key in ("$or", "$and", "$nor"):
+            encoded[key] = [encode_ledger_query(clause) for clause in value]
+        elif key in LEDGER_ID_FIELDS:
+            encoded[key] = encode_ledger_condition(value)
+        else:
+            encoded[key] = value
+    return encoded
+
+def encode_ledger_document(document: Dict[str, Any]) -> Dict[str, Any]:
+    if LEDGER_ID_STORAGE == "string":
+        return document
+    for field in LEDGER_ID_FIELDS:
+        binary = ledger_id_to_binary(document.get(field))
+        if binary is not None:
+            document[field] = binary
+    return document
+
+def decode_ledger_id(value: Any) -> Any:
+    if isinstance(value, Binary) and value.subtype == 4:
+        return str(uuid.UUID(bytes=bytes(value)))
+    return value
+
+def decode_ledger_document(document: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # Always decode, so rows written in either mode read back the same
+    if document:
+        for field in LEDGER_ID_FIELDS:
+            if field in document:
+                document[field] = decode_ledger_id(document[field])
+    return document
+
+# Ledger group commit
+class LedgerOutcomeUnknown(HTTPException):
+    """A ledger insert failed and whether its row landed could not be checked. It is an
+    HTTPException so run_idempotent keeps the key instead of letting a retry write twice"""
+
+    def __init__(self):
+        super().__init__(status_code=503, detail="Could not confirm the points were recorded; check your transactions before retrying")
+
+class LedgerWriteCoalescer:
+    """Collects ledger rows with their user increments and commits them in batches"""
+
+    def __init__(self):
+        self.batch: List[Any] = []
+        self.flush_handle = None
+        self.flushes = set()
+
+    async def submit(self, document: Dict[str, Any], increments: Dict[str, Dict[str, int]], lot: Optional[Dict[str, Any]] = None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.batch.append((document, increments, lot, future))
+        if len(self.batch) >= LEDGER_BATCH_MAX_OPS:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(LEDGER_BATCH_WINDOW_SECONDS, self.flush)
+        # A cancelled caller must not cancel the shared write
+        await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.batch = self.batch, []
+        if batch:
+            task = asyncio.ensure_future(self.write(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def drain(self):
+        self.flush()
+        await asyncio.gather(*self.flushes, return_exceptions=True)
+
+    async def write(self, batch: List[Any]):
+        failed: Dict[int, Exception] = {}
+        documents = [document for document, _, _, _ in batch]
+        try:
+            await db.point_transactions.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                failed[error["index"]] = OperationFailure(error.get("errmsg"), error.get("code"), error)
+        except Exception as e:
+            # The insert may have landed before the error surfaced; only rows that are missing failed
+            persisted = await persisted_ledger_ids([document["id"] for document in documents])
+            for index, document in enumerate(documents):
+                if persisted is None:
+                    failed[index] = LedgerOutcomeUnknown()
+                elif document["id"] not in persisted:
+                    failed[index] = e
+        
+        # A persisted ledger row is the record of the change, so its caller succeeds even if
+        # the lot or balance update after it fails; reconciliation repairs those from the ledger
+        written = [index for index in range(len(batch)) if index not in failed]
+        try:
+            lots = [batch[index][2] for index in written if batch[index][2]]
+            if lots:
+                try:
+                    await db.point_lots.insert_many(lots, ordered=False)
+                except BulkWriteError as e:
+                    logger.error("Ledger lot insert left %d lots unwritten: %s", len(e.details["writeErrors"]), e.details["writeErrors"][:5])
+            
+            # One $inc per user covers every written row in the batch
+            merged: Dict[str, Dict[str, int]] = {}
+            for index in written:
+                for user_id, fields in batch[index][1].items():
+                    totals = merged.setdefault(user_id, {})
+                    for field, delta in fields.items():
+                        totals[field] = totals.get(field, 0) + delta
+            if merged:
+                try:
+                    await db.users.bulk_write(
+                        [UpdateOne({"id": user_id}, {"$inc": fields}) for user_id, fields in merged.items()],
+                        ordered=False
+                    )
+                except BulkWriteError as e:
+                    logger.error("Ledger balance update left %d users unchanged: %s", len(e.details["writeErrors"]), e.details["writeErrors"][:5])
+        except Exception:
+            logger.exception("Ledger lot or balance update failed after %d rows were written", len(written))
+        
+        for index, (_, _, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+ledger_writer = LedgerWriteCoalescer()
+
+async def write_ledger(transaction: PointTransaction, increments: Dict[str, Dict[str, int]]):
+    """Insert a ledger row, its expiry lot if it is a credit, and its user $inc updates,
+    e.g. {user_id: {"point_balance": 5}}"""
+    document = encode_ledger_document(transaction.model_dump())
+    lot = make_point_lot(transaction)
+    if LEDGER_BATCH_ENABLED:
+        await ledger_writer.submit(document, increments, lot)
+        return
+    
+    try:
+        await db.point_transactions.insert_one(document)
+    except Exception:
+        persisted = await persisted_ledger_ids([document["id"]])
+        if persisted is None:
+            raise LedgerOutcomeUnknown()
+        if not persisted:
+            raise
+    try:
+        if lot:
+            await db.point_lots.insert_one(lot)
+        for user_id, fields in increments.items():
+            await db.users.update_one({"id": user_id}, {"$inc": fields})
+    except Exception:
+        logger.exception("Ledger lot or balance update failed after row %s was written", transaction.id)
+
+async def persisted_ledger_ids(ids: List[Any]) -> Optional[Set[Any]]:
+    """The ids among ids already in point_transactions, or None when that cannot be read"""
+    try:
+        return {row["id"] async for row in db.point_transactions.find({"id": {"$in": ids}}, {"_id": 0, "id": 1})}
+    except Exception:
+        logger.exception("Could not check which of %d ledger rows were written", len(ids))
+        return None
+
+# Ledger partitioning
+# point_transactions holds the last LEDGER_HOT_MONTHS months; older rows live in
+# one point_transactions_archive_<year> collection per year
+archive_names_cache = {"names": [], "expires_at": datetime.min}
+archive_indexes_created = set()
+
+def ledger_hot_cutoff(now: Optional[datetime] = None) -> datetime:
+    """Start of the hot window, LEDGER_HOT_MONTHS calendar months back"""
+    now = now or datetime.utcnow()
+    month_index = now.year * 12 + now.month - 1 - LEDGER_HOT_MONTHS
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+async def ledger_archive_names() -> List[str]:
+    """Archive collection names, newest year first"""
+    if archive_names_cache["expires_at"] < datetime.utcnow():
+        names = await db.list_collection_names(filter={"name": {"$regex": f"^{LEDGER_ARCHIVE_PREFIX}"}})
+        archive_names_cache["names"] = sorted(names, reverse=True)
+        archive_names_cache["expires_at"] = datetime.utcnow() + timedelta(seconds=60)
+    return archive_names_cache["names"]
+
+def archive_year(name: str) -> int:
+    return int(name[len(LEDGER_ARCHIVE_PREFIX):])
+
+async def find_ledger(
+    query: Dict[str, Any],
+    limit: int = 100,
+    since: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    history: bool = False
+):
+    """Newest-first ledger rows from since up to before. Archives, newest year first, fill
+    what the hot ledger leaves of limit only when the caller reaches past the hot window:
+    a since or before older than it, or history=True. Dashboards and profiles stay on the
+    hot ledger and page into history with ledger_page_cursor"""
+    if before:
+        query = {"$and": [query, {"created_at": {"$lt": before}}]}
+    if since:
+        query = {"$and": [query, {"created_at": {"$gte": since}}]}
+    query = encode_ledger_query(query)
+    cutoff = ledger_hot_cutoff()
+    transactions = []
+    if not before or before > cutoff:
+        transactions = await db.point_transactions.find(query).sort("created_at", -1).to_list(limit)
+        transactions = [decode_ledger_document(transaction) for transaction in transactions]
+    reaches_history = history or (since and since < cutoff) or (before and before <= cutoff)
+    if len(transactions) >= limit or not reaches_history:
+        return transactions
+
+    seen_ids = {transaction["id"] for transaction in transactions}
+    for name in await ledger_archive_names():
+        if since and archive_year(name) < since.year:
+            break
+        if before and archive_year(name) > before.year:
+            continue
+        needed = limit - len(transactions)
+        for transaction in await db[name].find(query).sort("created_at", -1).to_list(needed):
+            decode_ledger_document(transaction)
+            # Rows being moved can briefly exist in both collections
+            if transaction["id"] not in seen_ids:
+                seen_ids.add(transaction["id"])
+                transactions.append(transaction)
+        if len(transactions) >= limit:
+            break
+
+    transactions.sort(key=lambda t: t["created_at"], reverse=True)
+    return transactions[:limit]
+
+async def ledger_page_cursor(transactions: List[Dict[str, Any]], limit: int, before: Optional[datetime] = None) -> Optional[datetime]:
+    """before value for the page after a find_ledger page, or None when there is none.
+    A short page of the hot ledger continues at the hot window's start if archives exist"""
+    if len(transactions) >= limit:
+        return transactions[-1]["created_at"]
+    cutoff = ledger_hot_cutoff()
+    if (not before or before > cutoff) and await ledger_archive_names():
+        return cutoff
+    return None
+
+async def find_one_ledger(query: Dict[str, Any], since: Optional[datetime] = None):
+    """First ledger row matching query from since on, falling back to archives no older than since"""
+    if since:
+        query = {"$and": [query, {"created_at": {"$gte": since}}]}
+    query = encode_ledger_query(query)
+    transaction = await db.point_transactions.find_one(query)
+    if transaction or (since and since >= ledger_hot_cutoff()):
+        return decode_ledger_document(transaction)
+
+    for name in await ledger_archive_names():
+        if since and archive_year(name) < since.year:
+            break
+        transaction = await db[name].find_one(query)
+        if transaction:
+            return decode_ledger_document(transaction)
+    return None
+
+async def aggregate_ledger(
+    match: Dict[str, Any],
+    pipeline: List[Dict[str, Any]],
+    read_preference=ReadPreference.PRIMARY,
+    since: Optional[datetime] = None
+):
+    """Run match + pipeline over the hot ledger unioned with every archive no older than since"""
+    ledger = db.point_transactions.with_options(read_preference=read_preference)
+    match = encode_ledger_query(match)
+    stages = [{"$match": match}]
+    for name in await ledger_archive_names():
+        if since and archive_year(name) < since.year:
+            break
+        stages.append({"$unionWith": {"coll": name, "pipeline": [{"$match": match}]}})
+    return ledger.aggregate(stages + pipeline, allowDiskUse=True)
+
+async def ensure_archive_indexes(name: str):
+    if name in archive_indexes_created:
+        return
+    await db[name].create_index("id", unique=True)
+    await db[name].create_index([("to_user_id", 1), ("created_at", -1)])
+    await db[name].create_index([("from_user_id", 1), ("created_at", -1)])
+    archive_indexes_created.add(name)
+
+async def archive_point_transactions():
+    """Move ledger rows older than the hot window into yearly archives in batches"""
+    cutoff = ledger_hot_cutoff()
+    moved = 0
+    started = datetime.utcnow()
+
+    while True:
+        batch = await db.point_transactions.find(
+            {"created_at": {"$lt": cutoff}}
+        ).sort("created_at", 1).limit(LEDGER_ARCHIVE_BATCH_SIZE).to_list(LEDGER_ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+
+        by_year = {}
+        for transaction in batch:
+            by_year.setdefault(transaction["created_at"].year, []).append(transaction)
+
+        for year, transactions in by_year.items():
+            name = f"{LEDGER_ARCHIVE_PREFIX}{year}"
+            await ensure_archive_indexes(name)
+            try:
+                await db[name].insert_many(transactions, ordered=False)
+            except BulkWriteError as e:
+                # Rows copied by an interrupted earlier pass are already archived
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+
+        # Delete only after every row is safely in its archive
+        await db.point_transactions.delete_many({"_id": {"$in": [t["_id"] for t in batch]}})
+        moved += len(batch)
+        archive_names_cache["expires_at"] = datetime.min
+
+        if not await acquire_leader_lock("ledger_archival"):
+            logger.warning("Lost ledger archival lock, stopping")
+            break
+        await asyncio.sleep(0.01)
+
+    if moved:
+        elapsed = max((datetime.utcnow() - started).total_seconds(), 1e-6)
+        logger.info(f"Archived {moved} point transactions older than {cutoff:%Y-%m-%d} ({moved / elapsed:.0f} rows/s)")
+
+SCHEDULED_JOBS.append(("ledger_archival", LEDGER_ARCHIVE_INTERVAL_SECONDS, archive_point_transactions))
+
+# Ledger reconciliation
+async def ledger_totals(users: List[Dict[str, Any]], read_preference=ReadPreference.PRIMARY):
+    """Sum points received and cap spent per user straight from the point ledger"""
+    user_ids = [user["id"] for user in users]
+
+    received = {}
+    async for row in await aggregate_ledger(
+        {"to_user_id": {"$in": user_ids}},
+        [{"$group": {"_id": "$to_user_id", "total": {"$sum": "$amount"}}}],
+        read_preference
+    ):
+        # In dual storage one user can appear under both id forms
+        user_id = decode_ledger_id(row["_id"])
+        received[user_id] = received.get(user_id, 0) + row["total"]
+
+    # Caps are only spent by manager awards made since the last renewal
+    never_renewed = [user["id"] for user in users if not user.get("point_cap_renewed_at")]
+    spent_filters = [{"from_user_id": {"$in": never_renewed}}] if never_renewed else []
+    spent_filters += [
+        {"from_user_id": user["id"], "created_at": {"$gte": user["point_cap_renewed_at"]}}
+        for user in users if user.get("point_cap_renewed_at")
+    ]
+    spent = {}
+    if spent_filters:
+        async for row in await aggregate_ledger(
+            {"transaction_type": "manager_award", "$or": spent_filters},
+            [{"$group": {"_id": "$from_user_id", "total": {"$sum": "$amount"}}}],
+            read_preference
+        ):
+            # In dual storage one user can appear under both id forms
+            user_id = decode_ledger_id(row["_id"])
+            spent[user_id] = spent.get(user_id, 0) + row["total"]
+
+    # Spending counts down from whatever cap the current renewal granted
+    renewals = await latest_by_user(
+        db.point_cap_renewals.with_options(read_preference=read_preference), user_ids, "renewed_at", datetime.utcnow(), True
+    )
+    granted = {}
+    for user in users:
+        renewal = renewals.get(user["id"])
+        # Renewals from before the history existed granted the default
+        if renewal and renewal["renewed_at"] == user.get("point_cap_renewed_at"):
+            granted[user["id"]] = renewal["point_cap"]
+        else:
+            granted[user["id"]] = DEFAULT_POINT_CAP
+
+    return received, spent, granted
+
+async def lot_totals(user_ids: List[str], read_preference=ReadPreference.PRIMARY) -> Dict[str, int]:
+    """Points each user holds in lots: unspent remainders plus expiries claimed but not yet debited"""
+    totals = {}
+    point_lots = db.point_lots.with_options(read_preference=read_preference)
+    async for row in point_lots.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}, "$or": [{"remaining": {"$gt": 0}}, {"expiry_recorded": False}]}},
+        {"$group": {"_id": "$user_id", "total": {"$sum": {"$add": [
+            "$remaining",
+            {"$cond": [{"$eq": ["$expiry_recorded", False]}, {"$ifNull": ["$expired_amount", 0]}, 0]}
+        ]}}}}
+    ]):
+        totals[row["_id"]] = row["total"]
+    return totals
+
+def find_drift(
+    users: List[Dict[str, Any]],
+    received: Dict[str, int],
+    spent: Dict[str, int],
+    granted: Dict[str, int],
+    lots: Dict[str, int]
+):
+    drift = []
+    for user in users:
+        expected_balance = received.get(user["id"], 0)
+        expected_cap = granted.get(user["id"], DEFAULT_POINT_CAP) - spent.get(user["id"], 0)
+        if (
+            user.get("point_balance", 0) != expected_balance
+            or user.get("point_cap", DEFAULT_POINT_CAP) != expected_cap
+            or lots.get(user["id"], 0) != expected_balance
+        ):
+            drift.append({
+                "user_id": user["id"],
+                "company_id": user.get("company_id"),
+                "point_balance": user.get("point_balance", 0),
+                "expected_point_balance": expected_balance,
+                "point_lots": lots.get(user["id"], 0),
+                "point_cap": user.get("point_cap", DEFAULT_POINT_CAP),
+                "expected_point_cap": expected_cap
+            })
+    return drift
+
+async def repair_point_lots(row: Dict[str, Any], report_id: str):
+    """Bring a drifted user's lots in line with the ledger balance: a corrective lot
+    for points the lots are missing, or a draw for points they hold beyond it"""
+    shortfall = row["expected_point_balance"] - row["point_lots"]
+    if shortfall > 0:
+        lot = make_point_lot(PointTransaction(
+            id=f"reconcile:{report_id}:{row['user_id']}", from_user_id=row["user_id"], to_user_id=row["user_id"],
+            amount=shortfall, reason="Reconciled point lot", company_id=row.get("company_id") or ""
+        ))
+        lot["transaction_id"] = None
+        await db.point_lots.insert_one(lot)
+    elif shortfall < 0:
+        await consume_point_lots(row["user_id"], -shortfall)
+
+async def reconcile_balances(company_id: Optional[str] = None, repair: bool = False, report_id: Optional[str] = None):
+    """Compare stored balances, caps and lots with the ledger in batches and optionally repair drift"""
+    report_id = report_id or str(uuid.uuid4())
+    report = {
+        "id": report_id,
+        "company_id": company_id,
+        "repair": repair,
+        "status": "running",
+        "started_at": datetime.utcnow(),
+        "users_checked": 0,
+        "users_drifted": 0,
+        "users_repaired": 0,
+        "balance_drift_total": 0,
+        "cap_drift_total": 0,
+        "lot_drift_total": 0,
+        "drift": []
+    }
+    await db.reconciliation_reports.replace_one({"id": report_id}, report, upsert=True)
+
+    user_filter = {"company_id": company_id} if company_id else {}
+    projection = {"_id": 0, "id": 1, "company_id": 1, "point_balance": 1, "point_cap": 1, "point_cap_renewed_at": 1}
+    # The scan reads from secondaries when available to stay off the primary
+    scan_users = db.users.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+    last_user_id = ""
+
+    try:
+        while True:
+            users = await scan_users.find(
+                {**user_filter, "id": {"$gt": last_user_id}}, projection
+            ).sort("id", 1).limit(RECONCILIATION_BATCH_SIZE).to_list(RECONCILIATION_BATCH_SIZE)
+            if not users:
+                break
+            last_user_id = users[-1]["id"]
+            report["users_checked"] += len(users)
+
+            received, spent, granted = await ledger_totals(users, ReadPreference.SECONDARY_PREFERRED)
+            lots = await lot_totals([user["id"] for user in users], ReadPreference.SECONDARY_PREFERRED)
+            suspects = find_drift(users, received, spent, granted, lots)
+
+            if suspects:
+                # Re-check on the primary after in-flight awards have settled so
+                # a ledger insert racing its $inc is not reported as drift
+                await asyncio.sleep(RECONCILIATION_SETTLE_SECONDS)
+                rechecked = await db.users.find(
+                    {"id": {"$in": [row["user_id"] for row in suspects]}}, projection
+                ).to_list(None)
+                received, spent, granted = await ledger_totals(rechecked)
+                lots = await lot_totals([user["id"] for user in rechecked])
+                confirmed = find_drift(rechecked, received, spent, granted, lots)
+
+                report["users_drifted"] += len(confirmed)
+                for row in confirmed:
+                    report["balance_drift_total"] += row["point_balance"] - row["expected_point_balance"]
+                    report["cap_drift_total"] += row["point_cap"] - row["expected_point_cap"]
+                    report["lot_drift_total"] += row["point_lots"] - row["expected_point_balance"]
+                room = RECONCILIATION_REPORT_LIMIT - len(report["drift"])
+                report["drift"].extend(confirmed[:max(room, 0)])
+
+                if repair and confirmed:
+                    repaired = []
+                    for row in confirmed:
+                        # Only overwrite values that have not moved since they were read; a
+                        # bulk write cannot tell which of its updates matched, so each is its own
+                        result = await db.users.update_one(
+                            {"id": row["user_id"], "point_balance": row["point_balance"], "point_cap": row["point_cap"]},
+                            {"$set": {
+                                "point_balance": row["expected_point_balance"],
+                                "point_cap": row["expected_point_cap"]
+                            }}
+                        )
+                        if not result.matched_count:
+                            continue
+                        # Lots are what spends and expiries draw on, so they move with the
+                        # balance, and only when the balance itself was set
+                        if row["point_lots"] != row["expected_point_balance"]:
+                            await repair_point_lots(row, report_id)
+                        report["users_repaired"] += result.modified_count
+                        repaired.append(row["user_id"])
+                    await bump_versions(*(f"profile:{user_id}" for user_id in repaired))
+
+            await db.reconciliation_reports.update_one({"id": report_id}, {"$set": report})
+            await asyncio.sleep(RECONCILIATION_PAUSE_SECONDS)
+
+        report["status"] = "completed"
+    except Exception as e:
+        report["status"] = "failed"
+        report["error"] = str(e)
+        raise
+    finally:
+        report["finished_at"] = datetime.utcnow()
+        await db.reconciliation_reports.update_one({"id": report_id}, {"$set": report})
+        logger.info(
+            f"Reconciliation {report_id} {report['status']}: {report['users_checked']} users checked, "
+            f"{report['users_drifted']} drifted, {report['users_repaired']} repaired"
+        )
+
+    return report
+
+# Balance snapshots
+# Monthly per-user snapshots let point-in-time questions replay only the
+# ledger rows between the nearest snapshot and the requested date
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+async def latest_by_user(collection, user_ids: List[str], time_field: str, before: datetime, inclusive: bool = False):
+    """Newest document per user with time_field before (or at) the given moment"""
+    bound = "$lte" if inclusive else "$lt"
+    latest = {}
+    async for row in collection.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}, time_field: {bound: before}}},
+        {"$sort": {"user_id": 1, time_field: -1}},
+        {"$group": {"_id": "$user_id", "doc": {"$first": "$$ROOT"}}}
+    ]):
+        latest[row["_id"]] = row["doc"]
+    return latest
+
+async def ledger_sums_since(field: str, lower_bounds: Dict[str, Optional[datetime]], until: datetime, extra: Dict[str, Any] = None):
+    """Sum amounts per user over [lower bound, until), one $group over index ranges"""
+    unbounded = [user_id for user_id, lower in lower_bounds.items() if lower is None]
+    filters = [{field: {"$in": unbounded}, "created_at": {"$lt": until}}] if unbounded else []
+    filters += [
+        {field: user_id, "created_at": {"$gte": lower, "$lt": until}}
+        for user_id, lower in lower_bounds.items() if lower is not None
+    ]
+    if not filters:
+        return {}
+
+    since = None if unbounded else min(lower_bounds.values())
+    totals = {}
+    async for row in await aggregate_ledger(
+        {**(extra or {}), "$or": filters},
+        [{"$group": {"_id": f"${field}", "total": {"$sum": "$amount"}}}],
+        since=since
+    ):
+        user_id = decode_ledger_id(row["_id"])
+        totals[user_id] = totals.get(user_id, 0) + row["total"]
+    return totals
+
+async def balances_as_of(users: List[Dict[str, Any]], moment: datetime, snapshot_inclusive: bool = True):
+    """Point balance and remaining cap of each user at moment, from the nearest earlier snapshot"""
+    user_ids = [user["id"] for user in users]
+    snapshots = await latest_by_user(db.balance_snapshots, user_ids, "as_of", moment, snapshot_inclusive)
+    renewals = await latest_by_user(db.point_cap_renewals, user_ids, "renewed_at", moment)
+
+    balance_bounds, cap_bounds, results = {}, {}, {}
+    for user in users:
+        snapshot = snapshots.get(user["id"])
+        renewal = renewals.get(user["id"])
+        # Renewals from before the history existed are only known from the user document
+        renewed_at = user.get("point_cap_renewed_at")
+        if renewed_at and renewed_at < moment and (not renewal or renewed_at > renewal["renewed_at"]):
+            renewal = {"renewed_at": renewed_at, "point_cap": DEFAULT_POINT_CAP}
+
+        balance_bounds[user["id"]] = snapshot["as_of"] if snapshot else None
+        if renewal and (not snapshot or renewal["renewed_at"] > snapshot["as_of"]):
+            cap_bounds[user["id"]] = renewal["renewed_at"]
+            cap_base = renewal["point_cap"]
+        elif snapshot:
+            cap_bounds[user["id"]] = snapshot["as_of"]
+            cap_base = snapshot["point_cap"]
+        else:
+            cap_bounds[user["id"]] = None
+            cap_base = DEFAULT_POINT_CAP
+
+        results[user["id"]] = {
+            "point_balance": snapshot["point_balance"] if snapshot else 0,
+            "point_cap": cap_base,
+            "snapshot_as_of": snapshot["as_of"] if snapshot else None
+        }
+
+    received = await ledger_sums_since("to_user_id", balance_bounds, moment)
+    spent = await ledger_sums_since("from_user_id", cap_bounds, moment, {"transaction_type": "manager_award"})
+    for user_id, result in results.items():
+        result["point_balance"] += received.get(user_id, 0)
+        result["point_cap"] -= spent.get(user_id, 0)
+    return results
+
+async def take_balance_snapshots():
+    """Snapshot every user's balance and cap as of the start of the current month"""
+    as_of = month_start(datetime.utcnow())
+    run_id = f"balance_snapshots:{as_of:%Y-%m}"
+
+    run = await db.scheduler_runs.find_one({"_id": run_id})
+    if run and run.get("status") == "completed":
+        return
+    if not run:
+        run = {"_id": run_id, "job": "balance_snapshots", "status": "running", "checkpoint": "", "users_snapshotted": 0, "started_at": datetime.utcnow()}
+        await db.scheduler_runs.insert_one(run)
+
+    last_user_id = run["checkpoint"]
+    snapshotted = run.get("users_snapshotted", 0)
+    started = time.monotonic()
+
+    while True:
+        users = await db.users.find(
+            {"id": {"$gt": last_user_id}}, {"_id": 0, "id": 1, "point_cap_renewed_at": 1}
+        ).sort("id", 1).limit(BALANCE_SNAPSHOT_BATCH_SIZE).to_list(BALANCE_SNAPSHOT_BATCH_SIZE)
+        if not users:
+            break
+
+        # Build on the previous month's snapshots, never on this month's partial run
+        balances = await balances_as_of(users, as_of, snapshot_inclusive=False)
+        await db.balance_snapshots.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "as_of": as_of},
+                {"$setOnInsert": {**balance, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+            for user_id, balance in balances.items()
+        ], ordered=False)
+
+        last_user_id = users[-1]["id"]
+        snapshotted += len(users)
+        await db.scheduler_runs.update_one(
+            {"_id": run_id},
+            {"$set": {"checkpoint": last_user_id, "users_snapshotted": snapshotted}}
+        )
+        if not await acquire_leader_lock("balance_snapshots"):
+            logger.warning("Lost balance snapshot lock, stopping")
+            return
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    await db.scheduler_runs.update_one(
+        {"_id": run_id},
+        {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "users_snapshotted": snapshotted}}
+    )
+    logger.info(f"Snapshotted balances of {snapshotted} users as of {as_of:%Y-%m-%d} in {elapsed:.1f}s")
+
+SCHEDULED_JOBS.append(("balance_snapshots", BALANCE_SNAPSHOT_INTERVAL_SECONDS, take_balance_snapshots))
+
+# Point expiry
+# Every credit becomes a lot in point_lots that expires POINT_EXPIRY_MONTHS after
+# it was awarded. Spending draws on lots soonest-expiry first, while
+# point_balance stays the O(1) read and equals the sum of remaining lots
+POINT_EXPIRY_NAMESPACE = uuid.UUID("5b0c3c3e-8f0e-4d7a-9a57-2f4c1f7d6e10")
+
+def add_months(moment: datetime, months: int) -> datetime:
+    month_index = moment.month - 1 + months
+    year, month = moment.year + month_index // 12, month_index % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+def make_point_lot(transaction: PointTransaction) -> Optional[Dict[str, Any]]:
+    """Lot for a credit, or None for rows that do not add spendable points"""
+    if transaction.amount <= 0 or transaction.transaction_type not in POINT_LOT_TRANSACTION_TYPES:
+        return None
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": transaction.to_user_id,
+        "company_id": transaction.company_id,
+        "transaction_id": transaction.id,
+        "amount": transaction.amount,
+        "remaining": transaction.amount,
+        "awarded_at": transaction.created_at,
+        "expires_at": add_months(transaction.created_at, POINT_EXPIRY_MONTHS),
+        "expired_at": None
+    }
+
+async def consume_point_lots(user_id: str, amount: int):
+    """Draw amount from the user's unexpired lots, soonest expiry first.
+    Returns the part no lot covered and the (lot id, amount) draws made"""
+    draws = []
+    while amount > 0:
+        lots = await db.point_lots.find(
+            {"user_id": user_id, "remaining": {"$gt": 0}, "expires_at": {"$gt": datetime.utcnow()}},
+            {"_id": 0, "id": 1, "remaining": 1}
+        ).sort("expires_at", 1).limit(POINT_EXPIRY_BATCH_SIZE).to_list(POINT_EXPIRY_BATCH_SIZE)
+        if not lots:
+            break
+        for lot in lots:
+            take = min(amount, lot["remaining"])
+            # Conditional, so concurrent spends and the expiry sweep never draw the same points twice
+            result = await db.point_lots.update_one(
+                {"id": lot["id"], "remaining": {"$gte": take}}, {"$inc": {"remaining": -take}}
+            )
+            if result.modified_count:
+                amount -= take
+                draws.append((lot["id"], take))
+            if amount == 0:
+                break
+    return amount, draws
+
+async def restore_point_lots(user_id: str, draws: List[Any]):
+    """Put back draws of a spend that did not go through"""
+    for lot_id, take in draws:
+        result = await db.point_lots.update_one({"id": lot_id, "expired_at": None}, {"$inc": {"remaining": take}})
+        if result.modified_count == 0:
+            # The sweep expired the lot in between without these points, so they go into a
+            # corrective lot with the same expiry, which the next sweep expires and debits
+            lot = await db.point_lots.find_one({"id": lot_id}, {"_id": 0})
+            await db.point_lots.insert_one({
+                **{key: lot[key] for key in ("user_id", "company_id", "awarded_at", "expires_at")},
+                "id": str(uuid.uuid4()),
+                "transaction_id": None,
+                "amount": take,
+                "remaining": take,
+                "expired_at": None
+            })
+            logger.info(f"Restored {take} points of expired lot {lot_id} of user {user_id} as a corrective lot")
+
+async def record_lot_expiries() -> int:
+    """Write the expiry ledger rows and balance debits of claimed lots.
+    Each debit is an $inc that also adds the lot to the user's pending_expiries in
+    the same update, conditional on it not being there yet, so a rerun after a
+    crash at any point debits every lot exactly once"""
+    recorded = 0
+    while True:
+        lots = await db.point_lots.find({"expiry_recorded": False}, {"_id": 0}).limit(POINT_EXPIRY_BATCH_SIZE).to_list(POINT_EXPIRY_BATCH_SIZE)
+        if not lots:
+            return recorded
+        
+        rows = [
+            encode_ledger_document(PointTransaction(
+                # Derived from the lot, so a rerun after a crash collides with rows it already wrote
+                id=str(uuid.uuid5(POINT_EXPIRY_NAMESPACE, lot["id"])),
+                from_user_id=lot["user_id"],
+                to_user_id=lot["user_id"],
+                amount=-lot["expired_amount"],
+                reason=f"Points expired (awarded {lot['awarded_at']:%Y-%m-%d})",
+                company_id=lot["company_id"],
+                transaction_type="expiry",
+                created_at=lot["expired_at"]
+            ).model_dump())
+            for lot in lots
+        ]
+        try:
+            await db.point_transactions.insert_many(rows, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        
+        to_debit = [lot for lot in lots if not lot.get("debited")]
+        if to_debit:
+            await db.users.bulk_write([
+                UpdateOne(
+                    {"id": lot["user_id"], "pending_expiries": {"$ne": lot["id"]}},
+                    {"$inc": {"point_balance": -lot["expired_amount"]}, "$addToSet": {"pending_expiries": lot["id"]}}
+                )
+                for lot in to_debit
+            ], ordered=False)
+            await db.point_lots.update_many(
+                {"id": {"$in": [lot["id"] for lot in to_debit]}}, {"$set": {"debited": True}}
+            )
+        
+        # The markers are only needed until the lot itself says debited
+        by_user: Dict[str, List[str]] = {}
+        for lot in lots:
+            by_user.setdefault(lot["user_id"], []).append(lot["id"])
+        await db.users.bulk_write([
+            UpdateOne({"id": user_id}, {"$pull": {"pending_expiries": {"$in": lot_ids}}})
+            for user_id, lot_ids in by_user.items()
+        ], ordered=False)
+        await db.point_lots.update_many(
+            {"id": {"$in": [lot["id"] for lot in lots]}}, {"$set": {"expiry_recorded": True}}
+        )
+        if to_debit:
+            await bump_versions(*{f"profile:{lot['user_id']}" for lot in to_debit})
+        recorded += len(to_debit)
+
+async def expire_point_lots():
+    """Expire lots past their expiry date in batches, once per day"""
+    now = datetime.utcnow()
+    run_id = f"point_expiry:{now:%Y-%m-%d}"
+    
+    run = await db.scheduler_runs.find_one({"_id": run_id})
+    if run and run.get("status") == "completed":
+        return
+    if not run:
+        await db.scheduler_runs.insert_one({"_id": run_id, "job": "point_expiry", "status": "running", "started_at": now})
+    
+    # Rows claimed by an interrupted run come first
+    expired = await record_lot_expiries()
+    started = time.monotonic()
+    
+    while True:
+        lots = await db.point_lots.find(
+            {"remaining": {"$gt": 0}, "expires_at": {"$lte": now}}, {"_id": 0, "id": 1, "remaining": 1}
+        ).sort("expires_at", 1).limit(POINT_EXPIRY_BATCH_SIZE).to_list(POINT_EXPIRY_BATCH_SIZE)
+        if not lots:
+            break
+        
+        # Claim each lot only if nothing was drawn from it since it was read;
+        # lots that lost the race are picked up again by the next read
+        await db.point_lots.bulk_write([
+            UpdateOne(
+                {"id": lot["id"], "remaining": lot["remaining"]},
+                {"$set": {"remaining": 0, "expired_amount": lot["remaining"], "expired_at": now, "expiry_recorded": False}}
+            )
+            for lot in lots
+        ], ordered=False)
+        expired += await record_lot_expiries()
+        
+        if not await acquire_leader_lock("point_expiry"):
+            logger.warning("Lost point expiry lock, stopping")
+            return
+    
+    elapsed = max(time.monotonic() - started, 1e-6)
+    await db.scheduler_runs.update_one(
+        {"_id": run_id},
+        {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "lots_expired": expired}}
+    )
+    logger.info(f"Expired {expired} point lots in {elapsed:.1f}s")
+
+SCHEDULED_JOBS.append(("point_expiry", POINT_EXPIRY_INTERVAL_SECONDS, expire_point_lots))
+
+# Notification digests
+# Recognition and badge events are folded into one digest_buckets document per
+# user and DIGEST_BUCKET_HOURS window; once a window closes the digest job
+# renders every closed bucket in batches and mails them over pooled SMTP connections
+def digest_bucket_start(moment: datetime) -> datetime:
+    bucket_seconds = DIGEST_BUCKET_HOURS * 3600
+    epoch = calendar.timegm(moment.timetuple())
+    return datetime.utcfromtimestamp(epoch - epoch % bucket_seconds)
+
+async def add_to_digest(user_id: str, company_id: Optional[str], event: Dict[str, Any], points: int = 0):
+    """Fold an event into the user's open digest bucket with one upsert"""
+    if not DIGESTS_ENABLED:
+        return
+    now = datetime.utcnow()
+    bucket_start = digest_bucket_start(now)
+    await db.digest_buckets.update_one(
+        {"_id": f"{user_id}:{bucket_start:%Y%m%d%H}"},
+        {
+            "$setOnInsert": {
+                "user_id": user_id,
+                "company_id": company_id,
+                "bucket_start": bucket_start,
+                "bucket_end": bucket_start + timedelta(hours=DIGEST_BUCKET_HOURS),
+                "status": "pending",
+                "attempts": 0
+            },
+            # Only the first events are listed; the counters cover all of them
+            "$push": {"events": {"$each": [{**event, "at": now}], "$slice": DIGEST_MAX_EVENTS}},
+            "$inc": {"event_count": 1, f"counts.{event['kind']}": 1, "points": points}
+        },
+        upsert=True
+    )
+
+def render_digest(user: Dict[str, Any], bucket: Dict[str, Any]) -> EmailMessage:
+    counts = bucket.get("counts", {})
+    recognitions, badges = counts.get("recognition", 0), counts.get("badge", 0)
+    summary = []
+    if recognitions:
+        summary.append(f"{recognitions} recognition{'s' if recognitions != 1 else ''} worth {bucket.get('points', 0)} points")
+    if badges:
+        summary.append(f"{badges} new badge{'s' if badges != 1 else ''}")
+    
+    lines = [f"Hi {user['name']},", "", f"Since {bucket['bucket_start']:%b %d %H:%M} UTC you received {' and '.join(summary)}.", ""]
+    for event in bucket.get("events", []):
+        if event["kind"] == "recognition":
+            lines.append(f"  +{event['amount']} from {event['from_name']}: {event['reason']}")
+        elif event["kind"] == "badge":
+            lines.append(f"  Badge earned: {event['badge_name']}")
+    hidden = bucket.get("event_count", 0) - len(bucket.get("events", []))
+    if hidden > 0:
+        lines.append(f"  ...and {hidden} more")
+    lines += ["", f"Your balance is waiting in {DIGEST_APP_URL}"]
+    
+    message = EmailMessage()
+    message["From"] = DIGEST_FROM_ADDRESS
+    message["To"] = user["email"]
+    message["Subject"] = f"Your recognition digest: {', '.join(summary)}"
+    message.set_content("\n".join(lines))
+    return message
+
+class SMTPPool:
+    """Up to size long-lived SMTP connections; smtplib blocks, so batches are sent in threads"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.idle: List[smtplib.SMTP] = []
+        self.slots = asyncio.Semaphore(size)
+        self.opened = 0
+
+    def connect(self) -> smtplib.SMTP:
+        connection = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+        if SMTP_STARTTLS:
+            connection.starttls()
+        if SMTP_USERNAME:
+            connection.login(SMTP_USERNAME, SMTP_PASSWORD)
+        self.opened += 1
+        return connection
+
+    @staticmethod
+    def discard(connection: Optional[smtplib.SMTP]):
+        if connection is None:
+            return
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def send_batch(self, connection: Optional[smtplib.SMTP], messages: List[Any]):
+        """Send (index, message) pairs over one connection; returns it and the errors by index"""
+        errors = {}
+        for index, message in messages:
+            for attempt in range(2):
+                try:
+                    if connection is None:
+                        connection = self.connect()
+                    connection.send_message(message)
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                    # Refused by the server; the connection is still usable
+                    errors[index] = f"{type(e).__name__}: {e}"
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    # Dropped connection, e.g. an idle one the server timed out: retry once on a new one
+                    self.discard(connection)
+                    connection = None
+                    if attempt:
+                        errors[index] = f"{type(e).__name__}: {e}"
+        return connection, errors
+
+    async def send(self, messages: List[EmailMessage]) -> Dict[int, str]:
+        """Send messages split across the pool's connections; returns the failures by position"""
+        chunk_size = max(1, math.ceil(len(messages) / self.size))
+        indexed = list(enumerate(messages))
+        
+        async def send_chunk(chunk):
+            async with self.slots:
+                connection = self.idle.pop() if self.idle else None
+                connection, errors = await asyncio.to_thread(self.send_batch, connection, chunk)
+                if connection is not None:
+                    self.idle.append(connection)
+                return errors
+        
+        errors = {}
+        for chunk_errors in await asyncio.gather(*(
+            send_chunk(indexed[start:start + chunk_size]) for start in range(0, len(indexed), chunk_size)
+        )):
+            errors.update(chunk_errors)
+        return errors
+
+    def close(self):
+        while self.idle:
+            self.discard(self.idle.pop())
+
+smtp_pool = SMTPPool(SMTP_POOL_SIZE)
+
+async def send_digests():
+    """Mail every closed digest bucket, a batch at a time"""
+    now = datetime.utcnow()
+    started = time.monotonic()
+    sent = failed = 0
+    last_id = ""
+    
+    while True:
+        # Paging by _id means buckets that fail in this run wait for the next one
+        buckets = await db.digest_buckets.find(
+            {"status": "pending", "bucket_end": {"$lte": now}, "_id": {"$gt": last_id}}
+        ).sort("_id", 1).limit(DIGEST_BATCH_SIZE).to_list(DIGEST_BATCH_SIZE)
+        if not buckets:
+            break
+        last_id = buckets[-1]["_id"]
+        
+        users = {
+            user["id"]: user
+            for user in await db.users.find(
+                {"id": {"$in": [bucket["user_id"] for bucket in buckets]}},
+                {"_id": 0, "id": 1, "name": 1, "email": 1, "is_active": 1}
+            ).to_list(None)
+        }
+        deliverable = [
+            bucket for bucket in buckets
+            if users.get(bucket["user_id"], {}).get("is_active", False) and users[bucket["user_id"]].get("email")
+        ]
+        errors = await smtp_pool.send([render_digest(users[bucket["user_id"]], bucket) for bucket in deliverable])
+        
+        sent_at = datetime.utcnow()
+        deliverable_ids = {bucket["_id"] for bucket in deliverable}
+        # Inactive or deleted users get nothing
+        updates = [
+            UpdateOne({"_id": bucket["_id"]}, {"$set": {"status": "skipped", "sent_at": sent_at}})
+            for bucket in buckets if bucket["_id"] not in deliverable_ids
+        ]
+        for index, bucket in enumerate(deliverable):
+            if index not in errors:
+                updates.append(UpdateOne({"_id": bucket["_id"]}, {"$set": {"status": "sent", "sent_at": sent_at}}))
+                continue
+            change = {"last_error": errors[index]}
+            if bucket.get("attempts", 0) + 1 >= DIGEST_MAX_ATTEMPTS:
+                change.update(status="failed", sent_at=sent_at)
+            updates.append(UpdateOne({"_id": bucket["_id"]}, {"$set": change, "$inc": {"attempts": 1}}))
+        await db.digest_buckets.bulk_write(updates, ordered=False)
+        sent += len(deliverable) - len(errors)
+        failed += len(errors)
+        
+        if not await acquire_leader_lock("notification_digests"):
+            logger.warning("Lost notification digest lock, stopping")
+            break
+    
+    if sent or failed:
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Sent {sent} notification digests ({failed} failed) in {elapsed:.1f}s, {sent / elapsed:.0f} users/s")
+
+SCHEDULED_JOBS.append(("notification_digests", DIGEST_INTERVAL_SECONDS, send_digests))
+
+async def ensure_indexes():
+    """Create the indexes background jobs and hot queries rely on"""
+    await db.users.create_index("id")
+    await db.users.create_index([("company_id", 1), ("point_cap_renewal_type", 1), ("id", 1)])
+    await db.users.create_index(
+        [("company_id", 1), ("name", 1), ("id", 1)], collation=DIRECTORY_COLLATION, name="directory_name"
+    )
+    await db.users.create_index(
+        [("company_id", 1), ("email", 1)], collation=DIRECTORY_COLLATION, name="directory_email"
+    )
+    await db.point_transactions.create_index([("to_user_id", 1), ("created_at", -1)])
+    await db.point_transactions.create_index([("from_user_id", 1), ("created_at", -1)])
+    await db.point_transactions.create_index("created_at")
+    await db.point_transactions.create_index("id", unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+    await db.balance_snapshots.create_index([("user_id", 1), ("as_of", -1)], unique=True)
+    await db.point_cap_renewals.create_index([("user_id", 1), ("period", 1)], unique=True)
+    await db.point_cap_renewals.create_index([("user_id", 1), ("renewed_at", -1)])
+    await db.point_lots.create_index("id", unique=True)
+    await db.point_lots.create_index(
+        [("user_id", 1), ("expires_at", 1)], partialFilterExpression={"remaining": {"$gt": 0}}
+    )
+    await db.point_lots.create_index([("expires_at", 1)], partialFilterExpression={"remaining": {"$gt": 0}})
+    await db.point_lots.create_index("expiry_recorded", partialFilterExpression={"expiry_recorded": False})
+    await db.rewards.create_index("id", unique=True)
+    await db.rewards.create_index([("company_id", 1), ("is_active", 1), ("points_cost", 1)])
+    await db.redemptions.create_index([("user_id", 1), ("created_at", -1)])
+    await db.digest_buckets.create_index([("status", 1), ("_id", 1)], partialFilterExpression={"status": "pending"})
+    await db.digest_buckets.create_index("sent_at", expireAfterSeconds=DIGEST_RETENTION_SECONDS)
+    await db.refresh_tokens.create_index("expires_at", expireAfterSeconds=0)
+    await db.refresh_tokens.create_index("family_id")
+    await db.refresh_tokens.create_index("user_id")
+    await db.revocations.create_index("expires_at", expireAfterSeconds=0)
+    await db.revocations.create_index("written_at")
+    # Slots of workers that are gone for good (e.g. renamed hosts) age out
+    await db.cache_bus_tokens.create_index("updated_at", expireAfterSeconds=CACHE_BUS_TOKEN_RETENTION_SECONDS)
+    await db.webhook_endpoints.create_index("id", unique=True)
+    await db.webhook_endpoints.create_index([("company_id", 1), ("is_active", 1)])
+    await db.webhook_outbox.create_index("id", unique=True)
+    await db.webhook_outbox.create_index(
+        [("next_attempt_at", 1)], partialFilterExpression={"status": "pending"}
+    )
+    await db.webhook_outbox.create_index("lease_owner", partialFilterExpression={"status": "pending"})
+    await db.webhook_outbox.create_index("delivered_at", expireAfterSeconds=WEBHOOK_RETENTION_SECONDS)
+    await db.webhook_outbox.create_index("failed_at", expireAfterSeconds=WEBHOOK_RETENTION_SECONDS)
+    await db.request_profiles.create_index("id", unique=True)
+    await db.request_profiles.create_index("started_at", expireAfterSeconds=PROFILE_RETENTION_SECONDS)
+    if RATE_LIMIT_BACKEND == "mongo":
+        await db.rate_limits.create_index("updated_at", expireAfterSeconds=3600)
+
+# Admission control
+class MemoryRateLimitBackend:
+    """Token buckets kept in this worker's memory"""
+
+    def __init__(self, max_buckets: int = 100000):
+        self.buckets: Dict[str, List[float]] = {}
+        self.max_buckets = max_buckets
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take one token; returns 0 when admitted, otherwise seconds until a token is available"""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune(now)
+            bucket = self.buckets[key] = [burst, now]
+
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+    def prune(self, now: float):
+        # Buckets idle for a minute are full again and can be forgotten
+        idle = [key for key, (_, updated) in self.buckets.items() if now - updated > 60]
+        for key in idle:
+            del self.buckets[key]
+        if len(self.buckets) >= self.max_buckets:
+            self.buckets.clear()
+
+class MongoRateLimitBackend:
+    """Token buckets shared by every worker through the rate_limits collection"""
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated_at": now}},
+                {"$set": {
+                    "admitted": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]}
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket["admitted"]:
+            return 0
+        return (1 - bucket["tokens"]) / rate
+
+rate_limit_backend = MongoRateLimitBackend() if RATE_LIMIT_BACKEND == "mongo" else MemoryRateLimitBackend()
+
+def classify_route(method: str, path: str) -> str:
+    if path == "/api/auth/refresh":
+        return "refresh"
+    if (method, path) in AUTH_ROUTES:
+        return "auth"
+    if method in ("POST", "PUT", "PATCH", "DELETE"):
+        return "writes"
+    return "reads"
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+# Logged once per process: one proxy missing from TRUSTED_PROXIES puts every caller in one bucket
+untrusted_forwarder_warning = {"logged": False}
+
+def client_address(scope) -> str:
+    """Caller's IP: the peer, or the address a trusted proxy forwarded for"""
+    peer = scope["client"][0] if scope.get("client") else "unknown"
+    if not is_trusted_proxy(peer):
+        if not untrusted_forwarder_warning["logged"] and any(name == b"x-forwarded-for" for name, _ in scope["headers"]):
+            untrusted_forwarder_warning["logged"] = True
+            logger.warning(
+                f"X-Forwarded-For received from {peer}, which is not in TRUSTED_PROXIES; "
+                f"rate limits key on the peer address, so all traffic through it shares one bucket"
+            )
+        return peer
+    headers = {name: value.decode("latin-1") for name, value in scope["headers"] if name in (b"x-forwarded-for", b"x-real-ip")}
+    # The rightmost hop not added by one of our proxies is the client; anything left of it is caller-supplied
+    hops = [hop.strip() for hop in headers.get(b"x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop
+    return headers.get(b"x-real-ip", "").strip() or (hops[0] if hops else peer)
+
+def request_identity(scope) -> Dict[str, Optional[str]]:
+    """Caller identity from the bearer token, verified but without a database lookup.
+    Expired tokens still identify the caller (with expired set), which is enough for bucketing"""
+    identity = {"user_id": None, "company_id": None, "role": None, "expired": False, "client": client_address(scope)}
+    for name, value in scope["headers"]:
+        if name == b"authorization" and value.lower().startswith(b"bearer "):
+            token = value[7:].decode()
+            try:
+                try:
+                    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+                except jwt.ExpiredSignatureError:
+                    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options={"verify_exp": False})
+                    identity["expired"] = True
+                identity["user_id"] = payload.get("user_id")
+                identity["company_id"] = payload.get("company_id")
+                identity["role"] = payload.get("role")
+            except jwt.PyJWTError:
+                pass
+            break
+    return identity
+
+async def send_rejection(send, retry_after: float, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 429,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+class AdmissionControlMiddleware:
+    """Shed load with 429s from per-company, per-user and per-route-class token buckets
+    and per-worker concurrency caps on expensive endpoints"""
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight: Dict[str, int] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED or not scope["path"].startswith("/api/"):
+            await self.app(scope, receive, send)
+            return
+
+        method, path = scope["method"], scope["path"]
+        route_class = classify_route(method, path)
+        identity = request_identity(scope)
+
+        buckets = []
+        if route_class == "refresh":
+            # The expired access token sent along names the user; refreshes without one are bucketed by address
+            scope_name, key = ("user", identity["user_id"]) if identity["user_id"] else ("client", identity["client"])
+            buckets.append((f"{scope_name}:{key}:refresh", RATE_LIMITS[("refresh", scope_name)]))
+        elif route_class == "auth":
+            # Every password attempt is charged to its address; a token cannot buy a fresh
+            # bucket, since anyone can get one by registering. Live tokens also pay per user
+            buckets.append((f"client:{identity['client']}:auth", RATE_LIMITS[("auth", "client")]))
+            if identity["user_id"] and not identity["expired"]:
+                buckets.append((f"user:{identity['user_id']}:auth", RATE_LIMITS[("auth", "user")]))
+        elif not identity["user_id"]:
+            buckets.append((f"client:{identity['client']}:anonymous", RATE_LIMITS[("anonymous", "client")]))
+        else:
+            if identity["company_id"]:
+                buckets.append((f"company:{identity['company_id']}:{route_class}", RATE_LIMITS[(route_class, "company")]))
+            buckets.append((f"user:{identity['user_id']}:{route_class}", RATE_LIMITS[(route_class, "user")]))
+
+        for key, (rate, burst) in buckets:
+            retry_after = await rate_limit_backend.take(key, rate, burst)
+            if retry_after:
+                await send_rejection(send, retry_after, "Rate limit exceeded")
+                return
+
+        for limit_method, pattern, name, limit in CONCURRENCY_LIMITS:
+            if method == limit_method and pattern.match(path):
+                if self.in_flight.get(name, 0) >= limit:
+                    await send_rejection(send, 1, "Server busy, retry shortly")
+                    return
+                self.in_flight[name] = self.in_flight.get(name, 0) + 1
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    self.in_flight[name] -= 1
+                return
+
+        await self.app(scope, receive, send)
+
+# Request profiling
+def sign_profile_request(user_id: str, ttl_seconds: int = 300) -> str:
+    """X-Profile-Signature value letting user_id profile requests for ttl_seconds"""
+    expires = int(time.time()) + ttl_seconds
+    digest = hmac.new(PROFILING_SECRET.encode(), f"{user_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{digest}"
+
+def verify_profile_signature(user_id: Optional[str], signature: str) -> bool:
+    expires, _, digest = signature.partition(".")
+    if not user_id or not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(PROFILING_SECRET.encode(), f"{user_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+class RequestProfile:
+    """Stack samples and Mongo command timeline of one profiled request"""
+
+    def __init__(self, method: str, path: str, user_id: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.user_id = user_id
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.tasks = weakref.WeakSet()  # the request's task and every task it spawns
+        self.stacks: Dict[str, int] = {}
+        self.idle_samples = 0
+        self.other_samples = 0
+        self.timeline: List[Dict[str, Any]] = []
+        self.pending_commands: Dict[Any, Dict[str, Any]] = {}
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 3)
+
+    def command_started(self, event):
+        entry = {
+            "command": event.command_name,
+            "collection": str(event.command.get(event.command_name)),
+            "start_ms": self.elapsed_ms(),
+            "duration_ms": None,
+            "ok": None
+        }
+        with self.lock:
+            if len(self.timeline) < PROFILE_MAX_TIMELINE:
+                self.timeline.append(entry)
+                self.pending_commands[(event.connection_id, event.request_id)] = entry
+
+    def command_finished(self, event, ok: bool):
+        with self.lock:
+            entry = self.pending_commands.pop((event.connection_id, event.request_id), None)
+        if entry:
+            entry["duration_ms"] = event.duration_micros / 1000
+            entry["ok"] = ok
+
+    def add_sample(self, frame):
+        # Folded-stack format: root;...;leaf, one "stack count" line per distinct stack
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack = ";".join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def report(self) -> Dict[str, Any]:
+        samples = sum(self.stacks.values())
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "user_id": self.user_id,
+            "started_at": self.started_at,
+            "duration_ms": self.elapsed_ms(),
+            "sample_interval_ms": PROFILE_SAMPLE_INTERVAL_SECONDS * 1000,
+            "samples": samples,
+            # Samples taken while the event loop waited on I/O or ran other requests
+            "idle_samples": self.idle_samples,
+            "other_samples": self.other_samples,
+            "folded": "\n".join(f"{stack} {count}" for stack, count in sorted(self.stacks.items())),
+            "mongo": {
+                "commands": len(self.timeline),
+                "total_ms": round(sum(entry["duration_ms"] or 0 for entry in self.timeline), 3),
+                "timeline": self.timeline
+            }
+        }
+
+class StackSampler(threading.Thread):
+    """Samples the event loop thread's stack while its current task belongs to the profile"""
+
+    def __init__(self, profile: RequestProfile, loop: asyncio.AbstractEventLoop):
+        super().__init__(name=f"profile-{profile.id}", daemon=True)
+        self.profile = profile
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL_SECONDS):
+            task = asyncio.current_task(self.loop)
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if task is None or frame is None:
+                self.profile.idle_samples += 1
+            elif task in self.profile.tasks:
+                self.profile.add_sample(frame)
+            else:
+                self.profile.other_samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+profiled_loops = weakref.WeakSet()
+
+def install_profile_task_factory(loop: asyncio.AbstractEventLoop):
+    """Attribute tasks created inside a profiled request (e.g. by gather) to its profile"""
+    if loop in profiled_loops:
+        return
+    previous = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        task = previous(loop, coro, **kwargs) if previous else asyncio.Task(coro, loop=loop, **kwargs)
+        profile = active_profile.get()
+        if profile is not None:
+            profile.tasks.add(task)
+        return task
+
+    loop.set_task_factory(factory)
+    profiled_loops.add(loop)
+
+async def store_profile(profile: RequestProfile):
+    try:
+        await db.request_profiles.insert_one(profile.report())
+    except PyMongoError as e:
+        logger.warning(f"Could not store request profile {profile.id}: {e}")
+
+class RequestProfilingMiddleware:
+    """Profiles requests carrying a valid X-Profile-Signature from a super admin"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROFILING_SECRET:
+            await self.app(scope, receive, send)
+            return
+
+        signature = next((value for name, value in scope["headers"] if name == b"x-profile-signature"), None)
+        if signature is None:
+            await self.app(scope, receive, send)
+            return
+
+        identity = request_identity(scope)
+        if identity["expired"] or identity["role"] != UserRole.SUPER_ADMIN.value or not verify_profile_signature(identity["user_id"], signature.decode("latin-1")):
+            body = json.dumps({"detail": "Invalid profiling signature"}).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 403,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        loop = asyncio.get_running_loop()
+        install_profile_task_factory(loop)
+        profile = RequestProfile(scope["method"], scope["path"], identity["user_id"])
+        profile.tasks.add(asyncio.current_task())
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        token = active_profile.set(profile)
+        sampler = StackSampler(profile, loop)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            sampler.stop()
+            active_profile.reset(token)
+            await store_profile(profile)
+
+# Slow query capture
+SLOW_QUERY_DRIVER_FIELDS = {
+    "lsid", "$db", "$clusterTime", "txnNumber", "$readPreference", "readConcern",
+    "startTransaction", "autocommit", "apiVersion", "apiStrict", "apiDeprecationErrors"
+}
+slow_query_tasks = []
+slow_query_explained_at: Dict[str, float] = {}
+
+def query_shape(value: Any) -> Any:
+    """Query with every literal replaced by "?"; scalar lists such as $in operands collapse to one "?" """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        if all(not isinstance(item, (dict, list, tuple)) for item in value):
+            return "?"
+        return [query_shape(item) for item in value]
+    return "?"
+
+def command_shape(command: Dict[str, Any]) -> Dict[str, Any]:
+    shape = {}
+    for field in ("filter", "query", "pipeline"):
+        if field in command:
+            shape[field] = query_shape(command[field])
+    # Sort and projection specs are structure, not literals
+    for field in ("sort", "projection", "hint"):
+        if field in command:
+            shape[field] = command[field]
+    return shape
+
+def plan_stages(plan: Optional[Dict[str, Any]]) -> List[str]:
+    """Winning plan flattened leaf-first, e.g. ["IXSCAN to_user_id_1_created_at_-1", "FETCH", "LIMIT"]"""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f" {plan['indexName']}"
+        stages.append(stage)
+        # Branching stages (OR, SORT_MERGE) are summarized by their first input
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return list(reversed(stages))
+
+def summarize_explain(result: Dict[str, Any]) -> Dict[str, Any]:
+    # Aggregations that push work into the query layer nest the plan in the first $cursor stage
+    source = result
+    if "queryPlanner" not in result and result.get("stages"):
+        source = result["stages"][0].get("$cursor", {})
+    winning_plan = source.get("queryPlanner", {}).get("winningPlan", {})
+    # Slot-based engine plans wrap the classic tree in queryPlan
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+    stats = source.get("executionStats", {})
+    stages = plan_stages(winning_plan)
+    return {
+        "plan": stages,
+        "collection_scan": any(stage.startswith("COLLSCAN") for stage in stages),
+        "returned": stats.get("nReturned"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "docs_examined": stats.get("totalDocsExamined"),
+        "execution_ms": stats.get("executionTimeMillis")
+    }
+
+async def explain_command(database: str, command: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    explained = {key: value for key, value in command.items() if key not in SLOW_QUERY_DRIVER_FIELDS}
+    try:
+        result = await client[database].command({"explain": explained, "verbosity": "executionStats"})
+    except PyMongoError as e:
+        return {"error": str(e)}
+    return summarize_explain(result)
+
+async def record_slow_query(slow_query: Dict[str, Any]):
+    command = slow_query.pop("command_document")
+    shape = command_shape(command)
+    shape_json = json.dumps(shape, sort_keys=True, default=str)
+    shape_hash = hashlib.sha1(f"{slow_query['command']}:{slow_query['collection']}:{shape_json}".encode()).hexdigest()[:16]
+
+    # Explain each shape at most once per interval; explains re-run the query
+    explain = None
+    if SLOW_QUERY_EXPLAIN and time.monotonic() - slow_query_explained_at.get(shape_hash, float("-inf")) >= SLOW_QUERY_EXPLAIN_INTERVAL_SECONDS:
+        slow_query_explained_at[shape_hash] = time.monotonic()
+        explain = await explain_command(slow_query["database"], command)
+
+    await db.slow_queries.insert_one({
+        **slow_query,
+        "shape_hash": shape_hash,
+        # Stored as text: shapes keep operator keys such as $or that documents cannot hold everywhere
+        "shape": shape_json,
+        "explain": explain
+    })
+
+async def ensure_slow_query_collection():
+    try:
+        await db.create_collection("slow_queries", capped=True, size=SLOW_QUERY_COLLECTION_BYTES)
+    except CollectionInvalid:
+        pass
+
+async def run_slow_query_recorder():
+    """Record slow commands handed over by the listener, explaining new shapes"""
+    await ensure_slow_query_collection()
+    slow_query_listener.attach(asyncio.get_running_loop())
+    try:
+        while True:
+            slow_query = await slow_query_listener.queue.get()
+            try:
+                await record_slow_query(slow_query)
+            except PyMongoError as e:
+                logger.warning(f"Could not record slow query on {slow_query.get('collection')}: {e}")
+    finally:
+        slow_query_listener.detach()
+
+class RequestScopeMiddleware:
+    """Exposes the ASGI scope of the request being served to the Mongo command listeners"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = current_request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request_scope.reset(token)
+
+# Webhooks
+# Events go to a durable outbox, one entry per subscribed endpoint, and every
+# worker runs a dispatcher that leases due entries and posts them in signed
+# batches, bounded per destination host, retrying with exponential backoff
+webhook_endpoint_cache: Dict[str, Any] = {}
+webhook_tasks = []
+
+@on_cache_invalidation("webhook_endpoints")
+def invalidate_webhook_endpoints(change: Dict[str, Any]):
+    company_id = (change.get("fullDocument") or {}).get("company_id")
+    if company_id:
+        webhook_endpoint_cache.pop(company_id, None)
+    else:
+        # Updates and deletes carry only the _id; endpoint changes are rare, so drop them all
+        webhook_endpoint_cache.clear()
+
+@on_cache_flush
+def flush_webhook_endpoints():
+    webhook_endpoint_cache.clear()
+
+async def webhook_endpoints_for(company_id: str) -> List[Dict[str, Any]]:
+    """Active endpoints of a company, cached briefly so emitting costs no read"""
+    cached = webhook_endpoint_cache.get(company_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    endpoints = await db.webhook_endpoints.find(
+        {"company_id": company_id, "is_active": True}, {"_id": 0, "id": 1, "events": 1}
+    ).to_list(None)
+    webhook_endpoint_cache[company_id] = (time.monotonic() + WEBHOOK_ENDPOINT_CACHE_SECONDS, endpoints)
+    return endpoints
+
+async def emit_webhook_event(company_id: Optional[str], event_type: str, data: Dict[str, Any]):
+    """Queue an event for every endpoint of the company subscribed to it"""
+    if not WEBHOOKS_ENABLED or not company_id:
+        return
+    endpoints = [
+        endpoint for endpoint in await webhook_endpoints_for(company_id)
+        if not endpoint.get("events") or event_type in endpoint["events"]
+    ]
+    if not endpoints:
+        return
+    
+    now = datetime.utcnow()
+    event_id = str(uuid.uuid4())
+    await db.webhook_outbox.insert_many([
+        {
+            "id": str(uuid.uuid4()),
+            "event_id": event_id,
+            "endpoint_id": endpoint["id"],
+            "company_id": company_id,
+            "type": event_type,
+            "data": jsonable_encoder(data),
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "lease_until": now,
+            "lease_owner": None,
+            "created_at": now
+        }
+        for endpoint in endpoints
+    ], ordered=False)
+
+def sign_webhook(secret: str, timestamp: str, body: bytes) -> str:
+    """X-Effy-Signature value: receivers recompute v1 over "<t>.<raw body>" with their secret"""
+    digest = hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+def webhook_backoff(attempts: int) -> float:
+    """Seconds before retry number attempts, doubling up to the cap, with jitter"""
+    delay = min(WEBHOOK_BACKOFF_MAX_SECONDS, WEBHOOK_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+class WebhookDestinationError(Exception):
+    pass
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+async def resolve_webhook_destination(url: str) -> str:
+    """Resolve the URL's host and return one address to connect to; every address must be public"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise WebhookDestinationError("Webhook URL must be an absolute http(s) URL")
+    if parts.username or parts.password:
+        raise WebhookDestinationError("Webhook URL must not carry credentials")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise WebhookDestinationError(f"Webhook host {parts.hostname} does not resolve")
+    addresses = sorted({info[4][0] for info in infos})
+    if not addresses:
+        raise WebhookDestinationError(f"Webhook host {parts.hostname} does not resolve")
+    if not WEBHOOK_ALLOW_PRIVATE_DESTINATIONS and not all(is_public_address(address) for address in addresses):
+        raise WebhookDestinationError(f"Webhook host {parts.hostname} resolves to a non-public address")
+    return addresses[0]
+
+def pin_webhook_url(url: str, address: str) -> str:
+    """The URL with its host replaced by the checked address, so the connection can't be re-resolved"""
+    parts = urlsplit(url)
+    host = f"[{address}]" if ":" in address else address
+    return parts._replace(netloc=f"{host}:{parts.port}" if parts.port else host).geturl()
+
+class WebhookDispatcher:
+    """Leases due outbox entries and delivers them in per-endpoint batches"""
+
+    def __init__(self):
+        self.http = None
+        self.destination_limits: Dict[str, asyncio.Semaphore] = {}
+        self.destination_load: Dict[str, int] = {}
+        self.endpoint_destinations: Dict[str, str] = {}
+        self.in_flight = set()
+
+    def limiter(self, destination: str) -> asyncio.Semaphore:
+        if destination not in self.destination_limits:
+            self.destination_limits[destination] = asyncio.Semaphore(WEBHOOK_DESTINATION_CONCURRENCY)
+        return self.destination_limits[destination]
+
+    async def deliver(self, endpoint: Dict[str, Any], entries: List[Dict[str, Any]]):
+        """POST one signed batch; returns (delivered, retry_after, error)"""
+        delivery_id = str(uuid.uuid4())
+        body = pydantic_core.to_json({
+            "delivery_id": delivery_id,
+            "events": [
+                {"id": entry["event_id"], "type": entry["type"], "created_at": entry["created_at"],
+                 "company_id": entry["company_id"], "data": entry["data"]}
+                for entry in entries
+            ]
+        }, fallback=str)
+        timestamp = str(int(time.time()))
+        headers = {
+            "content-type": "application/json",
+            "x-effy-delivery": delivery_id,
+            "x-effy-signature": sign_webhook(endpoint["secret"], timestamp, body)
+        }
+        # Re-resolve on every delivery and connect to the address that was checked: a host that
+        # passed at registration can since have been pointed at an internal address
+        try:
+            address = await resolve_webhook_destination(endpoint["url"])
+        except WebhookDestinationError as e:
+            return False, None, str(e)
+        parts = urlsplit(endpoint["url"])
+        headers["host"] = parts.netloc
+        extensions = {"sni_hostname": parts.hostname} if parts.scheme == "https" else {}
+        try:
+            response = await self.http.post(
+                pin_webhook_url(endpoint["url"], address), content=body, headers=headers, extensions=extensions
+            )
+        except httpx.HTTPError as e:
+            return False, None, f"{type(e).__name__}: {e}"
+        if 200 <= response.status_code < 300:
+            return True, None, None
+        return False, parse_retry_after(response.headers.get("retry-after")), f"HTTP {response.status_code}"
+
+    async def settle(self, entries: List[Dict[str, Any]], delivered: bool, retry_after: Optional[float], error: Optional[str]):
+        now = datetime.utcnow()
+        lease = entries[0]["lease_owner"]
+        ids = [entry["id"] for entry in entries]
+        # An entry whose lease ran out may already belong to another worker
+        if delivered:
+            await db.webhook_outbox.update_many(
+                {"id": {"$in": ids}, "lease_owner": lease},
+                {"$set": {"status": "delivered", "delivered_at": now, "lease_owner": None}, "$inc": {"attempts": 1}}
+            )
+            return
+        
+        updates = []
+        for entry in entries:
+            attempts = entry["attempts"] + 1
+            if attempts >= WEBHOOK_MAX_ATTEMPTS:
+                change = {"status": "failed", "failed_at": now}
+            else:
+                delay = max(webhook_backoff(attempts), retry_after or 0)
+                change = {"next_attempt_at": now + timedelta(seconds=delay), "lease_until": now}
+            updates.append(UpdateOne(
+                {"id": entry["id"], "lease_owner": lease},
+                {"$set": {**change, "last_error": error, "lease_owner": None}, "$inc": {"attempts": 1}}
+            ))
+        await db.webhook_outbox.bulk_write(updates, ordered=False)
+
+    async def send(self, destination: str, endpoint: Dict[str, Any], entries: List[Dict[str, Any]]):
+        """Deliver one batch; the caller has already counted it against the destination"""
+        try:
+            async with self.limiter(destination):
+                delivered, retry_after, error = await self.deliver(endpoint, entries)
+            await self.settle(entries, delivered, retry_after, error)
+        except PyMongoError as e:
+            # Leases run out and the entries are retried
+            logger.warning(f"Could not settle webhook delivery to {destination}: {e}")
+        finally:
+            self.destination_load[destination] -= 1
+
+    async def claim(self) -> int:
+        """Lease due entries and start their deliveries; returns how many were dispatched"""
+        if len(self.in_flight) >= WEBHOOK_MAX_IN_FLIGHT:
+            await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+        
+        now = datetime.utcnow()
+        # Leave entries for saturated destinations to a later pass instead of queueing them here
+        saturated = [
+            endpoint_id for endpoint_id, destination in self.endpoint_destinations.items()
+            if self.destination_load.get(destination, 0) >= WEBHOOK_DESTINATION_CONCURRENCY
+        ]
+        due = {"status": "pending", "next_attempt_at": {"$lte": now}, "lease_until": {"$lte": now}}
+        if saturated:
+            due["endpoint_id"] = {"$nin": saturated}
+        candidates = await db.webhook_outbox.find(due, {"_id": 0, "id": 1}).sort("next_attempt_at", 1).limit(WEBHOOK_CLAIM_SIZE).to_list(WEBHOOK_CLAIM_SIZE)
+        if not candidates:
+            return 0
+        
+        lease = uuid.uuid4().hex
+        await db.webhook_outbox.update_many(
+            {"id": {"$in": [candidate["id"] for candidate in candidates]}, "status": "pending", "lease_until": {"$lte": now}},
+            {"$set": {"lease_owner": lease, "lease_until": now + timedelta(seconds=WEBHOOK_LEASE_SECONDS)}}
+        )
+        entries = await db.webhook_outbox.find({"lease_owner": lease}, {"_id": 0}).sort("created_at", 1).to_list(None)
+        
+        dispatched = 0
+        by_endpoint: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in entries:
+            by_endpoint.setdefault(entry["endpoint_id"], []).append(entry)
+        endpoints = {
+            endpoint["id"]: endpoint
+            for endpoint in await db.webhook_endpoints.find({"id": {"$in": list(by_endpoint)}, "is_active": True}, {"_id": 0}).to_list(None)
+        }
+        
+        for endpoint_id, endpoint_entries in by_endpoint.items():
+            endpoint = endpoints.get(endpoint_id)
+            if not endpoint:
+                await db.webhook_outbox.update_many(
+                    {"id": {"$in": [entry["id"] for entry in endpoint_entries]}, "lease_owner": lease},
+                    {"$set": {"status": "failed", "failed_at": now, "last_error": "Endpoint removed", "lease_owner": None}}
+                )
+                continue
+            destination = urlsplit(endpoint["url"]).netloc
+            self.endpoint_destinations[endpoint_id] = destination
+            # Take only as many batches as the destination has free slots and hand the rest back
+            room = max(0, WEBHOOK_DESTINATION_CONCURRENCY - self.destination_load.get(destination, 0)) * WEBHOOK_BATCH_SIZE
+            if len(endpoint_entries) > room:
+                await db.webhook_outbox.update_many(
+                    {"id": {"$in": [entry["id"] for entry in endpoint_entries[room:]]}, "lease_owner": lease},
+                    {"$set": {"lease_owner": None, "lease_until": now}}
+                )
+                endpoint_entries = endpoint_entries[:room]
+            dispatched += len(endpoint_entries)
+            for start in range(0, len(endpoint_entries), WEBHOOK_BATCH_SIZE):
+                self.destination_load[destination] = self.destination_load.get(destination, 0) + 1
+                task = asyncio.create_task(self.send(destination, endpoint, endpoint_entries[start:start + WEBHOOK_BATCH_SIZE]))
+                self.in_flight.add(task)
+                task.add_done_callback(self.in_flight.discard)
+        return dispatched
+
+    async def run(self):
+        async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT_SECONDS) as http:
+            self.http = http
+            try:
+                while True:
+                    try:
+                        claimed = await self.claim()
+                    except PyMongoError as e:
+                        logger.warning(f"Webhook dispatcher could not claim deliveries: {e}")
+                        claimed = 0
+                    if not claimed:
+                        await asyncio.sleep(WEBHOOK_POLL_SECONDS)
+            finally:
+                for task in self.in_flight:
+                    task.cancel()
+                await asyncio.gather(*self.in_flight, return_exceptions=True)
+
+webhook_dispatcher = WebhookDispatcher()
 
 # Authentication routes
 @api_router.post("/auth/register")
@@ -248,7 +3266,7 @@ async def register_user(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="User already exists")
     
     # Hash password
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await asyncio.to_thread(hash_password, user_data.password)
     
     # Create user
     user = User(
@@ -260,15 +3278,12 @@ async def register_user(user_data: UserCreate):
         department=user_data.department
     )
     
-    user_dict = user.dict()
+    user_dict = user.model_dump()
     user_dict["password"] = hashed_password
     
     await db.users.insert_one(user_dict)
     
-    # Create JWT token
-    token = create_jwt_token(user.id, user.email, user.role.value, user.company_id)
-    
-    return {"token": token, "user": user}
+    return {**await issue_tokens(user_dict), "user": user}
 
 @api_router.post("/auth/login")
 async def login_user(login_data: UserLogin):
@@ -278,18 +3293,62 @@ async def login_user(login_data: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Verify password
-    if not verify_password(login_data.password, user_data["password"]):
+    # bcrypt runs off the event loop so the login concurrency cap bounds its CPU use
+    if not await asyncio.to_thread(verify_password, login_data.password, user_data["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if not user_data.get("is_active", True):
+        raise HTTPException(status_code=403, detail="Account is deactivated")
+    
     user = User(**{k: v for k, v in user_data.items() if k != "password"})
     
-    # Create JWT token
-    token = create_jwt_token(user.id, user.email, user.role.value, user.company_id)
+    return {**await issue_tokens(user_data), "user": user}
+
+@api_router.post("/auth/refresh")
+async def refresh_access_token(refresh_data: RefreshRequest):
+    """Swap a refresh token for a new access token and a new refresh token"""
+    token_hash = hash_refresh_token(refresh_data.refresh_token)
+    now = datetime.utcnow()
+    record = await db.refresh_tokens.find_one_and_update(
+        {"_id": token_hash, "used_at": None, "expires_at": {"$gt": now}},
+        {"$set": {"used_at": now}}
+    )
+    if not record:
+        used = await db.refresh_tokens.find_one({"_id": token_hash, "used_at": {"$ne": None}})
+        if used and now - used["used_at"] > timedelta(seconds=REFRESH_REUSE_GRACE_SECONDS):
+            # A rotated token came back: someone else may hold the session, so end it
+            await db.refresh_tokens.delete_many({"family_id": used["family_id"]})
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    
+    user_data = await db.users.find_one({"id": record["user_id"]})
+    if not user_data or not user_data.get("is_active", True):
+        raise HTTPException(status_code=401, detail="User is deactivated")
+    
+    return {
+        "token": create_jwt_token(user_data),
+        "refresh_token": await issue_refresh_token(user_data["id"], record["family_id"]),
+        "expires_in": ACCESS_TOKEN_TTL_SECONDS
+    }
+
+@api_router.post("/auth/logout")
+async def logout_user(
+    logout_data: LogoutRequest,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: User = Depends(get_current_user)
+):
+    """Revoke the access token and end the refresh session it came with"""
+    await revoke_access_token(decode_access_token(credentials.credentials))
+    if logout_data.refresh_token:
+        record = await db.refresh_tokens.find_one(
+            {"_id": hash_refresh_token(logout_data.refresh_token), "user_id": current_user.id}, {"family_id": 1}
+        )
+        if record:
+            await db.refresh_tokens.delete_many({"family_id": record["family_id"]})
     
-    return {"token": token, "user": user}
+    return {"message": "Logged out"}
 
 @api_router.get("/auth/me")
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: User = Depends(get_current_user_record)):
     return current_user
 
 # Company routes
@@ -306,7 +3365,7 @@ async def create_company(company_data: CompanyCreate):
         point_name=company_data.point_name
     )
     
-    await db.companies.insert_one(company.dict())
+    await db.companies.insert_one(company.model_dump())
     
     # Create company admin
     admin_user = UserCreate(
@@ -318,7 +3377,7 @@ async def create_company(company_data: CompanyCreate):
     )
     
     # Hash password and create admin
-    hashed_password = hash_password(admin_user.password)
+    hashed_password = await asyncio.to_thread(hash_password, admin_user.password)
     admin = User(
         email=admin_user.email,
         name=admin_user.name,
@@ -326,7 +3385,7 @@ async def create_company(company_data: CompanyCreate):
         company_id=admin_user.company_id
     )
     
-    admin_dict = admin.dict()
+    admin_dict = admin.model_dump()
     admin_dict["password"] = hashed_password
     
     await db.users.insert_one(admin_dict)
@@ -337,23 +3396,34 @@ async def create_company(company_data: CompanyCreate):
     return company
 
 @api_router.get("/companies/{company_id}")
-async def get_company(company_id: str, current_user: User = Depends(get_current_user)):
-    company_data = await db.companies.find_one({"id": company_id})
-    if not company_data:
+async def get_company(
+    company_id: str,
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user)
+):
+    catalog = await get_company_catalog(company_id)
+    if not catalog:
         raise HTTPException(status_code=404, detail="Company not found")
     
-    return Company(**company_data)
+    etag = make_etag("company", catalog.version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    
+    return catalog.company
 
 # Point transaction routes
-@api_router.post("/points/give")
-async def give_points(
-    transaction_data: PointTransactionCreate,
-    current_user: User = Depends(get_current_user)
-):
+async def award_points(transaction_data: PointTransactionCreate, current_user: User):
+    """Award points from a manager or company admin to a recipient"""
     # Check if current user is a manager
     if current_user.role not in [UserRole.MANAGER, UserRole.COMPANY_ADMIN]:
         raise HTTPException(status_code=403, detail="Only managers can give points")
     
+    # A zero or negative amount would raise the cap below and debit the recipient
+    if transaction_data.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+    
     # Get recipient user
     recipient = await db.users.find_one({"id": transaction_data.to_user_id})
     if not recipient:
@@ -373,8 +3443,19 @@ async def give_points(
         if recipient.get("role") not in [UserRole.MANAGER.value]:
             raise HTTPException(status_code=403, detail="Company admins can only give points to managers")
     
-    # Check if manager has enough points in cap
-    if current_user.point_cap < transaction_data.amount:
+    # The first award of a new period renews an automatic cap itself, so the job
+    # running later cannot reset the cap over this award
+    now = datetime.utcnow()
+    if current_user.point_cap_renewal_type == "automatic" and current_user.point_cap_renewal_period != point_cap_renewal_period(now):
+        await renew_point_caps_for([current_user.id], now)
+    
+    # Draw down the manager's point cap only while it still covers the amount, so
+    # concurrent awards cannot spend it below zero
+    drawn = await db.users.update_one(
+        {"id": current_user.id, "point_cap": {"$gte": transaction_data.amount}},
+        {"$inc": {"point_cap": -transaction_data.amount}}
+    )
+    if not drawn.modified_count:
         raise HTTPException(status_code=400, detail="Insufficient point cap")
     
     # Create transaction
@@ -386,92 +3467,217 @@ async def give_points(
         company_id=current_user.company_id
     )
     
-    await db.point_transactions.insert_one(transaction.dict())
-    
-    # Update recipient's points
-    await db.users.update_one(
-        {"id": transaction_data.to_user_id},
-        {"$inc": {"point_balance": transaction_data.amount}}
-    )
-    
-    # Update manager's point cap
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$inc": {"point_cap": -transaction_data.amount}}
-    )
+    # Record the award and credit the recipient; give the cap back if the row was not written
+    try:
+        await write_ledger(transaction, {transaction_data.to_user_id: {"point_balance": transaction_data.amount}})
+    except LedgerOutcomeUnknown:
+        raise
+    except Exception:
+        await db.users.update_one({"id": current_user.id}, {"$inc": {"point_cap": transaction_data.amount}})
+        raise
+    await bump_versions(f"profile:{transaction_data.to_user_id}", f"profile:{current_user.id}")
+    await emit_webhook_event(current_user.company_id, "points.awarded", transaction.model_dump())
+    await add_to_digest(transaction.to_user_id, current_user.company_id, {
+        "kind": "recognition", "amount": transaction.amount, "reason": transaction.reason, "from_name": current_user.name
+    }, points=transaction.amount)
     
     # Check and award badges
     await check_and_award_badges(transaction_data.to_user_id, current_user.company_id)
     
     return {"message": "Points awarded successfully", "transaction": transaction}
 
+@api_router.post("/points/give")
+async def give_points(
+    transaction_data: PointTransactionCreate,
+    current_user: User = Depends(get_current_user_fields("point_cap_renewal_type", "point_cap_renewal_period")),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key, "points_give", current_user.id, transaction_data.model_dump(),
+        lambda: award_points(transaction_data, current_user)
+    )
+
 @api_router.get("/points/transactions")
-async def get_transactions(current_user: User = Depends(get_current_user)):
-    # Get transactions for current user (given or received)
-    transactions = await db.point_transactions.find({
+async def get_transactions(
+    response: Response,
+    before: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Get transactions for current user (given or received), newest 100 first. The first
+    pages come from the hot ledger; X-Next-Before, when set, is the before value of the
+    next page, which reaches into archived years once the hot ledger runs out"""
+    if before and before.tzinfo:
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    transactions = await find_ledger({
         "$or": [
             {"from_user_id": current_user.id},
             {"to_user_id": current_user.id}
         ]
-    }).sort("created_at", -1).to_list(100)
+    }, limit=100, before=before)
+    
+    next_before = await ledger_page_cursor(transactions, 100, before)
+    if next_before:
+        response.headers["X-Next-Before"] = next_before.isoformat()
+    
+    return fast_json(await name_transactions(transactions, UserLookup()), response)
+
+async def name_transactions(transactions: List[Dict[str, Any]], users: UserLookup):
+    """Populate sender and recipient names and handle ObjectId"""
+    await users.load([t["from_user_id"] for t in transactions] + [t["to_user_id"] for t in transactions])
     
-    # Populate user names and handle ObjectId
     result = []
     for transaction in transactions:
         # Convert _id to string if it exists
         if "_id" in transaction and isinstance(transaction["_id"], ObjectId):
             transaction["_id"] = str(transaction["_id"])
             
-        from_user = await db.users.find_one({"id": transaction["from_user_id"]})
-        to_user = await db.users.find_one({"id": transaction["to_user_id"]})
-        transaction["from_user_name"] = from_user.get("name", "Unknown") if from_user else "Unknown"
-        transaction["to_user_name"] = to_user.get("name", "Unknown") if to_user else "Unknown"
+        transaction["from_user_name"] = users.name(transaction["from_user_id"])
+        transaction["to_user_name"] = users.name(transaction["to_user_id"])
         result.append(transaction)
     
     return result
 
 # User routes
+@api_router.get("/points/lots")
+async def get_point_lots(current_user: User = Depends(get_current_user_fields("point_balance"))):
+    """Get the current user's unspent point lots, soonest expiry first"""
+    lots = await db.point_lots.find(
+        {"user_id": current_user.id, "remaining": {"$gt": 0}},
+        {"_id": 0, "id": 1, "transaction_id": 1, "amount": 1, "remaining": 1, "awarded_at": 1, "expires_at": 1}
+    ).sort("expires_at", 1).to_list(500)
+    
+    return fast_json({"point_balance": current_user.point_balance, "lots": lots})
+
 @api_router.get("/users/team")
 async def get_team_members(current_user: User = Depends(get_current_user)):
     """Get direct reports for managers"""
     if current_user.role not in [UserRole.MANAGER, UserRole.COMPANY_ADMIN]:
         raise HTTPException(status_code=403, detail="Only managers can view team members")
     
+    return fast_json(await load_team_members(current_user))
+
+async def load_team_members(current_user: User):
     if current_user.role == UserRole.MANAGER:
         # Get direct reports
-        team_members = await db.users.find({
+        query = {
             "manager_id": current_user.id,
             "company_id": current_user.company_id,
             "is_active": True
-        }).to_list(100)
+        }
     else:
         # Company admin can see all employees
-        team_members = await db.users.find({
+        query = {
             "company_id": current_user.company_id,
             "is_active": True,
             "role": {"$ne": "company_admin"}
-        }).to_list(100)
+        }
     
-    # Remove password field and convert ObjectId to string
-    result = []
-    for member in team_members:
-        member.pop("password", None)
-        # Convert _id to string if it exists
-        if "_id" in member and isinstance(member["_id"], ObjectId):
-            member["_id"] = str(member["_id"])
-        result.append(member)
+    return await db.users.find(query, USER_RECORD_PROJECTION).to_list(100)
+
+def encode_directory_cursor(user: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([user["name"], user["id"]]).encode()).decode()
+
+def decode_directory_cursor(cursor: str):
+    try:
+        name, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return name, user_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@api_router.get("/users/directory")
+async def get_directory(
+    q: Optional[str] = None,
+    department: Optional[str] = None,
+    role: Optional[UserRole] = None,
+    company_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = DIRECTORY_PAGE_SIZE,
+    current_user: User = Depends(get_current_user)
+):
+    """Search the team roster or company directory by name or email prefix, a page at a time"""
+    if current_user.role not in [UserRole.MANAGER, UserRole.COMPANY_ADMIN, UserRole.SUPER_ADMIN]:
+        raise HTTPException(status_code=403, detail="Only managers can view the directory")
     
-    return result
+    limit = max(1, min(limit, DIRECTORY_MAX_PAGE_SIZE))
+    
+    # Super admins may browse any company; everyone else sees their own
+    if current_user.role == UserRole.SUPER_ADMIN:
+        if not company_id:
+            raise HTTPException(status_code=400, detail="company_id is required")
+    else:
+        company_id = current_user.company_id
+    
+    conditions = [{"company_id": company_id, "is_active": True}]
+    if current_user.role == UserRole.MANAGER:
+        conditions.append({"manager_id": current_user.id})
+    if department:
+        conditions.append({"department": department})
+    if role:
+        conditions.append({"role": role.value})
+    
+    # Prefix search as a collated range so it stays on the (company_id, name, id) index;
+    # U+FFFF sorts after every other character under the collation
+    if q and q.strip():
+        prefix = q.strip()
+        prefix_range = {"$gte": prefix, "$lt": prefix + "\uffff"}
+        if "@" in prefix:
+            conditions.append({"email": prefix_range})
+        else:
+            conditions.append({"$or": [{"name": prefix_range}, {"email": prefix_range}]})
+    
+    # Keyset pagination on (name, id)
+    if cursor:
+        last_name, last_id = decode_directory_cursor(cursor)
+        conditions.append({"$or": [
+            {"name": {"$gt": last_name}},
+            {"name": last_name, "id": {"$gt": last_id}}
+        ]})
+    
+    users = await db.users.find(
+        {"$and": conditions}, DIRECTORY_PROJECTION, collation=DIRECTORY_COLLATION
+    ).sort([("name", 1), ("id", 1)]).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = encode_directory_cursor(users[limit - 1]) if len(users) > limit else None
+    
+    return fast_json({"users": users[:limit], "next_cursor": next_cursor})
+
+PROFILE_SECTIONS = [
+    "employee", "manager", "company", "statistics", "point_transactions", "badges",
+    "recent_achievements", "recent_recognition"
+]
+DEFAULT_PROFILE_SECTIONS = PROFILE_SECTIONS[:6]
 
 @api_router.get("/users/{user_id}/profile")
-async def get_employee_profile(user_id: str, current_user: User = Depends(get_current_user)):
-    """Get comprehensive 360-degree employee profile"""
+async def get_employee_profile(
+    user_id: str,
+    request: Request,
+    response: Response,
+    fields: Optional[str] = None,
+    include: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Get comprehensive 360-degree employee profile
+
+    fields picks the sections to return (default: all but the recent_* slices)
+    and include adds sections to that set, e.g. ?fields=employee,statistics or
+    ?include=recent_recognition.
+    """
+    sections = set(fields.split(",")) if fields else set(DEFAULT_PROFILE_SECTIONS)
+    if include:
+        sections |= set(include.split(","))
+    sections = {section.strip() for section in sections if section.strip()}
+    unknown = sections - set(PROFILE_SECTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown profile sections: {', '.join(sorted(unknown))}")
     
     # Check if current user has permission to view this profile
     if current_user.role not in [UserRole.MANAGER, UserRole.COMPANY_ADMIN, UserRole.SUPER_ADMIN]:
         if current_user.id != user_id:
             raise HTTPException(status_code=403, detail="Insufficient permissions")
     
+    # Read the change counter before any profile data
+    profile_version, = await get_versions(f"profile:{user_id}")
+    
     # Get the employee
     employee_data = await db.users.find_one({"id": user_id})
     if not employee_data:
@@ -494,106 +3700,195 @@ async def get_employee_profile(user_id: str, current_user: User = Depends(get_cu
         if employee.manager_id != current_user.id and employee.id != current_user.id:
             raise HTTPException(status_code=403, detail="Can only view direct reports or own profile")
     
+    # Short-circuit before the heavy queries when the client's copy is current
+    catalog = await get_company_catalog(employee.company_id) if employee.company_id else None
+    # The selection is part of the tag, so a cached copy of other sections is never revalidated
+    etag = make_etag("profile", profile_version, catalog.version if catalog else 0, "+".join(sorted(sections)))
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    
+    profile = {}
+    
+    if "employee" in sections:
+        profile["employee"] = employee_data
+    
     # Get manager info
-    manager_info = None
-    if employee.manager_id:
-        manager_data = await db.users.find_one({"id": employee.manager_id})
-        if manager_data:
-            manager_info = {
-                "id": manager_data["id"],
-                "name": manager_data["name"],
-                "email": manager_data["email"]
-            }
+    if "manager" in sections:
+        manager_info = None
+        if employee.manager_id:
+            manager_data = await db.users.find_one({"id": employee.manager_id})
+            if manager_data:
+                manager_info = {
+                    "id": manager_data["id"],
+                    "name": manager_data["name"],
+                    "email": manager_data["email"]
+                }
+        profile["manager"] = manager_info
     
     # Get company info
-    company_info = None
-    if employee.company_id:
-        company_data = await db.companies.find_one({"id": employee.company_id})
-        if company_data:
+    if "company" in sections:
+        company_info = None
+        if catalog:
             company_info = {
-                "id": company_data["id"],
-                "name": company_data["name"],
-                "point_name": company_data["point_name"]
+                "id": catalog.company.id,
+                "name": catalog.company.name,
+                "point_name": catalog.company.point_name
             }
+        profile["company"] = company_info
     
-    # Get all point transactions for this employee
-    point_transactions = await db.point_transactions.find({
-        "to_user_id": user_id
-    }).sort("created_at", -1).to_list(100)
-    
-    # Populate sender names and handle ObjectId
-    for transaction in point_transactions:
-        if "_id" in transaction and isinstance(transaction["_id"], ObjectId):
-            transaction["_id"] = str(transaction["_id"])
-        
-        from_user = await db.users.find_one({"id": transaction["from_user_id"]})
-        transaction["from_user_name"] = from_user.get("name", "Unknown") if from_user else "Unknown"
-        transaction["from_user_role"] = from_user.get("role", "Unknown") if from_user else "Unknown"
+    # Get point transactions for this employee; statistics use the same window.
+    # Redemptions and expiries are debits, not recognition
+    recognition_query = {"to_user_id": user_id, "transaction_type": {"$nin": ["redemption", "expiry"]}}
+    point_transactions = []
+    if sections & {"statistics", "point_transactions"}:
+        point_transactions = await find_ledger(recognition_query, limit=100)
+    elif "recent_recognition" in sections:
+        point_transactions = await find_ledger(recognition_query, limit=10)
     
-    # Get all badges earned by this employee
-    user_badges = await db.user_badges.find({"user_id": user_id}).sort("earned_at", -1).to_list(100)
+    # Populate sender names only for rows that are returned
+    if sections & {"point_transactions", "recent_recognition"}:
+        shown = point_transactions if "point_transactions" in sections else point_transactions[:10]
+        users = UserLookup()
+        await users.load(transaction["from_user_id"] for transaction in shown)
+        for transaction in shown:
+            if "_id" in transaction and isinstance(transaction["_id"], ObjectId):
+                transaction["_id"] = str(transaction["_id"])
+            
+            transaction["from_user_name"] = users.name(transaction["from_user_id"])
+            transaction["from_user_role"] = users.role(transaction["from_user_id"])
     
+    # Get badges earned by this employee
     badges_with_details = []
-    for user_badge in user_badges:
-        if "_id" in user_badge and isinstance(user_badge["_id"], ObjectId):
-            user_badge["_id"] = str(user_badge["_id"])
+    if sections & {"badges", "recent_achievements"}:
+        badge_limit = 100 if "badges" in sections else 5
+        user_badges = await db.user_badges.find({"user_id": user_id}).sort("earned_at", -1).to_list(badge_limit)
         
-        badge = await db.badges.find_one({"id": user_badge["badge_id"]})
-        if badge:
-            if "_id" in badge and isinstance(badge["_id"], ObjectId):
-                badge["_id"] = str(badge["_id"])
-            
-            badges_with_details.append({
-                "earned_at": user_badge["earned_at"],
-                "badge": badge,
-                "awarded_by": user_badge.get("awarded_by")
-            })
+        for user_badge in user_badges:
+            badge = await get_badge(user_badge["badge_id"], employee.company_id)
+            if badge:
+                badges_with_details.append({
+                    "earned_at": user_badge["earned_at"],
+                    "badge": badge,
+                    "awarded_by": user_badge.get("awarded_by")
+                })
     
-    # Calculate points statistics
-    total_points_received = sum(t["amount"] for t in point_transactions)
-    points_by_month = {}
-    recognition_count = len(point_transactions)
-    
-    # Group transactions by month for analytics
-    for transaction in point_transactions:
-        month_key = transaction["created_at"].strftime("%Y-%m")
-        if month_key not in points_by_month:
-            points_by_month[month_key] = 0
-        points_by_month[month_key] += transaction["amount"]
-    
-    # Get recognition reasons breakdown
-    recognition_reasons = {}
-    for transaction in point_transactions:
-        reason = transaction.get("reason", "No reason provided")
-        if reason not in recognition_reasons:
-            recognition_reasons[reason] = {"count": 0, "total_points": 0}
-        recognition_reasons[reason]["count"] += 1
-        recognition_reasons[reason]["total_points"] += transaction["amount"]
-    
-    # Create comprehensive profile
-    profile = {
-        "employee": employee_data,
-        "manager": manager_info,
-        "company": company_info,
-        "statistics": {
+    if "statistics" in sections:
+        # Calculate points statistics
+        total_points_received = sum(t["amount"] for t in point_transactions)
+        points_by_month = {}
+        recognition_count = len(point_transactions)
+        
+        # Group transactions by month for analytics
+        for transaction in point_transactions:
+            month_key = transaction["created_at"].strftime("%Y-%m")
+            if month_key not in points_by_month:
+                points_by_month[month_key] = 0
+            points_by_month[month_key] += transaction["amount"]
+        
+        # Get recognition reasons breakdown
+        recognition_reasons = {}
+        for transaction in point_transactions:
+            reason = transaction.get("reason", "No reason provided")
+            if reason not in recognition_reasons:
+                recognition_reasons[reason] = {"count": 0, "total_points": 0}
+            recognition_reasons[reason]["count"] += 1
+            recognition_reasons[reason]["total_points"] += transaction["amount"]
+        
+        if "badges" in sections:
+            badges_earned = len(badges_with_details)
+        else:
+            badges_earned = await db.user_badges.count_documents({"user_id": user_id})
+        
+        profile["statistics"] = {
             "total_points_received": total_points_received,
             "current_balance": employee.point_balance,
-            "badges_earned": len(badges_with_details),
+            "badges_earned": badges_earned,
             "recognition_count": recognition_count,
             "points_by_month": points_by_month,
             "recognition_reasons": recognition_reasons
-        },
-        "point_transactions": point_transactions,
-        "badges": badges_with_details,
-        "recent_achievements": badges_with_details[:5],  # Last 5 badges
-        "recent_recognition": point_transactions[:10]    # Last 10 recognitions
-    }
+        }
+    
+    if "point_transactions" in sections:
+        profile["point_transactions"] = point_transactions
+    if "badges" in sections:
+        profile["badges"] = badges_with_details
+    # The recent_* slices repeat rows of the full lists, so they are opt-in
+    if "recent_achievements" in sections:
+        profile["recent_achievements"] = badges_with_details[:5]  # Last 5 badges
+    if "recent_recognition" in sections:
+        profile["recent_recognition"] = point_transactions[:10]    # Last 10 recognitions
+    
+    return fast_json(profile, response)
+
+@api_router.post("/users/{user_id}/deactivate")
+async def deactivate_user(user_id: str, current_user: User = Depends(get_current_user)):
+    """Deactivate a user; their sessions end within REVOCATION_SYNC_SECONDS on every worker"""
+    if current_user.role not in [UserRole.COMPANY_ADMIN, UserRole.SUPER_ADMIN]:
+        raise HTTPException(status_code=403, detail="Only company admins can deactivate users")
+    if user_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Cannot deactivate yourself")
+    
+    query = {"id": user_id}
+    if current_user.role != UserRole.SUPER_ADMIN:
+        query["company_id"] = current_user.company_id
+    result = await db.users.update_one(query, {"$set": {"is_active": False}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    await revoke_user(user_id)
+    await bump_versions(f"profile:{user_id}")
+    
+    return {"message": "User deactivated"}
+
+@api_router.get("/users/{user_id}/balance")
+async def get_balance_as_of(
+    user_id: str,
+    as_of: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Get a user's point balance and remaining point cap at a past moment"""
+    if current_user.role not in [UserRole.MANAGER, UserRole.COMPANY_ADMIN, UserRole.SUPER_ADMIN]:
+        if current_user.id != user_id:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    user = await db.users.find_one(
+        {"id": user_id}, {"_id": 0, "id": 1, "company_id": 1, "manager_id": 1, "point_cap_renewed_at": 1}
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    return profile
+    if current_user.role != UserRole.SUPER_ADMIN and user.get("company_id") != current_user.company_id:
+        raise HTTPException(status_code=403, detail="Can only view users in same company")
+    if current_user.role == UserRole.MANAGER and user.get("manager_id") != current_user.id and user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Can only view direct reports or own balance")
+    
+    # Compare naive UTC datetimes, as stored
+    as_of = as_of or datetime.utcnow()
+    if as_of.tzinfo:
+        as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    balance = (await balances_as_of([user], as_of))[user_id]
+    
+    return {"user_id": user_id, "as_of": as_of, **balance}
 
 @api_router.get("/users/badges")
-async def get_user_badges(current_user: User = Depends(get_current_user)):
+async def get_user_badges(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user)
+):
     """Get badges earned by current user"""
+    badges_version, = await get_versions(f"user_badges:{current_user.id}")
+    catalog = await get_company_catalog(current_user.company_id) if current_user.company_id else None
+    etag = make_etag("badges", badges_version, catalog.version if catalog else 0)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    
+    return fast_json(await load_user_badges(current_user), response)
+
+async def load_user_badges(current_user: User):
     # Get user badges
     user_badges = await db.user_badges.find({"user_id": current_user.id}).to_list(100)
     
@@ -604,12 +3899,8 @@ async def get_user_badges(current_user: User = Depends(get_current_user)):
         if "_id" in user_badge and isinstance(user_badge["_id"], ObjectId):
             user_badge["_id"] = str(user_badge["_id"])
             
-        badge = await db.badges.find_one({"id": user_badge["badge_id"]})
+        badge = await get_badge(user_badge["badge_id"], current_user.company_id)
         if badge:
-            # Convert badge _id to string if it exists
-            if "_id" in badge and isinstance(badge["_id"], ObjectId):
-                badge["_id"] = str(badge["_id"])
-                
             badges_with_details.append({
                 "earned_at": user_badge["earned_at"],
                 "badge": badge
@@ -617,9 +3908,41 @@ async def get_user_badges(current_user: User = Depends(get_current_user)):
     
     return badges_with_details
 
+@api_router.get("/users/badges/progress")
+async def get_badge_progress(current_user: User = Depends(get_current_user_fields("point_balance"))):
+    """Get the next points badge and the points remaining to earn it"""
+    catalog = await get_company_catalog(current_user.company_id) if current_user.company_id else None
+    ladder = catalog.points_badges if catalog else []
+    thresholds = catalog.points_thresholds if catalog else []
+
+    # The balance is the route's one Mongo read: access tokens carry only identity
+    # claims, and a balance claim would be stale as soon as points moved
+    balance = current_user.point_balance
+    reached = bisect.bisect_right(thresholds, balance)
+    current_badge = ladder[reached - 1] if reached else None
+    next_badge = ladder[reached] if reached < len(ladder) else None
+    
+    progress = {
+        "point_balance": balance,
+        "current_badge": current_badge,
+        "next_badge": next_badge,
+        "points_remaining": 0,
+        "progress_percent": 100
+    }
+    if next_badge:
+        floor = thresholds[reached - 1] if reached else 0
+        span = max(thresholds[reached] - floor, 1)
+        progress["points_remaining"] = thresholds[reached] - balance
+        progress["progress_percent"] = round(100 * (balance - floor) / span)
+    
+    return fast_json(progress)
+
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
+async def get_dashboard_stats(current_user: User = Depends(get_current_user_fields("point_balance", "point_cap"))):
     """Get dashboard statistics"""
+    return fast_json(await load_dashboard_stats(current_user, UserLookup()))
+
+async def load_dashboard_stats(current_user: User, users: UserLookup):
     stats = {
         "point_balance": current_user.point_balance,
         "point_cap": current_user.point_cap,
@@ -648,30 +3971,39 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
         stats["team_size"] = team_size
     
     # Get recent transactions
-    recent_transactions = await db.point_transactions.find({
+    recent_transactions = await find_ledger({
         "$or": [
             {"from_user_id": current_user.id},
             {"to_user_id": current_user.id}
         ]
-    }).sort("created_at", -1).limit(5).to_list(5)
-    
-    # Populate user names and handle ObjectId
-    processed_transactions = []
-    for transaction in recent_transactions:
-        # Convert _id to string if it exists
-        if "_id" in transaction and isinstance(transaction["_id"], ObjectId):
-            transaction["_id"] = str(transaction["_id"])
-            
-        from_user = await db.users.find_one({"id": transaction["from_user_id"]})
-        to_user = await db.users.find_one({"id": transaction["to_user_id"]})
-        transaction["from_user_name"] = from_user.get("name", "Unknown") if from_user else "Unknown"
-        transaction["to_user_name"] = to_user.get("name", "Unknown") if to_user else "Unknown"
-        processed_transactions.append(transaction)
+    }, limit=5)
     
-    stats["recent_transactions"] = processed_transactions
+    stats["recent_transactions"] = await name_transactions(recent_transactions, users)
     
     return stats
 
+@api_router.get("/bootstrap")
+async def get_bootstrap(current_user: User = Depends(get_current_user_record)):
+    """Everything the frontend loads after login, fetched concurrently in one round trip"""
+    users = UserLookup()
+    loads = [
+        load_dashboard_stats(current_user, users),
+        load_user_badges(current_user),
+        load_tasks(current_user, users)
+    ]
+    if current_user.role in [UserRole.MANAGER, UserRole.COMPANY_ADMIN]:
+        loads.append(load_team_members(current_user))
+    
+    stats, badges, tasks, *team = await asyncio.gather(*loads)
+    
+    return fast_json({
+        "user": current_user,
+        "stats": stats,
+        "badges": badges,
+        "tasks": tasks,
+        "team": team[0] if team else []
+    })
+
 # Task routes
 @api_router.post("/tasks", response_model=Task)
 async def create_task(task_data: TaskCreate, current_user: User = Depends(get_current_user)):
@@ -689,13 +4021,27 @@ async def create_task(task_data: TaskCreate, current_user: User = Depends(get_cu
         created_by=current_user.id
     )
     
-    await db.tasks.insert_one(task.dict())
+    await db.tasks.insert_one(task.model_dump())
+    await bump_versions(f"tasks:{current_user.company_id}")
     
     return task
 
 @api_router.get("/tasks")
-async def get_tasks(current_user: User = Depends(get_current_user)):
+async def get_tasks(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user)
+):
     """Get tasks for current user's company"""
+    tasks_version, = await get_versions(f"tasks:{current_user.company_id}")
+    etag = make_etag("tasks", tasks_version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+    
+    return fast_json(await load_tasks(current_user, UserLookup()), response)
+
+async def load_tasks(current_user: User, users: UserLookup):
     # Get tasks for the company
     tasks = await db.tasks.find({
         "company_id": current_user.company_id,
@@ -703,19 +4049,18 @@ async def get_tasks(current_user: User = Depends(get_current_user)):
     }).sort("created_at", -1).to_list(100)
     
     # Populate creator names and handle ObjectId
+    await users.load(task["created_by"] for task in tasks)
     result = []
     for task in tasks:
         if "_id" in task and isinstance(task["_id"], ObjectId):
             task["_id"] = str(task["_id"])
         
-        creator = await db.users.find_one({"id": task["created_by"]})
-        task["created_by_name"] = creator.get("name", "Unknown") if creator else "Unknown"
+        task["created_by_name"] = users.name(task["created_by"])
         result.append(task)
     
     return result
 
-@api_router.post("/tasks/{task_id}/complete")
-async def complete_task(task_id: str, current_user: User = Depends(get_current_user)):
+async def complete_task_for_user(task_id: str, current_user: User):
     """Mark task as completed and award points"""
     # Get the task
     task_data = await db.tasks.find_one({"id": task_id})
@@ -733,11 +4078,12 @@ async def complete_task(task_id: str, current_user: User = Depends(get_current_u
         raise HTTPException(status_code=400, detail="Task is no longer active")
     
     # Check if user already completed this task
-    existing_completion = await db.point_transactions.find_one({
+    # A completion cannot predate the task, so older archives are skipped
+    existing_completion = await find_one_ledger({
         "to_user_id": current_user.id,
         "transaction_type": "task_completion",
         "reason": f"Task completed: {task.title}"
-    })
+    }, since=task.created_at)
     
     if existing_completion:
         raise HTTPException(status_code=400, detail="You have already completed this task")
@@ -752,22 +4098,330 @@ async def complete_task(task_id: str, current_user: User = Depends(get_current_u
         transaction_type="task_completion"
     )
     
-    await db.point_transactions.insert_one(transaction.dict())
-    
-    # Update user's points
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$inc": {"point_balance": task.points_reward}}
-    )
+    # Record the completion and update user's points
+    await write_ledger(transaction, {current_user.id: {"point_balance": task.points_reward}})
+    await bump_versions(f"profile:{current_user.id}")
+    if DIGESTS_ENABLED:
+        creator = UserLookup()
+        await creator.load([task.created_by])
+        await add_to_digest(current_user.id, current_user.company_id, {
+            "kind": "recognition", "amount": transaction.amount, "reason": transaction.reason,
+            "from_name": creator.name(task.created_by)
+        }, points=transaction.amount)
+    await emit_webhook_event(current_user.company_id, "task.completed", {
+        "task_id": task.id, "task_title": task.title, "user_id": current_user.id,
+        "points_awarded": task.points_reward, "transaction_id": transaction.id
+    })
     
     # Check and award badges
     await check_and_award_badges(current_user.id, current_user.company_id)
     
     return {"message": "Task completed successfully", "points_awarded": task.points_reward}
 
+@api_router.post("/tasks/{task_id}/complete")
+async def complete_task(
+    task_id: str,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Mark task as completed and award points"""
+    return await run_idempotent(
+        idempotency_key, "tasks_complete", current_user.id, {"task_id": task_id},
+        lambda: complete_task_for_user(task_id, current_user)
+    )
+
+# Reward routes
+@api_router.post("/rewards", response_model=Reward)
+async def create_reward(reward_data: RewardCreate, current_user: User = Depends(get_current_user)):
+    """Add a reward to the company catalog"""
+    if current_user.role != UserRole.COMPANY_ADMIN:
+        raise HTTPException(status_code=403, detail="Only company admins can create rewards")
+    if reward_data.points_cost <= 0:
+        raise HTTPException(status_code=400, detail="Points cost must be positive")
+    if reward_data.stock is not None and reward_data.stock < 0:
+        raise HTTPException(status_code=400, detail="Stock cannot be negative")
+    
+    reward = Reward(**reward_data.model_dump(), company_id=current_user.company_id, created_by=current_user.id)
+    await db.rewards.insert_one(reward.model_dump())
+    
+    return reward
+
+@api_router.get("/rewards")
+async def get_rewards(current_user: User = Depends(get_current_user)):
+    """Get the active rewards of the current user's company, cheapest first"""
+    rewards = await db.rewards.find(
+        {"company_id": current_user.company_id, "is_active": True}, {"_id": 0}
+    ).sort("points_cost", 1).to_list(500)
+    
+    return fast_json(rewards)
+
+@api_router.get("/rewards/redemptions")
+async def get_redemptions(current_user: User = Depends(get_current_user)):
+    """Get the current user's redemptions, newest first"""
+    redemptions = await db.redemptions.find(
+        {"user_id": current_user.id}, {"_id": 0}
+    ).sort("created_at", -1).to_list(100)
+    
+    return fast_json(redemptions)
+
+async def redeem_reward(reward_id: str, current_user: User):
+    """Debit the cost, then reserve one unit of stock, each with a single conditional update"""
+    reward = await db.rewards.find_one(
+        {"id": reward_id, "company_id": current_user.company_id, "is_active": True}, {"_id": 0}
+    )
+    if not reward:
+        raise HTTPException(status_code=404, detail="Reward not found")
+    limited = reward.get("stock") is not None
+    if limited and reward["stock"] <= 0:
+        raise HTTPException(status_code=409, detail="Reward is out of stock")
+    
+    # Draw on unexpired lots first: points past their expiry still count in
+    # point_balance until the sweep runs, but cannot be spent
+    uncovered, draws = await consume_point_lots(current_user.id, reward["points_cost"])
+    if uncovered:
+        await restore_point_lots(current_user.id, draws)
+        raise HTTPException(status_code=400, detail="Insufficient point balance")
+    
+    # Debit only while the balance covers the cost
+    try:
+        debit = await db.users.update_one(
+            {"id": current_user.id, "point_balance": {"$gte": reward["points_cost"]}},
+            {"$inc": {"point_balance": -reward["points_cost"]}}
+        )
+    except Exception:
+        await restore_point_lots(current_user.id, draws)
+        raise
+    if debit.modified_count == 0:
+        logger.warning(f"User {current_user.id} has unspent lots but a balance below {reward['points_cost']}")
+        await restore_point_lots(current_user.id, draws)
+        raise HTTPException(status_code=400, detail="Insufficient point balance")
+    
+    # Stock is only taken by callers who have already paid, so users who cannot
+    # afford the reward never hold a unit; unlimited rewards skip the reservation.
+    # A negative ledger row keeps ledger-derived balances (reconciliation, snapshots) correct
+    transaction = PointTransaction(
+        from_user_id=current_user.id,
+        to_user_id=current_user.id,
+        amount=-reward["points_cost"],
+        reason=f"Redeemed: {reward['name']}",
+        company_id=current_user.company_id,
+        transaction_type="redemption"
+    )
+    reserved = ledger_written = False
+    try:
+        if limited:
+            reservation = await db.rewards.update_one(
+                {"id": reward_id, "company_id": current_user.company_id, "is_active": True, "stock": {"$gt": 0}},
+                {"$inc": {"stock": -1}}
+            )
+            if reservation.modified_count == 0:
+                raise HTTPException(status_code=409, detail="Reward is out of stock")
+            reserved = True
+        
+        await write_ledger(transaction, {})
+        ledger_written = True
+        
+        redemption = Redemption(
+            reward_id=reward_id,
+            reward_name=reward["name"],
+            user_id=current_user.id,
+            company_id=current_user.company_id,
+            points_cost=reward["points_cost"],
+            transaction_id=transaction.id
+        )
+        await db.redemptions.insert_one(redemption.model_dump())
+    except LedgerOutcomeUnknown:
+        # The debit row may have landed, so undoing could refund a recorded debit;
+        # reconciliation settles the balance against whatever the ledger holds
+        logger.error("Redemption of %s by %s left as is: ledger write outcome unknown", reward_id, current_user.id)
+        raise
+    except Exception:
+        # The idempotency key is released on failure, so a retry must find nothing half-done
+        await undo_redemption(current_user, reward, draws, reserved, transaction if ledger_written else None)
+        raise
+    
+    try:
+        await bump_versions(f"profile:{current_user.id}")
+    except PyMongoError as e:
+        # The redemption stands; a stale profile ETag is not worth failing (and retrying) it
+        logger.warning(f"Could not bump profile version of {current_user.id} after redemption: {e}")
+    
+    return {"message": "Reward redeemed successfully", "redemption": redemption}
+
+async def undo_redemption(current_user: User, reward: Dict[str, Any], draws: List[Any], reserved: bool,
+                          transaction: Optional[PointTransaction]):
+    """Compensate a redemption that failed after its debit: reverse the ledger row if it was
+    written, re-credit the balance, put the lots back and release the reserved unit"""
+    try:
+        if transaction:
+            await write_ledger(PointTransaction(
+                from_user_id=current_user.id,
+                to_user_id=current_user.id,
+                amount=reward["points_cost"],
+                reason=f"Redemption reversed: {reward['name']}",
+                company_id=current_user.company_id,
+                transaction_type="redemption"
+            ), {})
+        await db.users.update_one({"id": current_user.id}, {"$inc": {"point_balance": reward["points_cost"]}})
+        await restore_point_lots(current_user.id, draws)
+        if reserved:
+            await db.rewards.update_one({"id": reward["id"]}, {"$inc": {"stock": 1}})
+    except Exception:
+        # The original error still reaches the caller; reconciliation reports what is left over
+        logger.exception(f"Could not undo redemption of {reward['id']} by {current_user.id}")
+
+@api_router.post("/rewards/{reward_id}/redeem")
+async def redeem(
+    reward_id: str,
+    current_user: User = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """Redeem a reward for points"""
+    return await run_idempotent(
+        idempotency_key, "rewards_redeem", current_user.id, {"reward_id": reward_id},
+        lambda: redeem_reward(reward_id, current_user)
+    )
+
+# Webhook routes
+@api_router.post("/webhooks")
+async def create_webhook(webhook_data: WebhookEndpointCreate, current_user: User = Depends(get_current_user)):
+    """Register an endpoint for the company's events; the signing secret is only shown here"""
+    if current_user.role != UserRole.COMPANY_ADMIN:
+        raise HTTPException(status_code=403, detail="Only company admins can manage webhooks")
+    try:
+        await resolve_webhook_destination(webhook_data.url)
+    except WebhookDestinationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    unknown = set(webhook_data.events) - WEBHOOK_EVENTS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown webhook events: {', '.join(sorted(unknown))}")
+    
+    endpoint = WebhookEndpoint(**webhook_data.model_dump(), company_id=current_user.company_id, created_by=current_user.id)
+    await db.webhook_endpoints.insert_one(endpoint.model_dump())
+    webhook_endpoint_cache.pop(current_user.company_id, None)
+    
+    return endpoint
+
+@api_router.get("/webhooks")
+async def get_webhooks(current_user: User = Depends(get_current_user)):
+    """List the company's active webhook endpoints, without their secrets"""
+    if current_user.role != UserRole.COMPANY_ADMIN:
+        raise HTTPException(status_code=403, detail="Only company admins can manage webhooks")
+    endpoints = await db.webhook_endpoints.find(
+        {"company_id": current_user.company_id, "is_active": True}, {"_id": 0, "secret": 0}
+    ).to_list(100)
+    
+    return fast_json(endpoints)
+
+@api_router.delete("/webhooks/{webhook_id}")
+async def delete_webhook(webhook_id: str, current_user: User = Depends(get_current_user)):
+    """Deactivate an endpoint; its undelivered events are dropped at the next claim"""
+    if current_user.role != UserRole.COMPANY_ADMIN:
+        raise HTTPException(status_code=403, detail="Only company admins can manage webhooks")
+    result = await db.webhook_endpoints.update_one(
+        {"id": webhook_id, "company_id": current_user.company_id, "is_active": True},
+        {"$set": {"is_active": False}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Webhook not found")
+    webhook_endpoint_cache.pop(current_user.company_id, None)
+    
+    return {"message": "Webhook deleted"}
+
+# Admin routes
+@api_router.post("/admin/reconciliation")
+async def start_reconciliation(
+    request: ReconciliationRequest,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_user)
+):
+    """Reconcile point balances and caps against the ledger in the background"""
+    if current_user.role not in [UserRole.SUPER_ADMIN, UserRole.COMPANY_ADMIN]:
+        raise HTTPException(status_code=403, detail="Only admins can run reconciliation")
+
+    company_id = request.company_id
+    if current_user.role == UserRole.COMPANY_ADMIN:
+        if company_id and company_id != current_user.company_id:
+            raise HTTPException(status_code=403, detail="Can only reconcile your own company")
+        company_id = current_user.company_id
+
+    report_id = str(uuid.uuid4())
+    background_tasks.add_task(reconcile_balances, company_id, request.repair, report_id)
+
+    return {"message": "Reconciliation started", "report_id": report_id}
+
+@api_router.get("/admin/reconciliation/{report_id}")
+async def get_reconciliation_report(report_id: str, current_user: User = Depends(get_current_user)):
+    """Get a reconciliation drift report"""
+    if current_user.role not in [UserRole.SUPER_ADMIN, UserRole.COMPANY_ADMIN]:
+        raise HTTPException(status_code=403, detail="Only admins can view reconciliation reports")
+
+    report = await db.reconciliation_reports.find_one({"id": report_id}, {"_id": 0})
+    if not report:
+        raise HTTPException(status_code=404, detail="Report not found")
+
+    if current_user.role == UserRole.COMPANY_ADMIN and report.get("company_id") != current_user.company_id:
+        raise HTTPException(status_code=403, detail="Can only view reports for your own company")
+
+    return report
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: str, format: str = "json", current_user: User = Depends(get_current_user)):
+    """Get a stored request profile; format=folded returns the flame graph input as text"""
+    if current_user.role != UserRole.SUPER_ADMIN:
+        raise HTTPException(status_code=403, detail="Only super admins can view request profiles")
+
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    if format == "folded":
+        return PlainTextResponse(profile["folded"])
+    return fast_json(profile)
+
+@api_router.get("/admin/slow-queries")
+async def get_slow_queries(hours: int = 24, limit: int = 50, current_user: User = Depends(get_current_user)):
+    """Slow query shapes from the last hours, worst total time first, with their latest explain"""
+    if current_user.role != UserRole.SUPER_ADMIN:
+        raise HTTPException(status_code=403, detail="Only super admins can view slow queries")
+
+    since = datetime.utcnow() - timedelta(hours=hours)
+    shapes = await db.slow_queries.aggregate([
+        {"$match": {"at": {"$gte": since}}},
+        # Sorting explained rows last makes $last pick the newest explain of each shape
+        {"$addFields": {"explained": {"$cond": [{"$ifNull": ["$explain", False]}, 1, 0]}}},
+        {"$sort": {"explained": 1, "at": 1}},
+        {"$group": {
+            "_id": "$shape_hash",
+            "command": {"$first": "$command"},
+            "collection": {"$first": "$collection"},
+            "shape": {"$first": "$shape"},
+            "routes": {"$addToSet": {"$concat": [{"$ifNull": ["$method", ""]}, " ", "$route"]}},
+            "count": {"$sum": 1},
+            "total_ms": {"$sum": "$duration_ms"},
+            "max_ms": {"$max": "$duration_ms"},
+            "last_seen": {"$max": "$at"},
+            "explain": {"$last": "$explain"}
+        }},
+        {"$sort": {"total_ms": -1}},
+        {"$limit": max(1, min(limit, 500))},
+        {"$project": {"_id": 0, "shape_hash": "$_id", "command": 1, "collection": 1, "shape": 1, "routes": 1,
+                      "count": 1, "total_ms": 1, "max_ms": 1, "avg_ms": {"$divide": ["$total_ms", "$count"]},
+                      "last_seen": 1, "explain": 1}}
+    ]).to_list(None)
+
+    return fast_json({"since": since, "threshold_ms": SLOW_QUERY_THRESHOLD_MS, "dropped": slow_query_listener.dropped, "shapes": shapes})
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Added before admission control so it wraps only admitted requests
+app.add_middleware(RequestScopeMiddleware)
+
+app.add_middleware(RequestProfilingMiddleware)
+
+app.add_middleware(AdmissionControlMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -783,6 +4437,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_scheduler():
+    await ensure_indexes()
+    if not SCHEDULER_ENABLED:
+        return
+    for name, interval_seconds, job in SCHEDULED_JOBS:
+        scheduler_tasks.append(asyncio.create_task(run_periodic_job(name, interval_seconds, job)))
+
+@app.on_event("startup")
+async def start_revocation_sync():
+    await revocations.sync()
+    revocation_tasks.append(asyncio.create_task(run_revocation_sync()))
+
+@app.on_event("startup")
+async def start_cache_invalidation_bus():
+    if CACHE_BUS_ENABLED:
+        cache_bus_tasks.append(asyncio.create_task(run_cache_invalidation_bus()))
+
+@app.on_event("startup")
+async def start_slow_query_recorder():
+    if SLOW_QUERY_ENABLED:
+        slow_query_tasks.append(asyncio.create_task(run_slow_query_recorder()))
+
+@app.on_event("startup")
+async def start_webhook_dispatcher():
+    if WEBHOOKS_ENABLED:
+        webhook_tasks.append(asyncio.create_task(webhook_dispatcher.run()))
+
+@app.on_event("shutdown")
+async def stop_webhook_dispatcher():
+    for task in webhook_tasks:
+        task.cancel()
+    await asyncio.gather(*webhook_tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def stop_slow_query_recorder():
+    for task in slow_query_tasks:
+        task.cancel()
+    await asyncio.gather(*slow_query_tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def stop_revocation_sync():
+    for task in revocation_tasks:
+        task.cancel()
+    await asyncio.gather(*revocation_tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def stop_cache_invalidation_bus():
+    for task in cache_bus_tasks:
+        task.cancel()
+    await asyncio.gather(*cache_bus_tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    for task in scheduler_tasks:
+        task.cancel()
+    await asyncio.gather(*scheduler_tasks, return_exceptions=True)
+    for name, _, _ in SCHEDULED_JOBS:
+        await release_leader_lock(name)
+
+@app.on_event("shutdown")
+async def flush_ledger_writes():
+    await ledger_writer.drain()
+
+@app.on_event("shutdown")
+async def close_smtp_pool():
+    await asyncio.to_thread(smtp_pool.close)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
\ No newline at end of file
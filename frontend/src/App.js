@@ -5,6 +5,39 @@ import axios from "axios";
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Access tokens are short-lived; a 401 triggers one refresh, shared by all
+// requests that fail while it is in flight, and the request is retried
+let refreshInFlight = null;
+
+const storeTokens = (token, refreshToken) => {
+  localStorage.setItem('token', token);
+  localStorage.setItem('refreshToken', refreshToken);
+  axios.defaults.headers.common['Authorization'] = `Bearer ${token}`;
+};
+
+const refreshAccessToken = () => {
+  if (!refreshInFlight) {
+    const refreshToken = localStorage.getItem('refreshToken');
+    refreshInFlight = axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken })
+      .then((response) => {
+        storeTokens(response.data.token, response.data.refresh_token);
+        return response.data.token;
+      })
+      .catch((error) => {
+        // Another tab may have rotated the refresh token first
+        const latest = localStorage.getItem('refreshToken');
+        if (latest && latest !== refreshToken) {
+          return localStorage.getItem('token');
+        }
+        throw error;
+      })
+      .finally(() => {
+        refreshInFlight = null;
+      });
+  }
+  return refreshInFlight;
+};
+
 // Auth Context
 const AuthContext = createContext();
 
@@ -30,6 +63,29 @@ const AuthProvider = ({ children }) => {
     }
   }, [token]);
 
+  useEffect(() => {
+    const interceptor = axios.interceptors.response.use(
+      (response) => response,
+      async (error) => {
+        const original = error.config;
+        const isAuthCall = original && /\/auth\/(login|refresh|logout)$/.test(original.url);
+        if (error.response?.status !== 401 || !original || original._retried || isAuthCall || !localStorage.getItem('refreshToken')) {
+          return Promise.reject(error);
+        }
+        original._retried = true;
+        try {
+          const newToken = await refreshAccessToken();
+          original.headers['Authorization'] = `Bearer ${newToken}`;
+          return axios(original);
+        } catch (refreshError) {
+          logout();
+          return Promise.reject(error);
+        }
+      }
+    );
+    return () => axios.interceptors.response.eject(interceptor);
+  }, []);
+
   const fetchCurrentUser = async () => {
     try {
       const response = await axios.get(`${API}/auth/me`);
@@ -45,12 +101,11 @@ const AuthProvider = ({ children }) => {
   const login = async (email, password) => {
     try {
       const response = await axios.post(`${API}/auth/login`, { email, password });
-      const { token: newToken, user: userData } = response.data;
+      const { token: newToken, refresh_token: refreshToken, user: userData } = response.data;
       
-      localStorage.setItem('token', newToken);
+      storeTokens(newToken, refreshToken);
       setToken(newToken);
       setUser(userData);
-      axios.defaults.headers.common['Authorization'] = `Bearer ${newToken}`;
       
       return true;
     } catch (error) {
@@ -60,7 +115,13 @@ const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    const refreshToken = localStorage.getItem('refreshToken');
+    if (axios.defaults.headers.common['Authorization']) {
+      // Best effort: the server revokes the access token and ends the refresh session
+      axios.post(`${API}/auth/logout`, { refresh_token: refreshToken }).catch(() => {});
+    }
     localStorage.removeItem('token');
+    localStorage.removeItem('refreshToken');
     setToken(null);
     setUser(null);
     delete axios.defaults.headers.common['Authorization'];
@@ -202,20 +263,15 @@ const Dashboard = () => {
     return departmentTeams;
   };
 
+  const fetchDashboardData = async () => {
     try {
-      const [statsRes, badgesRes] = await Promise.all([
-        axios.get(`${API}/dashboard/stats`),
-        axios.get(`${API}/users/badges`)
-      ]);
-
-      setStats(statsRes.data);
-      setBadges(badgesRes.data);
-
-      // Fetch team members if user is a manager
-      if (user.role === 'manager' || user.role === 'company_admin') {
-        const teamRes = await axios.get(`${API}/users/team`);
-        setTeamMembers(teamRes.data);
-      }
+      // One round trip for stats, badges, tasks and (for managers) the team
+      const response = await axios.get(`${API}/bootstrap`);
+
+      setStats(response.data.stats);
+      setBadges(response.data.badges);
+      setTasks(response.data.tasks);
+      setTeamMembers(response.data.team);
     } catch (error) {
       console.error('Failed to fetch dashboard data:', error);
     }
@@ -1101,7 +1157,7 @@ const Dashboard = () => {
                     <div className="bg-gray-50 rounded-xl p-4">
                       <h3 className="text-lg font-bold text-gray-900 mb-4">Recent Recognition</h3>
                       <div className="space-y-3 max-h-80 overflow-y-auto">
-                        {selectedEmployeeProfile.recent_recognition.slice(0, 5).map((recognition, index) => (
+                        {selectedEmployeeProfile.point_transactions.slice(0, 5).map((recognition, index) => (
                           <div key={index} className="bg-white border-l-4 border-blue-500 rounded-r-lg p-3">
                             <div className="flex justify-between items-start">
                               <div className="flex-1">
@@ -1121,7 +1177,7 @@ const Dashboard = () => {
                             </div>
                           </div>
                         ))}
-                        {selectedEmployeeProfile.recent_recognition.length === 0 && (
+                        {selectedEmployeeProfile.point_transactions.length === 0 && (
                           <p className="text-gray-500 text-center py-8">No recognition yet</p>
                         )}
                       </div>
@@ -0,0 +1,582 @@
+"""Shared test setup: backend/server.py on the import path, a command counter
+for the query budgets and in-memory stand-ins for the Mongo collections.
+
+The stand-ins apply the filters, updates, bulk writes and aggregation stages
+server.py sends, evaluated the way MongoDB would, so routes and jobs can run
+without a MongoDB. Tests never use the environment's DB_NAME: the query
+budgets drop their database, so it is always QUERY_BUDGET_DB_NAME.
+"""
+import copy
+import json
+import os
+import re
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("QUERY_BUDGET_DB_NAME", "effydoc_query_budgets")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# Handshake and monitoring traffic is not a query the route made, and cursor cleanup
+# runs on the driver's background thread whenever an earlier cursor is collected
+IGNORED_COMMANDS = {
+    "hello", "ismaster", "isMaster", "ping", "endSessions", "saslStart", "saslContinue", "buildInfo", "killCursors"
+}
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Records commands sent while recording is on"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.commands = []
+
+    def started(self, event):
+        if not self.recording or event.command_name in IGNORED_COMMANDS:
+            return
+        target = event.command.get(event.command_name)
+        shape = {key: event.command[key] for key in ("filter", "query", "pipeline", "updates", "deletes") if key in event.command}
+        with self.lock:
+            self.commands.append(f"{event.command_name} {target}: {json.dumps(shape, default=str)[:300]}")
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def start(self):
+        with self.lock:
+            self.commands = []
+            self.recording = True
+
+    def stop(self):
+        with self.lock:
+            self.recording = False
+            return list(self.commands)
+
+
+# Clients pick up registered listeners when they are created, so this has to happen
+# before any test module imports server.py
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
+import server  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def mongo_commands():
+    return command_counter
+
+
+class Result:
+    """The counts of pymongo's insert, update, delete and bulk write results"""
+
+    def __init__(self, matched=0, modified=None, upserted_id=None, deleted=0, inserted=0, upserted=0):
+        self.matched_count = matched
+        self.modified_count = matched if modified is None else modified
+        self.upserted_id = upserted_id
+        self.deleted_count = deleted
+        self.inserted_count = inserted
+        self.upserted_count = upserted
+        self.inserted_id = upserted_id
+
+
+class Cursor:
+    """Motor cursor over documents already read: sort, skip, limit, to_list and async iteration"""
+
+    def __init__(self, documents, projection=None, collation=None):
+        self.documents = documents
+        self.projection = projection
+        self.collation = collation
+        self.skipped = 0
+        self.limited = 0
+
+    def sort(self, key_or_list, direction=None):
+        keys = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        sort_documents(self.documents, keys, self.collation)
+        return self
+
+    def skip(self, count):
+        self.skipped = count
+        return self
+
+    def limit(self, count):
+        self.limited = count
+        return self
+
+    def results(self):
+        documents = self.documents[self.skipped:]
+        if self.limited:
+            documents = documents[:self.limited]
+        return [project(document, self.projection) for document in documents]
+
+    async def to_list(self, length=None):
+        documents = self.results()
+        return documents[:length] if length else documents
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.results():
+            yield document
+
+
+MISSING = object()
+
+
+def get_path(document, path):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return MISSING
+    return value
+
+
+def set_path(document, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def unset_path(document, path):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.get(part, {})
+    document.pop(last, None)
+
+
+def collated(value, collation):
+    # Strength 1 and 2 collations compare strings without case
+    if collation is not None and isinstance(value, str) and collation.document.get("strength", 3) <= 2:
+        return value.casefold()
+    return value
+
+
+def compare(left, right, collation=None):
+    """-1, 0 or 1, or None when MongoDB would not compare the two types"""
+    left, right = collated(left, collation), collated(right, collation)
+    if left is None or right is None:
+        return 0 if left is right else None
+    if type(left) is not type(right) and not (isinstance(left, (int, float)) and isinstance(right, (int, float))):
+        return None
+    return (left > right) - (left < right)
+
+
+def equal(value, expected, collation=None):
+    if isinstance(value, list) and not isinstance(expected, list):
+        return any(equal(item, expected, collation) for item in value)
+    if value is MISSING:
+        return expected is None
+    return compare(value, expected, collation) == 0 if not isinstance(value, (dict, list)) else value == expected
+
+
+def is_operator_condition(condition):
+    return isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)
+
+
+def matches_condition(value, condition, collation=None):
+    if not is_operator_condition(condition):
+        return equal(value, condition, collation)
+    for operator, operand in condition.items():
+        if operator == "$eq":
+            ok = equal(value, operand, collation)
+        elif operator == "$ne":
+            ok = not equal(value, operand, collation)
+        elif operator == "$in":
+            ok = any(equal(value, item, collation) for item in operand)
+        elif operator == "$nin":
+            ok = not any(equal(value, item, collation) for item in operand)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            candidates = value if isinstance(value, list) else [value]
+            results = [compare(item, operand, collation) for item in candidates if item is not MISSING]
+            accept = {"$gt": (1,), "$gte": (0, 1), "$lt": (-1,), "$lte": (-1, 0)}[operator]
+            ok = any(result in accept for result in results)
+        elif operator == "$exists":
+            ok = (value is not MISSING) == bool(operand)
+        elif operator == "$not":
+            ok = not matches_condition(value, operand, collation)
+        elif operator == "$regex":
+            ok = isinstance(value, str) and re.search(operand, value, re.I if "i" in condition.get("$options", "") else 0)
+        elif operator == "$options":
+            ok = True
+        else:
+            raise NotImplementedError(f"query operator {operator}")
+        if not ok:
+            return False
+    return True
+
+
+def matches(document, query, collation=None):
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            ok = all(matches(document, clause, collation) for clause in condition)
+        elif key == "$or":
+            ok = any(matches(document, clause, collation) for clause in condition)
+        elif key == "$nor":
+            ok = not any(matches(document, clause, collation) for clause in condition)
+        else:
+            ok = matches_condition(get_path(document, key), condition, collation)
+        if not ok:
+            return False
+    return True
+
+
+def project(document, projection):
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    included = {field for field, flag in projection.items() if flag and field != "_id"}
+    if included:
+        projected = {field: document[field] for field in included if field in document}
+        if projection.get("_id", 1) and "_id" in document:
+            projected["_id"] = document["_id"]
+        return projected
+    for field, flag in projection.items():
+        if not flag:
+            document.pop(field, None)
+    return document
+
+
+def sort_key(value, collation):
+    # Missing and null sort before everything else, as in MongoDB
+    if value is MISSING or value is None:
+        return (0, 0)
+    return (1, collated(value, collation))
+
+
+def sort_documents(documents, keys, collation=None):
+    for field, direction in reversed(keys):
+        documents.sort(key=lambda document: sort_key(get_path(document, field), collation), reverse=direction < 0)
+
+
+def apply_update(document, update, inserting=False):
+    for operator, fields in update.items():
+        if operator == "$setOnInsert" and not inserting:
+            continue
+        for path, value in fields.items():
+            current = get_path(document, path)
+            if operator in ("$set", "$setOnInsert"):
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$inc":
+                set_path(document, path, (0 if current is MISSING else current) + value)
+            elif operator in ("$max", "$min"):
+                order = compare(value, current) if current is not MISSING else None
+                if current is MISSING or (operator == "$max" and order == 1) or (operator == "$min" and order == -1):
+                    set_path(document, path, value)
+            elif operator == "$push":
+                items = list(current) if current is not MISSING else []
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(copy.deepcopy(value["$each"]))
+                    if "$slice" in value:
+                        items = items[:value["$slice"]] if value["$slice"] >= 0 else items[value["$slice"]:]
+                else:
+                    items.append(copy.deepcopy(value))
+                set_path(document, path, items)
+            elif operator == "$addToSet":
+                items = list(current) if current is not MISSING else []
+                for item in value["$each"] if isinstance(value, dict) and "$each" in value else [value]:
+                    if item not in items:
+                        items.append(item)
+                set_path(document, path, items)
+            elif operator == "$pull":
+                if current is not MISSING:
+                    set_path(document, path, [item for item in current if not matches_condition(item, value)])
+            else:
+                raise NotImplementedError(f"update operator {operator}")
+
+
+def upsert_seed(query):
+    """Fields an upsert copies from its filter: the top-level equality conditions"""
+    return {
+        key: copy.deepcopy(value) for key, value in query.items()
+        if not key.startswith("$") and not is_operator_condition(value)
+    }
+
+
+def evaluate(expression, document):
+    """The aggregation expressions server.py uses in $group and $project"""
+    if isinstance(expression, str) and expression.startswith("$$ROOT"):
+        return document
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    if isinstance(expression, dict) and len(expression) == 1:
+        (operator, operands), = expression.items()
+        if operator == "$add":
+            return sum(evaluate(operand, document) or 0 for operand in operands)
+        if operator == "$cond":
+            condition, then, otherwise = operands
+            return evaluate(then if evaluate(condition, document) else otherwise, document)
+        if operator == "$eq":
+            left, right = evaluate(operands, document)
+            return left == right
+        if operator == "$ifNull":
+            value, fallback = evaluate(operands, document)
+            return fallback if value is None else value
+    return expression
+
+
+class FakeCollection:
+    """A collection held in a list. unique names fields, besides _id, whose duplicates
+    are refused the way a unique index refuses them"""
+
+    def __init__(self, documents=(), unique=(), name="collection", database=None):
+        self.name = name
+        self.database = database
+        # Each entry is a field or a tuple of fields for a compound index
+        self.unique = [(field,) if isinstance(field, str) else tuple(field) for field in ("_id", *unique)]
+        self.documents = []
+        for document in documents:
+            self.store(dict(document))
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def create_index(self, *args, **kwargs):
+        return None
+
+    def store(self, document):
+        document.setdefault("_id", ObjectId())
+        for fields in self.unique:
+            key = [document.get(field) for field in fields]
+            if any(field in document for field in fields) and any(
+                [other.get(field) for field in fields] == key for other in self.documents
+            ):
+                index = "_".join(f"{field}_1" for field in fields)
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {index}", 11000)
+        self.documents.append(document)
+        return document["_id"]
+
+    def matching(self, query, collation=None):
+        return [document for document in self.documents if matches(document, query, collation)]
+
+    def first(self, query, sort=None, collation=None):
+        found = self.matching(query, collation)
+        if sort:
+            sort_documents(found, list(sort), collation)
+        return found[0] if found else None
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, collation=None, **kwargs):
+        cursor = Cursor(copy.deepcopy(self.matching(filter, collation)), projection, collation)
+        if sort:
+            cursor.sort(sort)
+        return cursor.limit(limit)
+
+    async def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        document = self.first(filter, sort)
+        return project(document, projection) if document else None
+
+    async def count_documents(self, filter, **kwargs):
+        return len(self.matching(filter))
+
+    async def insert_one(self, document):
+        inserted_id = self.store(copy.deepcopy(document))
+        document.setdefault("_id", inserted_id)
+        return Result(upserted_id=inserted_id, inserted=1)
+
+    async def insert_many(self, documents, ordered=True):
+        errors = []
+        for index, document in enumerate(documents):
+            try:
+                document.setdefault("_id", self.store(copy.deepcopy(document)))
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+        return Result(inserted=len(documents))
+
+    def update(self, query, update, upsert=False, many=False, replace=False):
+        targets = self.matching(query)
+        if not many:
+            targets = targets[:1]
+        modified = 0
+        for document in targets:
+            before = copy.deepcopy(document)
+            if replace:
+                document.clear()
+                document.update({"_id": before["_id"], **copy.deepcopy(update)})
+            else:
+                apply_update(document, update)
+            modified += document != before
+        if targets or not upsert:
+            return Result(len(targets), modified)
+        document = upsert_seed(query)
+        if replace:
+            document.update(copy.deepcopy(update))
+        else:
+            apply_update(document, update, inserting=True)
+        return Result(0, 0, upserted_id=self.store(document), upserted=1)
+
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        return self.update(filter, update, upsert)
+
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        return self.update(filter, update, upsert, many=True)
+
+    async def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        return self.update(filter, replacement, upsert, replace=True)
+
+    async def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, return_document=False, **kwargs):
+        document = self.first(filter, sort)
+        before = copy.deepcopy(document)
+        if document is None:
+            if not upsert:
+                return None
+            self.update(filter, update, upsert=True)
+            document = self.documents[-1]
+        else:
+            apply_update(document, update)
+        returned = document if return_document else before
+        return project(returned, projection) if returned else None
+
+    async def delete_one(self, filter, **kwargs):
+        document = self.first(filter)
+        if document is None:
+            return Result(deleted=0)
+        self.documents.remove(document)
+        return Result(deleted=1)
+
+    async def delete_many(self, filter, **kwargs):
+        doomed = self.matching(filter)
+        self.documents = [document for document in self.documents if document not in doomed]
+        return Result(deleted=len(doomed))
+
+    async def bulk_write(self, operations, ordered=True):
+        totals = Result()
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if isinstance(operation, InsertOne):
+                    self.store(copy.deepcopy(operation._doc))
+                    totals.inserted_count += 1
+                    continue
+                if isinstance(operation, (DeleteOne, DeleteMany)):
+                    result = await (self.delete_one if isinstance(operation, DeleteOne) else self.delete_many)(operation._filter)
+                    totals.deleted_count += result.deleted_count
+                    continue
+                result = self.update(
+                    operation._filter, operation._doc, operation._upsert,
+                    many=isinstance(operation, UpdateMany), replace=isinstance(operation, ReplaceOne)
+                )
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+                continue
+            totals.matched_count += result.matched_count
+            totals.modified_count += result.modified_count
+            totals.upserted_count += result.upserted_count
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nModified": totals.modified_count})
+        return totals
+
+    def aggregate(self, pipeline, **kwargs):
+        documents = copy.deepcopy(self.documents)
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                documents = [document for document in documents if matches(document, spec)]
+            elif name == "$unionWith":
+                other = self.database[spec["coll"]]
+                documents += [
+                    document for document in copy.deepcopy(other.documents)
+                    if all(matches(document, inner["$match"]) for inner in spec.get("pipeline", []))
+                ]
+            elif name == "$sort":
+                sort_documents(documents, list(spec.items()))
+            elif name == "$limit":
+                documents = documents[:spec]
+            elif name == "$group":
+                groups = {}
+                for document in documents:
+                    key = evaluate(spec["_id"], document)
+                    group = groups.setdefault(repr(key), {"_id": key})
+                    for field, accumulator in spec.items():
+                        if field == "_id":
+                            continue
+                        (operator, expression), = accumulator.items()
+                        value = evaluate(expression, document)
+                        if operator == "$sum":
+                            group[field] = group.get(field, 0) + (value or 0)
+                        elif operator == "$first":
+                            group.setdefault(field, value)
+                        elif operator == "$max":
+                            group[field] = value if field not in group else max(group[field], value)
+                        else:
+                            raise NotImplementedError(f"accumulator {operator}")
+                documents = list(groups.values())
+            else:
+                raise NotImplementedError(f"aggregation stage {name}")
+        return Cursor(documents)
+
+
+# The unique indexes server.ensure_indexes creates, by collection
+UNIQUE_INDEXES = {
+    "point_transactions": ["id"],
+    "point_lots": ["id"],
+    "rewards": ["id"],
+    "webhook_endpoints": ["id"],
+    "webhook_outbox": ["id"],
+    "request_profiles": ["id"],
+    "balance_snapshots": [("user_id", "as_of")],
+    "point_cap_renewals": [("user_id", "period")],
+}
+
+
+class FakeDB(dict):
+    """Collections by attribute, like db.point_transactions, or by name, like db[name];
+    a collection is created empty the first time it is named"""
+
+    def __missing__(self, name):
+        return self.add(name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __setattr__(self, name, collection):
+        self[name] = collection
+
+    def add(self, name, documents=()):
+        """Create (or empty) the collection name holding copies of documents"""
+        unique = UNIQUE_INDEXES.get(name, ["id"] if name.startswith(server.LEDGER_ARCHIVE_PREFIX) else [])
+        self[name] = FakeCollection(documents, unique, name, self)
+        return self[name]
+
+    async def list_collection_names(self, filter=None):
+        pattern = (filter or {}).get("name", {}).get("$regex", "")
+        return [name for name in self if re.search(pattern, name)]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Empty in-memory database installed as server.db, with the process caches emptied"""
+    database = FakeDB()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "catalog_cache", {})
+    monkeypatch.setattr(server, "catalog_owners", {})
+    monkeypatch.setattr(server, "idempotency_lru", type(server.idempotency_lru)())
+    monkeypatch.setattr(server, "idempotency_inflight", {})
+    monkeypatch.setattr(server, "webhook_endpoint_cache", {})
+    monkeypatch.setattr(server, "archive_names_cache", {"names": [], "expires_at": datetime.min})
+    return database
@@ -0,0 +1,117 @@
+"""Rate-limit bucketing: route classes and the client address behind proxies; no MongoDB needed."""
+import asyncio
+import ipaddress
+
+import server
+
+
+def scope(path, method="POST", peer="10.1.2.3", headers=()):
+    return {"type": "http", "method": method, "path": path, "client": (peer, 50000), "headers": list(headers)}
+
+
+def buckets_taken(monkeypatch, request_scope):
+    taken = []
+
+    async def take(key, rate, burst):
+        taken.append(key)
+        return 0
+
+    async def app(scope, receive, send):
+        pass
+
+    monkeypatch.setattr(server.rate_limit_backend, "take", take)
+    asyncio.run(server.AdmissionControlMiddleware(app)(request_scope, None, None))
+    return taken
+
+
+def test_only_password_routes_are_auth():
+    assert server.classify_route("POST", "/api/auth/login") == "auth"
+    assert server.classify_route("POST", "/api/auth/register") == "auth"
+    assert server.classify_route("POST", "/api/auth/logout") == "writes"
+    assert server.classify_route("POST", "/api/auth/refresh") == "refresh"
+
+
+def test_anonymous_callers_do_not_share_the_auth_bucket(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+
+    assert buckets_taken(monkeypatch, scope("/api/auth/login")) == ["client:10.1.2.3:auth"]
+    assert buckets_taken(monkeypatch, scope("/api/rewards", method="GET")) == ["client:10.1.2.3:anonymous"]
+
+
+def test_forwarded_client_is_used_behind_a_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [ipaddress.ip_network("10.0.0.0/8")])
+    forwarded = [(b"x-forwarded-for", b"198.51.100.7, 10.4.0.1")]
+
+    assert server.client_address(scope("/api/auth/login", headers=forwarded)) == "198.51.100.7"
+
+
+def test_untrusted_forwarder_is_logged_once(monkeypatch, caplog):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+    monkeypatch.setattr(server, "untrusted_forwarder_warning", {"logged": False})
+    forwarded = [(b"x-forwarded-for", b"198.51.100.7")]
+
+    for _ in range(3):
+        assert server.client_address(scope("/api/auth/login", headers=forwarded)) == "10.1.2.3"
+
+    assert sum("not in TRUSTED_PROXIES" in record.message for record in caplog.records) == 1
+
+
+def bearer(user_id, expired=False):
+    token = server.create_jwt_token({"id": user_id, "email": "e@company.example.com", "name": "Emp", "role": "employee"})
+    if expired:
+        payload = server.jwt.decode(token, server.JWT_SECRET, algorithms=[server.JWT_ALGORITHM])
+        payload["exp"] = payload["iat"] - 60
+        token = server.jwt.encode(payload, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+    return [(b"authorization", f"Bearer {token}".encode())]
+
+
+def test_signed_in_callers_pay_their_address_bucket_and_their_own(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+
+    taken = buckets_taken(monkeypatch, scope("/api/auth/login", headers=bearer("user-1")))
+
+    assert taken == ["client:10.1.2.3:auth", "user:user-1:auth"]
+
+
+def test_expired_tokens_do_not_identify_auth_callers(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+
+    taken = buckets_taken(monkeypatch, scope("/api/auth/login", headers=bearer("user-1", expired=True)))
+
+    assert taken == ["client:10.1.2.3:auth"]
+
+
+def test_tokens_do_not_lift_the_address_limit_on_logins(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", [])
+    monkeypatch.setattr(server, "rate_limit_backend", server.MemoryRateLimitBackend())
+    statuses = []
+
+    async def app(scope, receive, send):
+        statuses.append(200)
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    async def guess(count):
+        middleware = server.AdmissionControlMiddleware(app)
+        for number in range(count):
+            # A fresh token per attempt, as anyone who can self-register could mint
+            headers = bearer(f"user-{number}", expired=number % 2 == 0)
+            await middleware(scope("/api/auth/login", headers=headers), None, send)
+
+    asyncio.run(guess(1000))
+
+    rate, burst = server.RATE_LIMITS[("auth", "client")]
+    assert statuses.count(200) < burst + 10
+    assert statuses.count(429) > 1000 - burst - 10
+
+
+def test_office_behind_one_address_can_sign_in_at_once(monkeypatch):
+    monkeypatch.setattr(server, "rate_limit_backend", server.MemoryRateLimitBackend())
+    rate, burst = server.RATE_LIMITS[("auth", "client")]
+
+    async def sign_in(count):
+        return [await server.rate_limit_backend.take("client:203.0.113.9:auth", rate, burst) for _ in range(count)]
+
+    assert not any(asyncio.run(sign_in(50)))
@@ -0,0 +1,98 @@
+"""Point-in-time balances from monthly snapshots plus a ledger replay; no MongoDB needed."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+USER = {"id": "user-1"}
+
+
+def row(number, created_at, amount, to_user_id="user-1", from_user_id="manager-1", transaction_type="manager_award"):
+    return {
+        "id": f"row-{number}", "from_user_id": from_user_id, "to_user_id": to_user_id, "amount": amount,
+        "transaction_type": transaction_type, "company_id": "company-1", "created_at": created_at
+    }
+
+
+def snapshot(as_of, point_balance, point_cap=server.DEFAULT_POINT_CAP):
+    return {"user_id": "user-1", "as_of": as_of, "point_balance": point_balance, "point_cap": point_cap}
+
+
+@pytest.fixture
+def ledger(fake_db):
+    fake_db.add("point_transactions")
+    fake_db.add("balance_snapshots")
+    fake_db.add("point_cap_renewals")
+    return fake_db
+
+
+def balance_at(moment, inclusive=True):
+    return asyncio.run(server.balances_as_of([USER], moment, inclusive))["user-1"]
+
+
+def test_without_snapshots_the_whole_ledger_is_replayed(ledger):
+    ledger.add(server.LEDGER_ARCHIVE_PREFIX + "2025", [row(1, datetime(2025, 3, 1), 20)])
+    ledger.point_transactions.documents += [row(2, datetime(2026, 9, 10), 10), row(3, datetime(2026, 10, 20), 99)]
+
+    balance = balance_at(datetime(2026, 10, 15))
+
+    assert (balance["point_balance"], balance["snapshot_as_of"]) == (30, None)
+
+
+def test_replay_starts_at_the_nearest_earlier_snapshot(ledger):
+    # The snapshots disagree with the rows before them on purpose: only rows after a snapshot count
+    ledger.balance_snapshots.documents += [snapshot(datetime(2026, 9, 1), 100), snapshot(datetime(2026, 10, 1), 130)]
+    ledger.point_transactions.documents += [
+        row(1, datetime(2026, 8, 20), 1000),
+        row(2, datetime(2026, 9, 10), 30),
+        row(3, datetime(2026, 10, 5), 5),
+        row(4, datetime(2026, 10, 20), 50),
+    ]
+
+    assert balance_at(datetime(2026, 9, 30, 23))["point_balance"] == 130
+    assert balance_at(datetime(2026, 10, 15))["point_balance"] == 135
+    # At the month boundary the new snapshot is used as is, unless the caller is building it
+    at_boundary = balance_at(datetime(2026, 10, 1))
+    assert (at_boundary["point_balance"], at_boundary["snapshot_as_of"]) == (130, datetime(2026, 10, 1))
+    assert balance_at(datetime(2026, 10, 1), inclusive=False)["snapshot_as_of"] == datetime(2026, 9, 1)
+
+
+def test_archived_rows_after_the_snapshot_are_replayed(ledger):
+    ledger.balance_snapshots.documents.append(snapshot(datetime(2026, 1, 1), 20))
+    ledger.add(server.LEDGER_ARCHIVE_PREFIX + "2025", [row(1, datetime(2025, 6, 1), 20)])
+    ledger.add(server.LEDGER_ARCHIVE_PREFIX + "2026", [row(2, datetime(2026, 1, 15), 7)])
+    ledger.point_transactions.documents.append(row(3, datetime(2026, 9, 1), 3))
+
+    assert balance_at(datetime(2026, 2, 1))["point_balance"] == 27
+    assert balance_at(datetime(2026, 10, 1))["point_balance"] == 30
+
+
+def test_cap_counts_awards_given_since_the_snapshot(ledger):
+    ledger.balance_snapshots.documents.append(snapshot(datetime(2026, 10, 1), 0, point_cap=400))
+    ledger.point_transactions.documents += [
+        row(1, datetime(2026, 10, 2), 25, to_user_id="user-2", from_user_id="user-1"),
+        row(2, datetime(2026, 10, 3), 15, to_user_id="user-2", from_user_id="user-1", transaction_type="redemption"),
+    ]
+
+    assert balance_at(datetime(2026, 10, 15))["point_cap"] == 375
+
+
+def test_snapshot_job_matches_a_full_replay(ledger):
+    month = server.month_start(datetime.utcnow())
+    ledger.add("users", [dict(USER)])
+    ledger.add(server.LEDGER_ARCHIVE_PREFIX + str(month.year - 1), [row(1, datetime(month.year - 1, 5, 1), 40)])
+    ledger.point_transactions.documents += [
+        row(2, month - timedelta(days=20), 12),
+        row(3, max(month, datetime.utcnow() - timedelta(seconds=1)), 8),
+    ]
+    replayed = balance_at(datetime.utcnow())
+
+    asyncio.run(server.take_balance_snapshots())
+
+    taken, = ledger.balance_snapshots.documents
+    assert (taken["as_of"], taken["point_balance"]) == (month, 52)
+    from_snapshot = balance_at(datetime.utcnow())
+    assert from_snapshot["snapshot_as_of"] == month
+    assert from_snapshot["point_balance"] == replayed["point_balance"] == 60
@@ -0,0 +1,150 @@
+"""Cache bus slots, resume tokens and event dispatch against a scripted change stream; no MongoDB needed."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+
+
+class Stream:
+    """A change stream that hands out events, then idles until cancelled; each
+    event (or failure) advances the resume token like a real stream's batches"""
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.resume_token = None
+        self.alive = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def try_next(self):
+        if not self.events:
+            await asyncio.sleep(0.01)
+            return None
+        event = self.events.pop(0)
+        if isinstance(event, Exception):
+            raise event
+        self.resume_token = event["_id"]
+        return event
+
+
+@pytest.fixture
+def bus(monkeypatch, fake_db):
+    """Streams opened by the bus, scripted one list of events per watch() call"""
+    monkeypatch.setattr(server, "CACHE_BUS_ID", "host")
+    monkeypatch.setattr(server, "CACHE_BUS_TOKEN_FLUSH_SECONDS", 0)
+    monkeypatch.setattr(server, "cache_flushers", [])
+    worker(monkeypatch, "worker-1")
+    scripts, opened = [], []
+
+    def watch(pipeline, resume_after=None, **kwargs):
+        opened.append(resume_after)
+        return Stream(scripts.pop(0) if scripts else [])
+
+    fake_db.watch = watch
+    return scripts, opened
+
+
+def worker(monkeypatch, owner):
+    monkeypatch.setattr(server, "cache_bus_slot", {"id": None, "owner": owner})
+
+
+def event(token, collection="badges"):
+    return {"_id": {"_data": token}, "ns": {"db": "effydoc", "coll": collection}, "operationType": "delete", "documentKey": {"_id": token}}
+
+
+def run_until_idle(seconds=0.1):
+    """Run the bus until it has drained its scripted events, then stop it like a shutdown"""
+    async def main():
+        task = asyncio.create_task(server.run_cache_invalidation_bus())
+        await asyncio.sleep(seconds)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+
+def slot(fake_db, slot_id):
+    return next(document for document in fake_db.cache_bus_tokens.documents if document["_id"] == slot_id)
+
+
+def test_live_workers_get_separate_slots(monkeypatch, bus):
+    first = asyncio.run(server.claim_cache_bus_slot())
+    worker(monkeypatch, "worker-2")
+    second = asyncio.run(server.claim_cache_bus_slot())
+
+    assert (first["_id"], second["_id"]) == ("host:0", "host:1")
+
+
+def test_lapsed_lease_is_taken_over_and_its_old_owner_notices(monkeypatch, bus, fake_db):
+    asyncio.run(server.claim_cache_bus_slot())
+    slot(fake_db, "host:0")["lease_until"] = datetime.utcnow() - timedelta(seconds=1)
+    worker(monkeypatch, "worker-2")
+    assert asyncio.run(server.claim_cache_bus_slot())["_id"] == "host:0"
+
+    worker(monkeypatch, "worker-1")
+    server.cache_bus_slot["id"] = "host:0"
+    assert asyncio.run(server.save_cache_bus_token({"_data": "late"})) is False
+    assert slot(fake_db, "host:0")["owner"] == "worker-2"
+
+
+def test_events_reach_their_collections_handlers(monkeypatch, bus):
+    scripts, _ = bus
+    badges, users = [], []
+    monkeypatch.setitem(server.cache_invalidators, "badges", [badges.append])
+    monkeypatch.setitem(server.cache_invalidators, "users", [users.append])
+    scripts.append([event("1"), event("2", "users"), event("3")])
+
+    run_until_idle()
+
+    assert [change["_id"]["_data"] for change in badges] == ["1", "3"]
+    assert [change["_id"]["_data"] for change in users] == ["2"]
+
+
+def test_restarted_worker_resumes_from_its_slots_token(monkeypatch, bus, fake_db):
+    scripts, opened = bus
+    flushed = []
+    server.cache_flushers.append(lambda: flushed.append(True))
+    scripts.append([event("1"), event("2")])
+
+    run_until_idle()
+
+    # Shutdown released the lease and kept the last token
+    stored = slot(fake_db, "host:0")
+    assert stored["resume_token"] == {"_data": "2"}
+    assert stored["lease_until"] <= datetime.utcnow()
+    assert (opened, flushed) == ([None], [True])
+
+    worker(monkeypatch, "worker-1-restarted")
+    run_until_idle()
+
+    assert opened == [None, {"_data": "2"}]
+    assert flushed == [True]
+
+
+def test_expired_resume_token_flushes_caches_and_starts_over(bus, fake_db):
+    scripts, opened = bus
+    flushed = []
+    server.cache_flushers.append(lambda: flushed.append(True))
+    fake_db.add("cache_bus_tokens", [{"_id": "host:0", "resume_token": {"_data": "old"}, "lease_until": datetime.utcnow()}])
+    scripts.append([OperationFailure("resume point no longer in the oplog", 286)])
+
+    run_until_idle()
+
+    assert opened == [{"_data": "old"}, None]
+    assert flushed == [True]
+
+
+def test_standalone_servers_disable_the_bus(bus):
+    scripts, opened = bus
+    scripts.append([OperationFailure("The $changeStream stage is only supported on replica sets", 40573)])
+
+    assert asyncio.run(server.run_cache_invalidation_bus()) is None
+    assert opened == [None]
@@ -0,0 +1,111 @@
+"""The per-company catalog cache and its catalog_version stamp; no MongoDB needed."""
+import asyncio
+
+import pytest
+
+import server
+
+
+def badge(badge_id, points_required, **fields):
+    return server.Badge(
+        id=badge_id, name=badge_id.title(), description="", icon="star", badge_type="points_based",
+        company_id="company-1", points_required=points_required, **fields
+    ).model_dump()
+
+
+@pytest.fixture
+def catalog(monkeypatch, fake_db):
+    """The company's catalog store, with every Mongo read of it recorded"""
+    fake_db.add("companies", [server.Company(id="company-1", name="Company").model_dump()])
+    fake_db.add("badges", [
+        badge("gold", 500), badge("bronze", 100), badge("retired", 50, is_active=False), badge("silver", 250),
+        {**badge("first-task", None), "badge_type": "task_completion"},
+    ])
+    reads = []
+    for collection in (fake_db.companies, fake_db.badges):
+        for method in ("find_one", "find"):
+            monkeypatch.setattr(collection, method, recorded(reads, collection.name, getattr(collection, method)))
+    return reads
+
+
+def recorded(reads, name, method):
+    def call(*args, **kwargs):
+        reads.append(name)
+        return method(*args, **kwargs)
+    return call
+
+
+def load():
+    return asyncio.run(server.get_company_catalog("company-1"))
+
+
+def expire(catalog):
+    catalog.checked_at -= server.CATALOG_CACHE_TTL_SECONDS
+
+
+def test_catalog_holds_the_sorted_points_ladder(catalog):
+    loaded = load()
+
+    assert [badge["id"] for badge in loaded.points_badges] == ["bronze", "silver", "gold"]
+    assert loaded.points_thresholds == [100, 250, 500]
+    assert set(loaded.badges) == {"gold", "bronze", "retired", "silver", "first-task"}
+    assert loaded.company.name == "Company"
+
+
+def test_reads_within_the_ttl_come_from_memory(catalog):
+    first = load()
+    reads = list(catalog)
+
+    assert load() is first
+    assert asyncio.run(server.get_badge("silver", "company-1"))["points_required"] == 250
+    assert catalog == reads == ["companies", "badges"]
+
+
+def test_unchanged_stamp_revalidates_without_reloading(catalog):
+    first = load()
+    expire(first)
+    catalog.clear()
+
+    assert load() is first
+    assert catalog == ["companies"]
+
+
+def test_bumped_stamp_reloads_the_catalog(catalog, fake_db):
+    first = load()
+    # Another worker edits a badge and bumps the stamp; this worker only sees it after the TTL
+    asyncio.run(fake_db.badges.update_one({"id": "silver"}, {"$set": {"points_required": 300}}))
+    asyncio.run(fake_db.companies.update_one({"id": "company-1"}, {"$inc": {"catalog_version": 1}}))
+    assert load() is first
+
+    expire(first)
+    reloaded = load()
+
+    assert reloaded is not first
+    assert (reloaded.version, reloaded.points_thresholds) == (1, [100, 300, 500])
+
+
+def test_bump_on_this_worker_drops_its_copy_at_once(catalog):
+    first = load()
+
+    asyncio.run(server.bump_catalog_version("company-1"))
+
+    assert load() is not first
+    assert load().version == 1
+
+
+def test_change_events_evict_by_document_id(catalog, fake_db):
+    load()
+    silver = next(document for document in fake_db.badges.documents if document["id"] == "silver")
+
+    # Updates and deletes carry only the _id, which the cache maps back to the company
+    server.invalidate_company_catalog({"ns": {"coll": "badges"}, "operationType": "delete", "documentKey": {"_id": silver["_id"]}})
+
+    assert "company-1" not in server.catalog_cache
+
+
+def test_badges_outside_the_catalog_are_read_from_mongo(catalog, fake_db):
+    fake_db.badges.documents.append({**badge("global", 10), "company_id": None})
+    load()
+
+    assert asyncio.run(server.get_badge("global", "company-1"))["id"] == "global"
+    assert asyncio.run(server.get_badge("missing", "company-1")) is None
@@ -0,0 +1,197 @@
+"""Digest rendering and pooled SMTP delivery against a local SMTP stand-in.
+
+The stand-in speaks just enough SMTP for smtplib, keeps every message it
+accepts, counts connections and can refuse chosen recipients or hang up
+after each message. No MongoDB is needed.
+"""
+import asyncio
+import socketserver
+import threading
+from datetime import datetime
+from email import message_from_bytes
+
+import pytest
+
+import server
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.refused = set()
+        self.hang_up_after_message = False
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        stand_in = self.server
+        with stand_in.lock:
+            stand_in.connections += 1
+        self.reply("220 stand-in ready")
+        recipients = []
+        for raw in self.rfile:
+            command = raw.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip("<> ")
+                if address in stand_in.refused:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data in self.rfile:
+                    if data == b".\r\n":
+                        break
+                    lines.append(data[1:] if data.startswith(b"..") else data)
+                with stand_in.lock:
+                    stand_in.messages.append(message_from_bytes(b"".join(lines)))
+                self.reply("250 Queued")
+                if stand_in.hang_up_after_message:
+                    return
+            elif verb == "RSET":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    smtpd = SMTPStandIn()
+    thread = threading.Thread(target=smtpd.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(server, "SMTP_HOST", "127.0.0.1")
+    monkeypatch.setattr(server, "SMTP_PORT", smtpd.server_address[1])
+    yield smtpd
+    smtpd.shutdown()
+    smtpd.server_close()
+
+
+def bucket(number, events=None):
+    events = events or [
+        {"kind": "recognition", "amount": 5, "reason": "Great demo", "from_name": "Manager"},
+        {"kind": "badge", "badge_name": "Rising Star"},
+    ]
+    return {
+        "_id": f"user-{number}:2026101900", "user_id": f"user-{number}",
+        "bucket_start": datetime(2026, 10, 19), "events": events, "event_count": len(events),
+        "counts": {"recognition": sum(event["kind"] == "recognition" for event in events),
+                   "badge": sum(event["kind"] == "badge" for event in events)},
+        "points": sum(event.get("amount", 0) for event in events),
+    }
+
+
+def user(number):
+    return {"id": f"user-{number}", "name": f"User {number}", "email": f"user{number}@company.example.com"}
+
+
+def test_digest_summarizes_the_bucket():
+    message = server.render_digest(user(1), bucket(1))
+
+    assert message["To"] == "user1@company.example.com"
+    assert message["Subject"] == "Your recognition digest: 1 recognition worth 5 points, 1 new badge"
+    body = message.get_content()
+    assert "+5 from Manager: Great demo" in body
+    assert "Badge earned: Rising Star" in body
+
+
+def test_digest_mentions_unlisted_events():
+    events = [{"kind": "recognition", "amount": 1, "reason": "Thanks", "from_name": "Manager"}] * 3
+    digest = bucket(1, events)
+    digest["event_count"] = 40
+
+    assert "...and 37 more" in server.render_digest(user(1), digest).get_content()
+
+
+def test_bucket_start_is_aligned_to_the_window(monkeypatch):
+    monkeypatch.setattr(server, "DIGEST_BUCKET_HOURS", 6)
+
+    assert server.digest_bucket_start(datetime(2026, 10, 19, 13, 45)) == datetime(2026, 10, 19, 12)
+
+
+def test_pool_reuses_its_connections(stand_in):
+    pool = server.SMTPPool(2)
+    messages = [server.render_digest(user(i), bucket(i)) for i in range(20)]
+
+    async def send_twice():
+        first = await pool.send(messages[:10])
+        second = await pool.send(messages[10:])
+        return first, second
+
+    assert asyncio.run(send_twice()) == ({}, {})
+    pool.close()
+
+    assert sorted(message["To"] for message in stand_in.messages) == sorted(message["To"] for message in messages)
+    assert stand_in.connections == 2
+
+
+def test_refused_recipient_fails_only_its_message(stand_in):
+    stand_in.refused = {"user3@company.example.com"}
+    pool = server.SMTPPool(1)
+    messages = [server.render_digest(user(i), bucket(i)) for i in range(5)]
+
+    errors = asyncio.run(pool.send(messages))
+    pool.close()
+
+    assert list(errors) == [3]
+    assert len(stand_in.messages) == 4
+    assert stand_in.connections == 1
+
+
+def test_dropped_connection_is_replaced(stand_in):
+    stand_in.hang_up_after_message = True
+    pool = server.SMTPPool(1)
+    messages = [server.render_digest(user(i), bucket(i)) for i in range(3)]
+
+    errors = asyncio.run(pool.send(messages))
+    pool.close()
+
+    assert errors == {}
+    assert len(stand_in.messages) == 3
+    assert stand_in.connections == 3
+
+
+def test_task_completion_is_added_to_the_digest(monkeypatch, fake_db):
+    task = server.Task(title="Ship it", description="Release", points_reward=15, company_id="company-1", created_by="manager-1")
+    fake_db.add("tasks", [task.model_dump()])
+    fake_db.add("users", [{"id": "manager-1", "name": "Grace", "role": "manager"}])
+    digested = []
+
+    async def nothing(*args, **kwargs):
+        return None
+
+    async def add_to_digest(user_id, company_id, event, points=0):
+        digested.append((user_id, company_id, event, points))
+
+    for name in ("find_one_ledger", "write_ledger", "bump_versions", "emit_webhook_event", "check_and_award_badges"):
+        monkeypatch.setattr(server, name, nothing)
+    monkeypatch.setattr(server, "add_to_digest", add_to_digest)
+    employee = server.User(id="employee-1", email="e@company.example.com", name="Emp", role="employee", company_id="company-1")
+
+    asyncio.run(server.complete_task_for_user(task.id, employee))
+
+    assert digested == [("employee-1", "company-1", {
+        "kind": "recognition", "amount": 15, "reason": "Task completed: Ship it", "from_name": "Grace"
+    }, 15)]
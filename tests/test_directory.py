@@ -0,0 +1,115 @@
+"""The user directory's collated prefix search and keyset pages; no MongoDB needed."""
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+ADMIN = server.User(id="admin-1", email="admin@company.example.com", name="Admin", role="company_admin", company_id="company-1")
+MANAGER = server.User(id="manager-1", email="m@company.example.com", name="Manager", role="manager", company_id="company-1")
+
+NAMES = ["alex", "Alex", "ALEX", "alice", "ALAN", "Bob", "bea", "Zed", "Alfie"]
+
+
+@pytest.fixture
+def roster(fake_db):
+    fake_db.add("users", [
+        {
+            "id": f"user-{index}", "name": name, "email": f"{name.lower()}.{index}@company.example.com",
+            "company_id": "company-1", "manager_id": "manager-1" if index % 2 else "manager-2",
+            "role": "employee", "is_active": True, "password": "hash"
+        }
+        for index, name in enumerate(NAMES)
+    ] + [
+        {"id": "user-left", "name": "Alexa", "email": "alexa@company.example.com", "company_id": "company-1", "is_active": False},
+        {"id": "user-other", "name": "Alex", "email": "alex@other.example.com", "company_id": "company-2", "is_active": True},
+    ])
+
+
+def directory(current_user=ADMIN, **params):
+    return json.loads(asyncio.run(server.get_directory(**{
+        "q": None, "department": None, "role": None, "company_id": None, "cursor": None,
+        "limit": server.DIRECTORY_PAGE_SIZE, **params, "current_user": current_user
+    })).body)
+
+
+def names(page):
+    return [user["name"] for user in page["users"]]
+
+
+def walk(limit, **params):
+    """Every user on every page, following next_cursor to the end"""
+    users, cursor = [], None
+    while True:
+        page = directory(limit=limit, cursor=cursor, **params)
+        users += page["users"]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return users
+
+
+def expected_order(names):
+    return sorted(names, key=lambda pair: (pair[1].casefold(), pair[0]))
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 4, 50])
+def test_pages_neither_skip_nor_repeat_users(roster, limit):
+    users = walk(limit)
+
+    assert [user["id"] for user in users] == [
+        user_id for user_id, _ in expected_order([(f"user-{index}", name) for index, name in enumerate(NAMES)])
+    ]
+    assert all(set(user) <= set(server.DIRECTORY_PROJECTION) for user in users)
+
+
+def test_pages_break_ties_on_equal_names_by_id(roster):
+    # alex, Alex and ALEX collate equal, so a page boundary falls between them
+    first = directory(limit=3)
+    second = directory(limit=3, cursor=first["next_cursor"])
+
+    assert [user["id"] for user in first["users"] + second["users"]][1:5] == ["user-0", "user-1", "user-2", "user-8"]
+
+
+def test_prefix_is_case_insensitive(roster):
+    assert names(directory(q="al")) == names(directory(q="AL")) == ["ALAN", "alex", "Alex", "ALEX", "Alfie", "alice"]
+
+
+def test_prefix_range_ends_after_every_longer_name(roster, fake_db):
+    asyncio.run(fake_db.users.insert_one({
+        "id": "user-9", "name": "Alexandra", "email": "alexandra@company.example.com", "company_id": "company-1", "is_active": True
+    }))
+
+    # "\uffff" closes the range, so names longer than the prefix stay inside it
+    assert names(directory(q="Alex")) == ["alex", "Alex", "ALEX", "Alexandra"]
+    assert names(directory(q="ALEXANDRA")) == ["Alexandra"]
+    assert names(directory(q="alexander")) == []
+
+
+def test_prefix_with_an_at_sign_searches_emails(roster):
+    assert names(directory(q="BOB.5@")) == ["Bob"]
+
+
+def test_search_pages_follow_the_cursor(roster):
+    assert [user["name"] for user in walk(2, q="al")] == ["ALAN", "alex", "Alex", "ALEX", "Alfie", "alice"]
+
+
+def test_managers_see_their_reports(roster):
+    assert names(directory(MANAGER)) == ["Alex", "alice", "Bob", "Zed"]
+
+
+def test_employees_cannot_browse(roster):
+    employee = server.User(id="user-0", email="alex.0@company.example.com", name="alex", role="employee", company_id="company-1")
+
+    with pytest.raises(HTTPException) as refused:
+        directory(employee)
+
+    assert refused.value.status_code == 403
+
+
+def test_tampered_cursor_is_refused(roster):
+    with pytest.raises(HTTPException) as refused:
+        directory(cursor="not-a-cursor")
+
+    assert refused.value.status_code == 400
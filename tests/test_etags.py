@@ -0,0 +1,87 @@
+"""Weak ETags of the polled task, badge and company reads; no MongoDB needed."""
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+from fastapi import Request, Response
+
+import server
+
+EMPLOYEE = server.User(id="employee-1", email="e@company.example.com", name="Emp", role="employee", company_id="company-1")
+
+
+@pytest.fixture
+def company(fake_db):
+    fake_db.add("companies", [server.Company(id="company-1", name="Company").model_dump()])
+    fake_db.add("badges", [server.Badge(
+        id="badge-1", name="Rising Star", description="100 points", icon="star",
+        badge_type="points_based", company_id="company-1", points_required=100
+    ).model_dump()])
+    fake_db.add("users", [{"id": "manager-1", "name": "Grace"}])
+    fake_db.add("tasks", [{
+        "id": "task-1", "title": "Ship it", "company_id": "company-1", "created_by": "manager-1",
+        "is_active": True, "created_at": datetime(2026, 10, 19)
+    }])
+    fake_db.add("user_badges", [{"user_id": "employee-1", "badge_id": "badge-1", "earned_at": datetime(2026, 10, 19)}])
+
+
+def get(route, if_none_match=None, **kwargs):
+    """Status, ETag and body of a GET of route, sent with If-None-Match when given"""
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+    response = Response()
+    result = asyncio.run(route(request=request, response=response, **kwargs))
+    if isinstance(result, Response):
+        return result.status_code, result.headers.get("etag"), json.loads(result.body) if result.body else None
+    return 200, response.headers["etag"], result
+
+
+def test_weak_comparison():
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(b"if-none-match", b'"other", "tasks-3"')]})
+
+    assert server.etag_matches(request, 'W/"tasks-3"')
+    assert not server.etag_matches(request, 'W/"tasks-4"')
+
+
+def test_tasks(company):
+    status, etag, tasks = get(server.get_tasks, current_user=EMPLOYEE)
+    assert status == 200
+    assert [(task["id"], task["created_by_name"]) for task in tasks] == [("task-1", "Grace")]
+
+    assert get(server.get_tasks, etag, current_user=EMPLOYEE) == (304, etag, None)
+
+    asyncio.run(server.bump_versions("tasks:company-1"))
+    status, fresh, tasks = get(server.get_tasks, etag, current_user=EMPLOYEE)
+    assert (status, len(tasks)) == (200, 1)
+    assert fresh != etag
+    assert get(server.get_tasks, fresh, current_user=EMPLOYEE)[0] == 304
+
+
+def test_badges(company):
+    status, etag, badges = get(server.get_user_badges, current_user=EMPLOYEE)
+    assert status == 200
+    assert [badge["badge"]["name"] for badge in badges] == ["Rising Star"]
+
+    assert get(server.get_user_badges, etag, current_user=EMPLOYEE) == (304, etag, None)
+
+    # A new badge for the user and a change to the company's badge definitions both change the tag
+    asyncio.run(server.bump_versions("user_badges:employee-1"))
+    status, earned, _ = get(server.get_user_badges, etag, current_user=EMPLOYEE)
+    assert status == 200 and earned != etag
+
+    asyncio.run(server.bump_catalog_version("company-1"))
+    status, edited, _ = get(server.get_user_badges, earned, current_user=EMPLOYEE)
+    assert status == 200 and edited not in (etag, earned)
+
+
+def test_company(company):
+    status, etag, found = get(server.get_company, company_id="company-1", current_user=EMPLOYEE)
+    assert (status, found.name) == (200, "Company")
+
+    assert get(server.get_company, etag, company_id="company-1", current_user=EMPLOYEE) == (304, etag, None)
+
+    asyncio.run(server.bump_catalog_version("company-1"))
+    status, fresh, found = get(server.get_company, etag, company_id="company-1", current_user=EMPLOYEE)
+    assert (status, found.catalog_version) == (200, 1)
+    assert fresh != etag
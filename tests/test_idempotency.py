@@ -0,0 +1,86 @@
+"""Idempotency-Key handling in run_idempotent against an in-memory collection; no MongoDB needed."""
+import asyncio
+import json
+from collections import OrderedDict
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.fixture
+def give(fake_db):
+    """A handler that counts its executions, and a call of it through run_idempotent"""
+    executions = []
+
+    async def handler():
+        executions.append(1)
+        await asyncio.sleep(0.01)
+        return {"id": f"transaction-{len(executions)}", "amount": 10}
+
+    async def call(key, payload=None):
+        return await server.run_idempotent(key, "points_give", "user-1", payload or {"to_user_id": "user-2", "amount": 10}, handler)
+
+    call.executions = executions
+    return call
+
+
+def body(response):
+    return json.loads(response.body)
+
+
+def test_retry_gets_the_stored_response(give, fake_db):
+    first = asyncio.run(give("key-1"))
+    retry = asyncio.run(give("key-1"))
+
+    assert give.executions == [1]
+    assert body(retry) == body(first) == {"id": "transaction-1", "amount": 10}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    stored, = fake_db.idempotency_keys.documents
+    assert (stored["_id"], stored["state"]) == ("user-1:points_give:key-1", "completed")
+
+
+def test_retry_on_another_worker_gets_the_stored_response(give, monkeypatch):
+    asyncio.run(give("key-1"))
+    # A worker that never saw the key has nothing in its LRU
+    monkeypatch.setattr(server, "idempotency_lru", OrderedDict())
+
+    retry = asyncio.run(give("key-1"))
+
+    assert give.executions == [1]
+    assert body(retry) == {"id": "transaction-1", "amount": 10}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+
+def test_reused_key_with_a_different_payload_is_refused(give):
+    asyncio.run(give("key-1"))
+
+    with pytest.raises(HTTPException) as refused:
+        asyncio.run(give("key-1", {"to_user_id": "user-2", "amount": 500}))
+
+    assert refused.value.status_code == 422
+    assert give.executions == [1]
+
+
+def test_concurrent_requests_with_one_key_run_the_handler_once(give):
+    async def together():
+        return await asyncio.gather(give("key-1"), give("key-1"), give("key-1"))
+
+    responses = asyncio.run(together())
+
+    assert give.executions == [1]
+    assert [body(response) for response in responses] == [{"id": "transaction-1", "amount": 10}] * 3
+    assert sum("Idempotent-Replayed" in response.headers for response in responses) == 2
+
+
+def test_failed_execution_releases_the_key(give, fake_db):
+    async def broken():
+        raise RuntimeError("database went away")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.run_idempotent("key-1", "points_give", "user-1", {"to_user_id": "user-2", "amount": 10}, broken))
+
+    assert fake_db.idempotency_keys.documents == []
+    assert body(asyncio.run(give("key-1"))) == {"id": "transaction-1", "amount": 10}
@@ -0,0 +1,123 @@
+"""Ledger ids stored as strings, binary UUIDs or both while migrating; no MongoDB needed."""
+import asyncio
+import uuid
+
+import pytest
+from bson.binary import Binary
+from pymongo.errors import AutoReconnect
+
+import server
+
+MODES = ["string", "dual", "binary"]
+
+
+def transaction(**fields):
+    return server.PointTransaction(**{
+        "from_user_id": str(uuid.uuid4()), "to_user_id": str(uuid.uuid4()), "amount": 5,
+        "reason": "Great demo", "company_id": "company-1", **fields
+    })
+
+
+@pytest.fixture
+def ledger(monkeypatch, fake_db):
+    monkeypatch.setattr(server, "LEDGER_BATCH_ENABLED", False)
+    fake_db.add("point_transactions")
+    return fake_db.point_transactions
+
+
+def test_uuid_strings_become_binary_and_back():
+    value = str(uuid.uuid4())
+    binary = server.ledger_id_to_binary(value)
+
+    assert (binary.subtype, len(binary)) == (4, 16)
+    assert server.decode_ledger_id(binary) == value
+    assert server.decode_ledger_id(value) == value
+
+
+@pytest.mark.parametrize("value", ["company-1", "reconcile:report-1:user-1", None, 7])
+def test_ids_that_are_not_uuids_are_left_alone(value):
+    assert server.ledger_id_to_binary(value) is None
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_documents_are_encoded_for_the_mode(monkeypatch, mode):
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", mode)
+    row = transaction()
+
+    document = server.encode_ledger_document(row.model_dump())
+
+    if mode == "string":
+        assert document["id"] == row.id and document["to_user_id"] == row.to_user_id
+    else:
+        assert document["id"] == server.ledger_id_to_binary(row.id)
+        assert document["to_user_id"] == server.ledger_id_to_binary(row.to_user_id)
+    # Company ids are not UUIDs here and stay strings in every mode
+    assert document["company_id"] == "company-1"
+    assert server.decode_ledger_document(document) == row.model_dump()
+
+
+def test_queries_match_each_stored_form(monkeypatch):
+    value = str(uuid.uuid4())
+    binary = server.ledger_id_to_binary(value)
+    query = {"to_user_id": value, "from_user_id": {"$ne": value}, "$or": [{"id": {"$in": [value, "legacy"]}}], "amount": 5}
+
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", "string")
+    assert server.encode_ledger_query(query) == query
+
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", "dual")
+    assert server.encode_ledger_query(query) == {
+        "to_user_id": {"$in": [binary, value]}, "from_user_id": {"$nin": [binary, value]},
+        "$or": [{"id": {"$in": [binary, value, "legacy"]}}], "amount": 5
+    }
+
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", "binary")
+    assert server.encode_ledger_query(query) == {
+        "to_user_id": binary, "from_user_id": {"$ne": binary},
+        "$or": [{"id": {"$in": [binary, "legacy"]}}], "amount": 5
+    }
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_written_rows_read_back_with_string_ids(monkeypatch, ledger, mode):
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", mode)
+    row = transaction()
+
+    asyncio.run(server.write_ledger(row, {}))
+
+    stored, = ledger.documents
+    assert isinstance(stored["id"], Binary) == (mode != "string")
+    # Only the encoded query finds a binary row
+    assert (asyncio.run(ledger.find_one({"id": row.id})) is None) == (mode != "string")
+    found = asyncio.run(server.find_one_ledger({"id": row.id}))
+    assert (found["id"], found["from_user_id"], found["to_user_id"]) == (row.id, row.from_user_id, row.to_user_id)
+    assert [found["id"] for found in asyncio.run(server.find_ledger({"to_user_id": row.to_user_id}))] == [row.id]
+
+
+def test_dual_mode_finds_rows_written_before_the_migration(monkeypatch, ledger):
+    user_id = str(uuid.uuid4())
+    legacy, migrated = transaction(to_user_id=user_id), transaction(to_user_id=user_id)
+    asyncio.run(server.write_ledger(legacy, {}))
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", "dual")
+    asyncio.run(server.write_ledger(migrated, {}))
+
+    assert asyncio.run(server.find_one_ledger({"id": legacy.id}))["id"] == legacy.id
+    assert {row["id"] for row in asyncio.run(server.find_ledger({"to_user_id": user_id}))} == {legacy.id, migrated.id}
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_binary_row_that_landed_before_a_lost_reply_counts_as_written(monkeypatch, ledger, mode):
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", mode)
+    insert_one = ledger.insert_one
+
+    async def reply_lost(document):
+        await insert_one(document)
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(ledger, "insert_one", reply_lost)
+    row = transaction()
+
+    asyncio.run(server.write_ledger(row, {}))
+
+    stored, = ledger.documents
+    assert asyncio.run(server.persisted_ledger_ids([stored["id"]])) == {stored["id"]}
+    assert asyncio.run(server.persisted_ledger_ids([server.encode_ledger_document(transaction().model_dump())["id"]])) == set()
@@ -0,0 +1,87 @@
+"""Reads across the hot ledger and its yearly archives; no MongoDB needed."""
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+NOW = datetime.utcnow()
+
+
+def rows(prefix, count, newest):
+    return [
+        {"id": f"{prefix}-{index}", "to_user_id": "employee-1", "created_at": newest - timedelta(days=index)}
+        for index in range(count)
+    ]
+
+
+def ledger(monkeypatch, fake_db, hot_rows):
+    """Hot rows plus an archive two years back; returns the ledger collections read, in order"""
+    reads = []
+    archive_year = NOW.year - 2
+    collections = {
+        "hot": fake_db.add("point_transactions", hot_rows),
+        "archive": fake_db.add(f"{server.LEDGER_ARCHIVE_PREFIX}{archive_year}", rows("old", 5, datetime(archive_year, 6, 1))),
+    }
+    for label, collection in collections.items():
+        monkeypatch.setattr(collection, "find", logged(collection.find, reads, label))
+
+    monkeypatch.setattr(server, "LEDGER_ID_STORAGE", "string")
+    return reads
+
+
+def logged(find, reads, label):
+    def find_and_log(*args, **kwargs):
+        reads.append(label)
+        return find(*args, **kwargs)
+    return find_and_log
+
+
+def test_short_hot_window_stays_hot_and_points_at_the_archives(monkeypatch, fake_db):
+    reads = ledger(monkeypatch, fake_db, rows("hot", 2, NOW))
+
+    found = asyncio.run(server.find_ledger({"to_user_id": "employee-1"}, limit=4))
+    cursor = asyncio.run(server.ledger_page_cursor(found, 4))
+
+    assert [row["id"] for row in found] == ["hot-0", "hot-1"]
+    assert reads == ["hot"]
+    assert cursor == server.ledger_hot_cutoff()
+
+
+def test_paging_past_the_hot_window_reads_the_archives(monkeypatch, fake_db):
+    reads = ledger(monkeypatch, fake_db, rows("hot", 2, NOW))
+    before = server.ledger_hot_cutoff()
+
+    found = asyncio.run(server.find_ledger({"to_user_id": "employee-1"}, limit=4, before=before))
+    cursor = asyncio.run(server.ledger_page_cursor(found, 4, before))
+
+    assert [row["id"] for row in found] == ["old-0", "old-1", "old-2", "old-3"]
+    assert reads == ["archive"]
+    assert cursor == found[-1]["created_at"]
+
+
+def test_history_request_fills_a_short_hot_window(monkeypatch, fake_db):
+    reads = ledger(monkeypatch, fake_db, rows("hot", 2, NOW))
+
+    found = asyncio.run(server.find_ledger({"to_user_id": "employee-1"}, limit=10, history=True))
+
+    assert [row["id"] for row in found] == ["hot-0", "hot-1", *(f"old-{index}" for index in range(5))]
+    assert reads == ["hot", "archive"]
+    assert asyncio.run(server.ledger_page_cursor(found, 10, server.ledger_hot_cutoff())) is None
+
+
+def test_full_hot_window_skips_archives(monkeypatch, fake_db):
+    reads = ledger(monkeypatch, fake_db, rows("hot", 4, NOW))
+
+    found = asyncio.run(server.find_ledger({"to_user_id": "employee-1"}, limit=4))
+
+    assert len(found) == 4
+    assert reads == ["hot"]
+
+
+def test_since_bounds_rows_and_archives(monkeypatch, fake_db):
+    reads = ledger(monkeypatch, fake_db, rows("hot", 3, NOW))
+
+    found = asyncio.run(server.find_ledger({"to_user_id": "employee-1"}, limit=10, since=NOW - timedelta(days=1, hours=1)))
+
+    assert [row["id"] for row in found] == ["hot-0", "hot-1"]
+    assert reads == ["hot"]
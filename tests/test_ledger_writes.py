@@ -0,0 +1,81 @@
+"""Batched ledger writes when a stage fails part-way; no MongoDB needed."""
+import asyncio
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import server
+from tests.conftest import Cursor, FakeDB
+
+
+class FakeLedger:
+    """insert_many stores the rows, then optionally raises as if the reply was lost"""
+
+    def __init__(self, error=None, lands=True, readable=True):
+        self.rows, self.error, self.lands, self.readable = [], error, lands, readable
+
+    async def insert_many(self, documents, ordered=True):
+        if self.lands:
+            self.rows.extend(documents)
+        if self.error:
+            raise self.error
+
+    def find(self, query, projection=None):
+        if not self.readable:
+            raise AutoReconnect("primary stepped down")
+        return Cursor([{"id": row["id"]} for row in self.rows if row["id"] in query["id"]["$in"]])
+
+
+class FakeSink:
+    def __init__(self, error=None):
+        self.writes, self.error = [], error
+
+    async def insert_many(self, documents, ordered=True):
+        self.writes.append(documents)
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.error:
+            raise self.error
+        self.writes.append(operations)
+
+
+def run_batch(monkeypatch, ledger, users=None):
+    fake_db = FakeDB(point_transactions=ledger, point_lots=FakeSink(), users=users or FakeSink())
+    monkeypatch.setattr(server, "db", fake_db)
+
+    async def main():
+        writer = server.LedgerWriteCoalescer()
+        calls = [
+            writer.submit({"id": f"row-{index}"}, {f"user-{index}": {"point_balance": 5}}) for index in range(3)
+        ]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    return fake_db, asyncio.run(main())
+
+
+def test_rows_that_landed_before_a_lost_reply_succeed(monkeypatch):
+    fake_db, results = run_batch(monkeypatch, FakeLedger(AutoReconnect("connection reset")))
+
+    assert results == [None, None, None]
+    assert len(fake_db.users.writes) == 1
+
+
+def test_rows_that_did_not_land_fail_with_the_error(monkeypatch):
+    fake_db, results = run_batch(monkeypatch, FakeLedger(AutoReconnect("connection reset"), lands=False))
+
+    assert all(isinstance(result, AutoReconnect) for result in results)
+    assert fake_db.users.writes == []
+
+
+def test_unverifiable_rows_keep_their_idempotency_key(monkeypatch):
+    _, results = run_batch(monkeypatch, FakeLedger(AutoReconnect("connection reset"), readable=False))
+
+    assert all(isinstance(result, server.LedgerOutcomeUnknown) for result in results)
+    # An HTTPException is stored as the key's response instead of releasing the key
+    assert all(isinstance(result, server.HTTPException) for result in results)
+
+
+def test_balance_failure_after_the_ledger_insert_does_not_fail_callers(monkeypatch):
+    users = FakeSink(BulkWriteError({"writeErrors": [{"index": 0, "code": 2, "errmsg": "bad"}]}))
+    _, results = run_batch(monkeypatch, FakeLedger(), users)
+
+    assert results == [None, None, None]
@@ -0,0 +1,115 @@
+"""Automatic point-cap renewal against the awards it could race; no MongoDB needed."""
+import asyncio
+from datetime import datetime
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+from tests.conftest import FakeCollection
+
+MANAGER = {
+    "id": "manager-1", "email": "m@company.example.com", "name": "Manager", "role": "manager",
+    "company_id": "company-1", "point_cap": 3, "point_cap_renewal_type": "automatic",
+    "point_cap_renewal_period": "2020-01",
+}
+EMPLOYEE = {"id": "employee-1", "company_id": "company-1", "manager_id": "manager-1", "role": "employee"}
+
+
+class FakeUsers(FakeCollection):
+    """Users collection recording cap renewals and draws as they are applied"""
+
+    def __init__(self, calls):
+        super().__init__([MANAGER, EMPLOYEE], name="users")
+        self.calls = calls
+
+    def user(self, user_id):
+        return next(document for document in self.documents if document["id"] == user_id)
+
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        result = await super().update_one(filter, update, upsert)
+        if result.modified_count:
+            self.calls.append(("draw", update["$inc"]["point_cap"]))
+        return result
+
+    async def bulk_write(self, operations, ordered=True):
+        result = await super().bulk_write(operations, ordered)
+        self.calls.append(("renew", result.modified_count))
+        return result
+
+
+def renewed_user_ids(fake_db):
+    return [renewal["user_id"] for renewal in fake_db.point_cap_renewals.documents]
+
+
+def test_first_award_of_a_period_renews_the_cap_before_spending_it(monkeypatch, fake_db):
+    calls = []
+    fake_db.users = FakeUsers(calls)
+
+    async def write_ledger(transaction, increments):
+        calls.append(("award", increments[EMPLOYEE["id"]]["point_balance"]))
+
+    async def nothing(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(server, "write_ledger", write_ledger)
+    for name in ("bump_versions", "emit_webhook_event", "add_to_digest", "check_and_award_badges"):
+        monkeypatch.setattr(server, name, nothing)
+
+    award = server.PointTransactionCreate(to_user_id="employee-1", amount=10, reason="Thanks")
+    asyncio.run(server.award_points(award, server.User(**MANAGER)))
+    # The scheduled job reaching this manager afterwards finds the period already renewed
+    asyncio.run(server.renew_point_caps_for([MANAGER["id"]], datetime.utcnow()))
+
+    assert calls == [("renew", 1), ("draw", -10), ("award", 10), ("renew", 0)]
+    assert fake_db.users.user(MANAGER["id"])["point_cap"] == server.DEFAULT_POINT_CAP - 10
+
+
+def test_award_beyond_the_cap_draws_nothing(monkeypatch, fake_db):
+    calls = []
+    fake_db.users = FakeUsers(calls)
+    fake_db.users.user(MANAGER["id"]).update(point_cap_renewal_type="manual", point_cap=5)
+
+    award = server.PointTransactionCreate(to_user_id="employee-1", amount=10, reason="Thanks")
+    # The caller's copy of the cap is stale; only the conditional draw decides
+    manager = server.User(**{**MANAGER, "point_cap_renewal_type": "manual", "point_cap": 100})
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.award_points(award, manager))
+
+    assert error.value.status_code == 400
+    assert fake_db.users.user(MANAGER["id"])["point_cap"] == 5
+    assert calls == []
+
+
+def test_failed_award_returns_the_cap(monkeypatch, fake_db):
+    calls = []
+    fake_db.users = FakeUsers(calls)
+    fake_db.users.user(MANAGER["id"]).update(point_cap_renewal_type="manual", point_cap=50)
+
+    async def write_ledger(transaction, increments):
+        raise OperationFailure("ledger unavailable")
+
+    monkeypatch.setattr(server, "write_ledger", write_ledger)
+
+    award = server.PointTransactionCreate(to_user_id="employee-1", amount=10, reason="Thanks")
+    with pytest.raises(OperationFailure):
+        asyncio.run(server.award_points(award, server.User(**{**MANAGER, "point_cap_renewal_type": "manual"})))
+
+    assert fake_db.users.user(MANAGER["id"])["point_cap"] == 50
+
+
+def test_history_is_written_only_for_users_renewed(monkeypatch, fake_db):
+    fake_db.users = FakeUsers([])
+    renewed_manager = {**MANAGER, "id": "manager-2", "point_cap_renewal_period": "2999-01"}
+    fake_db.users.store(renewed_manager)
+
+    async def nothing(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(server, "bump_versions", nothing)
+
+    now = datetime.utcnow()
+    assert asyncio.run(server.renew_point_caps_for([MANAGER["id"], renewed_manager["id"]], now)) == 1
+    assert asyncio.run(server.renew_point_caps_for([MANAGER["id"]], now)) == 0
+
+    assert renewed_user_ids(fake_db) == [MANAGER["id"]]
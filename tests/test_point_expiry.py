@@ -0,0 +1,166 @@
+"""Point lots: the expiry sweep, its crash recovery and spends that race it; no MongoDB needed."""
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import server
+
+MANAGER = server.User(id="manager-1", email="m@company.example.com", name="Manager", role="manager", company_id="company-1")
+
+
+def test_team_members_leave_out_the_sweeps_bookkeeping(fake_db):
+    fake_db.add("users", [{
+        "id": "employee-1", "email": "e@company.example.com", "name": "Emp", "role": "employee",
+        "company_id": "company-1", "manager_id": "manager-1", "is_active": True, "point_balance": 40,
+        "password": "hash", "pending_expiries": ["lot-1"]
+    }])
+
+    member, = asyncio.run(server.load_team_members(MANAGER))
+
+    assert member["point_balance"] == 40
+    assert {"_id", "password", "pending_expiries"}.isdisjoint(member)
+
+
+def expiring(fake_db, *amounts):
+    """A user holding one lot per amount, all past expiry, on top of 7 points that never expire"""
+    awarded_at = datetime.utcnow() - timedelta(days=500)
+    fake_db.add("users", [{"id": "employee-1", "company_id": "company-1", "point_balance": sum(amounts) + 7}])
+    fake_db.add("point_lots", [
+        {
+            "id": f"lot-{index}", "user_id": "employee-1", "company_id": "company-1", "transaction_id": f"award-{index}",
+            "amount": amount, "remaining": amount, "awarded_at": awarded_at,
+            "expires_at": awarded_at + timedelta(days=365), "expired_at": None
+        }
+        for index, amount in enumerate(amounts)
+    ])
+
+
+def crash_once(monkeypatch, collection, method):
+    """Make the first call of collection.method fail as if the worker died before it"""
+    original = getattr(collection, method)
+    calls = []
+
+    async def fail_first(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise Crash()
+        return await original(*args, **kwargs)
+
+    monkeypatch.setattr(collection, method, fail_first)
+
+
+class Crash(Exception):
+    pass
+
+
+def sweep():
+    try:
+        asyncio.run(server.expire_point_lots())
+    except Crash:
+        # The next scheduled run, on this or another worker, picks up where it stopped
+        asyncio.run(server.expire_point_lots())
+
+
+def assert_expired_once(fake_db, *amounts):
+    user, = fake_db.users.documents
+    rows = fake_db.point_transactions.documents
+    assert user["point_balance"] == 7
+    assert user.get("pending_expiries", []) == []
+    assert sorted(row["amount"] for row in rows) == sorted(-amount for amount in amounts)
+    assert {row["id"] for row in rows} == {
+        str(uuid.uuid5(server.POINT_EXPIRY_NAMESPACE, lot["id"])) for lot in fake_db.point_lots.documents
+    }
+    for lot in fake_db.point_lots.documents:
+        assert (lot["remaining"], lot["expiry_recorded"], lot["debited"]) == (0, True, True)
+
+
+def test_sweep_writes_one_row_and_one_debit_per_lot(fake_db):
+    expiring(fake_db, 10, 25)
+
+    asyncio.run(server.expire_point_lots())
+    asyncio.run(server.record_lot_expiries())
+
+    assert_expired_once(fake_db, 10, 25)
+    run, = fake_db.scheduler_runs.documents
+    assert (run["status"], run["lots_expired"]) == ("completed", 2)
+
+
+def test_crash_between_the_ledger_rows_and_the_debit(fake_db, monkeypatch):
+    expiring(fake_db, 10, 25)
+    crash_once(monkeypatch, fake_db.users, "bulk_write")
+
+    sweep()
+
+    # The rerun's rows collide with the ones already written and the debit happens once
+    assert_expired_once(fake_db, 10, 25)
+
+
+def test_crash_between_the_debit_and_marking_lots_debited(fake_db, monkeypatch):
+    expiring(fake_db, 10, 25)
+    crash_once(monkeypatch, fake_db.point_lots, "update_many")
+
+    sweep()
+
+    # The user's pending_expiries markers stop the rerun from debiting again
+    assert_expired_once(fake_db, 10, 25)
+
+
+def test_crash_before_the_markers_are_pulled(fake_db, monkeypatch):
+    expiring(fake_db, 10)
+    bulk_write = fake_db.users.bulk_write
+    writes = []
+
+    async def crash_on_pull(operations, ordered=True):
+        writes.append(operations)
+        if len(writes) == 2:
+            raise Crash()
+        return await bulk_write(operations, ordered)
+
+    monkeypatch.setattr(fake_db.users, "bulk_write", crash_on_pull)
+
+    sweep()
+
+    assert_expired_once(fake_db, 10)
+
+
+def test_lot_drawn_between_the_read_and_the_claim_expires_what_is_left(fake_db, monkeypatch):
+    expiring(fake_db, 10, 25)
+    bulk_write = fake_db.point_lots.bulk_write
+    claims = []
+
+    async def spend_before_the_claim(operations, ordered=True):
+        claims.append(operations)
+        if len(claims) == 1:
+            # A redemption that read lot-1 before it expired takes 5 of its points
+            await fake_db.point_lots.update_one({"id": "lot-1", "remaining": {"$gte": 5}}, {"$inc": {"remaining": -5}})
+            await fake_db.users.update_one({"id": "employee-1"}, {"$inc": {"point_balance": -5}})
+        return await bulk_write(operations, ordered)
+
+    monkeypatch.setattr(fake_db.point_lots, "bulk_write", spend_before_the_claim)
+
+    asyncio.run(server.expire_point_lots())
+
+    # The first claim of lot-1 lost the race; the next read claimed only what the spend left
+    assert len(claims) == 2
+    lots = {lot["id"]: lot for lot in fake_db.point_lots.documents}
+    assert (lots["lot-0"]["expired_amount"], lots["lot-1"]["expired_amount"]) == (10, 20)
+    assert_expired_once(fake_db, 10, 20)
+
+
+
+def test_draw_put_back_after_its_lot_expired_expires_on_the_next_sweep(fake_db):
+    expiring(fake_db, 10, 25)
+    # A redemption drew 5 from lot-1, then failed after the sweep had expired the rest
+    fake_db.point_lots.documents[1]["remaining"] = 20
+    asyncio.run(server.expire_point_lots())
+
+    asyncio.run(server.restore_point_lots("employee-1", [("lot-1", 5)]))
+
+    corrective, = [lot for lot in fake_db.point_lots.documents if lot["transaction_id"] is None]
+    assert (corrective["remaining"], corrective["expires_at"]) == (5, fake_db.point_lots.documents[1]["expires_at"])
+
+    # Tomorrow's sweep expires it like any other lot, leaving balance, ledger and lots in step
+    fake_db.scheduler_runs.documents.clear()
+    asyncio.run(server.expire_point_lots())
+
+    assert_expired_once(fake_db, 10, 20, 5)
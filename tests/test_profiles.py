@@ -0,0 +1,38 @@
+"""Employee profile validators; no MongoDB needed."""
+import asyncio
+
+from fastapi import Request, Response
+
+import server
+
+EMPLOYEE = {"id": "employee-1", "email": "e@company.example.com", "name": "Emp", "role": "employee", "company_id": "company-1"}
+
+
+def profile_etag(monkeypatch, fake_db, fields=None, include=None):
+    async def get_versions(*keys):
+        return [7]
+
+    async def get_company_catalog(company_id):
+        return type("Catalog", (), {"version": 3})()
+
+    monkeypatch.setattr(server, "get_versions", get_versions)
+    monkeypatch.setattr(server, "get_company_catalog", get_company_catalog)
+    fake_db.add("users", [EMPLOYEE])
+
+    # "*" matches any tag, so the 304 carries the tag without running the section queries
+    request = Request({"type": "http", "method": "GET", "path": "/", "headers": [(b"if-none-match", b"*")]})
+    response = asyncio.run(server.get_employee_profile(
+        "employee-1", request, Response(), fields=fields, include=include, current_user=server.User(**EMPLOYEE)
+    ))
+    assert response.status_code == 304
+    return response.headers["etag"]
+
+
+def test_section_selection_is_part_of_the_etag(monkeypatch, fake_db):
+    default = profile_etag(monkeypatch, fake_db)
+    statistics = profile_etag(monkeypatch, fake_db, fields="employee,statistics")
+
+    assert default != statistics
+    # The same selection spelled differently shares a tag
+    assert statistics == profile_etag(monkeypatch, fake_db, fields="statistics, employee")
+    assert profile_etag(monkeypatch, fake_db, fields="employee", include="statistics") == statistics
@@ -0,0 +1,208 @@
+"""Per-endpoint Mongo query budgets.
+
+Every route on api_router is called in process against data from
+backend/seed_data.py while the command listener from conftest.py counts the
+commands it sends. A route that goes over its budget fails with the commands
+it issued. Budgets are for a warm process: the company catalog, the ledger
+archive list and the webhook endpoints are cached before each request, as
+they are in a running server. Budgets are the measured count; any slack is commented.
+
+Needs a disposable MongoDB (MONGO_URL, default mongodb://localhost:27017); the
+database QUERY_BUDGET_DB_NAME is dropped before and after the run. Without one
+the module is skipped, except under CI or REQUIRE_MONGO=true, where a missing
+MongoDB fails the run instead of quietly passing it.
+"""
+import asyncio
+import os
+from argparse import Namespace
+
+import httpx
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import server
+from seed_data import seed
+
+try:
+    MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=1000).admin.command("ping")
+except PyMongoError:
+    if os.environ.get("CI") or os.environ.get("REQUIRE_MONGO", "").lower() == "true":
+        pytest.fail(f"query budgets need a MongoDB at {os.environ['MONGO_URL']}", pytrace=False)
+    pytest.skip("query budgets need a MongoDB at MONGO_URL", allow_module_level=True)
+
+# (method, path, role, budget, request kwargs); path placeholders come from the seeded ids,
+# or from a "path_ids" entry in kwargs. Requests run in order, so later entries can use
+# ids created by earlier ones.
+BUDGETS = [
+    ("POST", "/api/auth/register", None, 3, {"json": {
+        "email": "budget.new@company0000.example.com", "name": "Budget New", "password": "password",
+        "role": "employee", "company_id": "{company_id}", "manager_id": "{manager_id}"
+    }}),
+    ("POST", "/api/auth/login", None, 2, {"json": {"email": "{employee_email}", "password": "password"}}),
+    ("POST", "/api/auth/refresh", None, 3, {"json": {"refresh_token": "{refresh_token}"}}),
+    ("GET", "/api/auth/me", "employee", 1, {}),
+    ("POST", "/api/companies", None, 5, {"json": {
+        "name": "Budget Co", "admin_email": "admin@budget.example.com", "admin_name": "Budget Admin",
+        "admin_password": "password"
+    }}),
+    # Served from the warm catalog cache; the access token is the only auth check
+    ("GET", "/api/companies/{company_id}", "employee", 0, {}),
+    # The recipient is the company's most recognized employee, who already holds every badge
+    ("POST", "/api/points/give", "manager", 12, {
+        "json": {"to_user_id": "{employee_id}", "amount": 5, "reason": "Budget check"},
+        "headers": {"Idempotency-Key": "budget-give"}
+    }),
+    # The employee's hot ledger fills the page, so no archive is read
+    ("GET", "/api/points/transactions", "employee", 2, {}),
+    ("GET", "/api/points/lots", "employee", 2, {}),
+    ("GET", "/api/users/team", "manager", 1, {}),
+    ("GET", "/api/users/directory", "manager", 1, {"params": {"q": "a"}}),
+    ("GET", "/api/users/{user_id}/profile", "manager", 6, {}),
+    ("GET", "/api/users/{user_id}/balance", "manager", 5, {}),
+    ("POST", "/api/users/{user_id}/deactivate", "admin", 4, {"path_ids": {"user_id": "{other_employee_id}"}}),
+    ("GET", "/api/users/badges", "employee", 2, {}),
+    ("GET", "/api/users/badges/progress", "employee", 1, {}),
+    ("GET", "/api/dashboard/stats", "manager", 5, {}),
+    # The dashboard's and the task list's name lookups run concurrently for different
+    # ids, so they are two $in queries; they can merge into one if the ids overlap
+    ("GET", "/api/bootstrap", "manager", 9, {}),
+    ("POST", "/api/tasks", "manager", 2, {"json": {"title": "Budget task", "description": "Budget check", "points_reward": 10}}),
+    ("GET", "/api/tasks", "employee", 3, {}),
+    ("POST", "/api/tasks/{task_id}/complete", "employee", 12, {"headers": {"Idempotency-Key": "budget-complete"}}),
+    ("POST", "/api/rewards", "admin", 1, {"json": {"name": "Budget mug", "description": "Budget check", "points_cost": 10, "stock": 5}}),
+    ("GET", "/api/rewards", "employee", 1, {}),
+    # One conditional update per lot drawn: lots are spent oldest first and seeded credits
+    # from before the current cap period are at least 5 points, so the 10-point cost takes
+    # one lot or two depending on the oldest lot's size
+    ("POST", "/api/rewards/{reward_id}/redeem", "employee", 11, {"headers": {"Idempotency-Key": "budget-redeem"}}),
+    ("GET", "/api/rewards/redemptions", "employee", 1, {}),
+    ("GET", "/api/admin/reconciliation/{report_id}", "super_admin", 1, {}),
+    ("GET", "/api/admin/profiles/{profile_id}", "super_admin", 1, {}),
+    ("GET", "/api/admin/slow-queries", "super_admin", 1, {}),
+    # A public address literal: registration resolves the host, and this needs no DNS
+    ("POST", "/api/webhooks", "admin", 1, {"json": {"url": "https://93.184.216.34/effy", "events": ["points.awarded"]}}),
+    ("GET", "/api/webhooks", "admin", 1, {}),
+    ("DELETE", "/api/webhooks/{webhook_id}", "admin", 1, {}),
+    # Last: it revokes the employee's token
+    ("POST", "/api/auth/logout", "employee", 3, {"json": {"refresh_token": "{refresh_token}"}}),
+]
+
+# Ids that only exist once an earlier request has created them
+CREATED_IDS = {
+    "task_id": ("POST", "/api/tasks"),
+    "reward_id": ("POST", "/api/rewards"),
+    "webhook_id": ("POST", "/api/webhooks"),
+}
+
+# Routes whose work is deliberately unbounded, with the reason
+EXEMPT = {
+    ("POST", "/api/admin/reconciliation"): "starts a full-ledger background scan",
+}
+
+
+def fill(value, ids):
+    if isinstance(value, str):
+        return value.format(**ids)
+    if isinstance(value, dict):
+        return {key: fill(item, ids) for key, item in value.items()}
+    return value
+
+
+async def seed_fixture():
+    """Seed a small tenant set and pick the most recognized employee and their chain"""
+    await server.client.drop_database(os.environ["DB_NAME"])
+    await seed(Namespace(
+        companies=3, users=300, transactions=20000, days=730, end=None, seed=7,
+        company_exponent=1.0, recipient_exponent=1.1, batch_size=2000, concurrency=4,
+        password="password"
+    ))
+
+    employee = await server.db.users.find_one({"role": "employee"}, sort=[("point_balance", -1)])
+    manager = await server.db.users.find_one({"id": employee["manager_id"]})
+    # Leave the manager cap room for the award below
+    await server.db.users.update_one({"id": manager["id"]}, {"$set": {"point_cap": server.DEFAULT_POINT_CAP}})
+    super_admin = server.User(email="root@budget.example.com", name="Budget Root", role=server.UserRole.SUPER_ADMIN)
+    await server.db.users.insert_one(super_admin.model_dump())
+    await server.db.reconciliation_reports.insert_one({"id": "budget-report", "status": "completed"})
+    await server.db.request_profiles.insert_one({"id": "budget-profile", "folded": ""})
+
+    admin = await server.db.users.find_one({"company_id": employee["company_id"], "role": "company_admin"})
+    users = {"employee": employee, "manager": manager, "admin": admin, "super_admin": super_admin.model_dump()}
+    tokens = {
+        role: server.create_jwt_token(user) for role, user in users.items()
+    }
+    other_employee = await server.db.users.find_one(
+        {"company_id": employee["company_id"], "role": "employee", "id": {"$ne": employee["id"]}}
+    )
+    ids = {
+        "company_id": employee["company_id"],
+        "employee_id": employee["id"],
+        "user_id": employee["id"],
+        "employee_email": employee["email"],
+        "manager_id": manager["id"],
+        "report_id": "budget-report",
+        "profile_id": "budget-profile",
+        "other_employee_id": other_employee["id"],
+        "refresh_token": await server.issue_refresh_token(employee["id"]),
+    }
+    return ids, tokens
+
+
+async def measure_routes(counter):
+    ids, tokens = await seed_fixture()
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://budget") as http:
+        for method, path, role, budget, kwargs in BUDGETS:
+            missing = [name for name in CREATED_IDS if "{" + name + "}" in path and name not in ids]
+            if missing:
+                results[(method, path)] = (None, [f"depends on {' '.join(CREATED_IDS[missing[0]])}, which failed"])
+                continue
+            kwargs = fill(kwargs, ids)
+            path_ids = {**ids, **kwargs.pop("path_ids", {})}
+            headers = dict(kwargs.pop("headers", {}))
+            if role:
+                headers["Authorization"] = f"Bearer {tokens[role]}"
+
+            # Warm the per-process caches a long-running server would already hold
+            await server.get_company_catalog(ids["company_id"])
+            await server.ledger_archive_names()
+            await server.webhook_endpoints_for(ids["company_id"])
+
+            counter.start()
+            try:
+                response = await http.request(method, fill(path, path_ids), headers=headers, **kwargs)
+            finally:
+                commands = counter.stop()
+
+            if response.status_code >= 400:
+                commands = [f"HTTP {response.status_code}: {response.text[:300]}"] + commands
+                results[(method, path)] = (None, commands)
+                continue
+            for name, created_by in CREATED_IDS.items():
+                if (method, path) == created_by:
+                    ids[name] = response.json()["id"]
+            results[(method, path)] = (len(commands), commands)
+
+    await server.client.drop_database(os.environ["DB_NAME"])
+    return results
+
+
+@pytest.fixture(scope="module")
+def measured(mongo_commands):
+    return asyncio.run(measure_routes(mongo_commands))
+
+
+def test_every_route_has_a_budget():
+    declared = {(method, path) for method, path, *_ in BUDGETS} | set(EXEMPT)
+    routes = {(method, route.path) for route in server.api_router.routes for method in route.methods}
+    assert routes - declared == set(), "declare a query budget for new routes in BUDGETS"
+
+
+@pytest.mark.parametrize("method, path, budget", [(method, path, budget) for method, path, _, budget, _ in BUDGETS])
+def test_route_within_query_budget(measured, method, path, budget):
+    count, commands = measured[(method, path)]
+    listing = "\n".join(f"  {command}" for command in commands)
+    assert count is not None, f"{method} {path} failed:\n{listing}"
+    assert count <= budget, f"{method} {path} sent {count} Mongo commands, budget is {budget}:\n{listing}"
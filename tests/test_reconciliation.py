@@ -0,0 +1,74 @@
+"""Balance, cap and lot drift against the ledger; no MongoDB needed."""
+import asyncio
+
+import server
+
+
+def test_cap_is_reconciled_against_the_granted_cap():
+    users = [{"id": "manager-1", "point_balance": 0, "point_cap": 40}]
+
+    assert server.find_drift(users, {}, {"manager-1": 10}, {"manager-1": 50}, {}) == []
+    drift, = server.find_drift(users, {}, {"manager-1": 10}, {"manager-1": server.DEFAULT_POINT_CAP}, {})
+    assert drift["expected_point_cap"] == server.DEFAULT_POINT_CAP - 10
+
+
+def test_lots_short_of_a_correct_balance_are_drift():
+    users = [{"id": "employee-1", "point_balance": 30, "point_cap": server.DEFAULT_POINT_CAP}]
+
+    drift, = server.find_drift(users, {"employee-1": 30}, {}, {}, {"employee-1": 20})
+
+    assert drift["point_lots"] == 20
+    assert drift["expected_point_balance"] == drift["point_balance"] == 30
+
+
+def test_repair_adds_a_lot_for_missing_points_and_draws_surplus(monkeypatch, fake_db):
+    drawn = []
+
+    async def consume_point_lots(user_id, amount):
+        drawn.append((user_id, amount))
+        return 0, []
+
+    monkeypatch.setattr(server, "consume_point_lots", consume_point_lots)
+    row = {"user_id": "employee-1", "company_id": "company-1", "expected_point_balance": 30}
+
+    asyncio.run(server.repair_point_lots({**row, "point_lots": 20}, "report-1"))
+    asyncio.run(server.repair_point_lots({**row, "point_lots": 45}, "report-1"))
+
+    assert [(lot["user_id"], lot["remaining"], lot["transaction_id"]) for lot in fake_db.point_lots.documents] == [("employee-1", 10, None)]
+    assert drawn == [("employee-1", 15)]
+
+
+def test_repair_skips_users_whose_balance_moved_before_the_write(monkeypatch, fake_db):
+    fake_db.add("users", [
+        {"id": f"employee-{number}", "company_id": "company-1", "point_balance": 50, "point_cap": server.DEFAULT_POINT_CAP}
+        for number in (1, 2)
+    ])
+    reads = []
+
+    async def ledger_totals(users, read_preference=None):
+        return {user["id"]: 30 for user in users}, {}, {}
+
+    async def lot_totals(user_ids, read_preference=None):
+        reads.append(read_preference)
+        if len(reads) == 2:
+            # An award to employee-1 lands after the primary re-check read its balance
+            await fake_db.users.update_one({"id": "employee-1"}, {"$inc": {"point_balance": 5}})
+        return {user_id: 20 for user_id in user_ids}
+
+    repaired = []
+
+    async def repair_point_lots(row, report_id):
+        repaired.append(row["user_id"])
+
+    monkeypatch.setattr(server, "ledger_totals", ledger_totals)
+    monkeypatch.setattr(server, "lot_totals", lot_totals)
+    monkeypatch.setattr(server, "repair_point_lots", repair_point_lots)
+    monkeypatch.setattr(server, "RECONCILIATION_SETTLE_SECONDS", 0)
+    monkeypatch.setattr(server, "RECONCILIATION_PAUSE_SECONDS", 0)
+
+    report = asyncio.run(server.reconcile_balances("company-1", repair=True))
+
+    users = {user["id"]: user for user in fake_db.users.documents}
+    assert (users["employee-1"]["point_balance"], users["employee-2"]["point_balance"]) == (55, 30)
+    assert repaired == ["employee-2"]
+    assert (report["users_drifted"], report["users_repaired"]) == (2, 1)
@@ -0,0 +1,112 @@
+"""Reward redemption ordering and compensation against in-memory collections; no MongoDB needed."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pymongo.errors import OperationFailure
+
+import server
+
+EMPLOYEE = server.User(id="employee-1", email="e@company.example.com", name="Emp", role="employee", company_id="company-1")
+
+
+def only(collection):
+    document, = collection.documents
+    return document
+
+
+@pytest.fixture
+def store(monkeypatch, fake_db):
+    reward = server.Reward(id="reward-1", name="Mug", description="A mug", points_cost=10, stock=1,
+                           company_id="company-1", created_by="admin-1")
+    fake_db.add("rewards", [reward.model_dump()])
+    fake_db.add("users", [{"id": "employee-1", "point_balance": 25}])
+    lots = {"remaining": 25, "restored": []}
+    ledger = []
+
+    async def consume_point_lots(user_id, amount):
+        lots["remaining"] -= amount
+        return 0, [("lot-1", amount)]
+
+    async def restore_point_lots(user_id, draws):
+        for _, take in draws:
+            lots["remaining"] += take
+            lots["restored"].append(take)
+
+    async def write_ledger(transaction, increments):
+        ledger.append(transaction.amount)
+
+    async def nothing(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(server, "consume_point_lots", consume_point_lots)
+    monkeypatch.setattr(server, "restore_point_lots", restore_point_lots)
+    monkeypatch.setattr(server, "write_ledger", write_ledger)
+    monkeypatch.setattr(server, "bump_versions", nothing)
+    return fake_db, lots, ledger
+
+
+def test_redemption_debits_and_reserves(store):
+    fake_db, lots, ledger = store
+
+    asyncio.run(server.redeem_reward("reward-1", EMPLOYEE))
+
+    assert only(fake_db.users)["point_balance"] == 15
+    assert only(fake_db.rewards)["stock"] == 0
+    assert lots["remaining"] == 15
+    assert ledger == [-10]
+    assert len(fake_db.redemptions.documents) == 1
+
+
+def test_failed_ledger_write_is_undone(store, monkeypatch):
+    fake_db, lots, ledger = store
+
+    async def failing_write_ledger(transaction, increments):
+        raise OperationFailure("ledger unavailable")
+
+    monkeypatch.setattr(server, "write_ledger", failing_write_ledger)
+
+    with pytest.raises(OperationFailure):
+        asyncio.run(server.redeem_reward("reward-1", EMPLOYEE))
+
+    assert only(fake_db.users)["point_balance"] == 25
+    assert only(fake_db.rewards)["stock"] == 1
+    assert lots == {"remaining": 25, "restored": [10]}
+    assert fake_db.redemptions.documents == []
+
+
+def test_failed_record_insert_reverses_the_ledger_row(store, monkeypatch):
+    fake_db, lots, ledger = store
+
+    async def failing_insert(document):
+        raise OperationFailure("redemptions unavailable")
+
+    monkeypatch.setattr(fake_db.redemptions, "insert_one", failing_insert)
+
+    with pytest.raises(OperationFailure):
+        asyncio.run(server.redeem_reward("reward-1", EMPLOYEE))
+
+    assert ledger == [-10, 10]
+    assert only(fake_db.users)["point_balance"] == 25
+    assert only(fake_db.rewards)["stock"] == 1
+    assert lots["remaining"] == 25
+
+
+def test_lost_stock_race_refunds_the_payer(store):
+    fake_db, lots, ledger = store
+    only(fake_db.rewards)["stock"] = 0
+    # The reward read saw a unit left; it went to someone else before the reservation
+    find_one = fake_db.rewards.find_one
+
+    async def stale_find_one(query, *args, **kwargs):
+        return {**await find_one(query, *args, **kwargs), "stock": 1}
+
+    fake_db.rewards.find_one = stale_find_one
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.redeem_reward("reward-1", EMPLOYEE))
+
+    assert error.value.status_code == 409
+    assert only(fake_db.users)["point_balance"] == 25
+    assert lots["remaining"] == 25
+    assert ledger == []
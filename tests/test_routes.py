@@ -0,0 +1,170 @@
+"""Routes from the query budgets, called through the app against in-memory collections.
+
+test_query_budgets.py counts Mongo commands and needs a MongoDB; these run
+in every pytest run and check what the routes return, plus the operation
+counts of the routes that promise a fixed number of reads.
+"""
+import asyncio
+from datetime import datetime
+
+import httpx
+import pytest
+
+import server
+from tests.conftest import FakeCollection
+
+COMPANY = server.Company(id="company-1", name="Company").model_dump()
+MANAGER = {
+    "id": "manager-1", "email": "grace@company.example.com", "name": "Grace", "role": "manager",
+    "company_id": "company-1", "point_cap": 500, "point_balance": 0, "is_active": True, "password": "hash"
+}
+EMPLOYEES = [
+    {
+        "id": f"employee-{number}", "email": f"{name.lower()}@company.example.com", "name": name, "role": "employee",
+        "company_id": "company-1", "manager_id": "manager-1", "point_balance": balance, "is_active": True, "password": "hash"
+    }
+    for number, (name, balance) in enumerate([("Alan", 120), ("ada", 40), ("Barbara", 0)], 1)
+]
+BADGES = [
+    server.Badge(
+        id=f"badge-{points}", name=name, description="", icon="star", badge_type="points_based",
+        company_id="company-1", points_required=points
+    ).model_dump()
+    for name, points in [("Starter", 10), ("Rising Star", 100), ("Legend", 500)]
+]
+
+
+@pytest.fixture
+def api(monkeypatch, fake_db):
+    """Send requests as a user and count the collection operations each one makes"""
+    monkeypatch.setattr(server, "WEBHOOKS_ENABLED", False)
+    monkeypatch.setattr(server, "DIGESTS_ENABLED", False)
+    fake_db.add("companies", [COMPANY])
+    fake_db.add("badges", BADGES)
+    fake_db.add("users", [MANAGER, *EMPLOYEES])
+    fake_db.add("user_badges", [{"id": "earned-1", "user_id": "employee-1", "badge_id": "badge-10", "earned_at": datetime(2026, 9, 1)}])
+    fake_db.add("tasks", [{
+        "id": "task-1", "title": "Ship it", "description": "Release", "points_reward": 15, "company_id": "company-1",
+        "created_by": "manager-1", "is_active": True, "created_at": datetime(2026, 10, 1)
+    }])
+
+    operations = []
+    for method in ("find", "find_one", "aggregate", "count_documents", "insert_one", "insert_many",
+                   "update_one", "update_many", "bulk_write", "find_one_and_update", "delete_one"):
+        monkeypatch.setattr(FakeCollection, method, counted(operations, method, getattr(FakeCollection, method)))
+
+    def send(*requests):
+        """Responses to (user, method, path, kwargs) requests sent in order, and the operations of each"""
+        async def main():
+            # Warm the caches a running server holds, as the query budgets do
+            await server.get_company_catalog("company-1")
+            responses, counts = [], []
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://routes") as http:
+                for user, method, path, kwargs in requests:
+                    headers = {**kwargs.pop("headers", {}), "Authorization": f"Bearer {server.create_jwt_token(user)}"}
+                    operations.clear()
+                    responses.append(await http.request(method, path, headers=headers, **kwargs))
+                    counts.append(list(operations))
+            await server.ledger_writer.drain()
+            return responses, counts
+
+        return asyncio.run(main())
+
+    return send
+
+
+def counted(operations, method, original):
+    def call(collection, *args, **kwargs):
+        operations.append(f"{collection.name}.{method}")
+        return original(collection, *args, **kwargs)
+    return call
+
+
+def give(amount, key="give-1", to_user_id="employee-1"):
+    return (MANAGER, "POST", "/api/points/give", {
+        "json": {"to_user_id": to_user_id, "amount": amount, "reason": "Great demo"},
+        "headers": {"Idempotency-Key": key}
+    })
+
+
+def test_give_points_once_per_idempotency_key(api, fake_db):
+    (first, retry, other), _ = api(give(25), give(25), give(25, key="give-2"))
+
+    assert first.status_code == retry.status_code == other.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert first.json()["transaction"]["amount"] == 25
+    assert other.json()["transaction"]["id"] != first.json()["transaction"]["id"]
+
+    users = {user["id"]: user for user in fake_db.users.documents}
+    assert (users["employee-1"]["point_balance"], users["manager-1"]["point_cap"]) == (170, 450)
+    assert len(fake_db.point_transactions.documents) == len(fake_db.point_lots.documents) == 2
+
+
+def test_give_points_key_reused_for_another_award_is_refused(api, fake_db):
+    (first, reused), _ = api(give(25), give(30))
+
+    assert (first.status_code, reused.status_code) == (200, 422)
+    assert len(fake_db.point_transactions.documents) == 1
+
+
+@pytest.mark.parametrize("amount", [0, -50])
+def test_give_points_refuses_amounts_below_one(api, fake_db, amount):
+    (response,), (operations,) = api(give(amount))
+
+    assert (response.status_code, response.json()["detail"]) == (400, "Amount must be positive")
+    users = {user["id"]: user for user in fake_db.users.documents}
+    assert (users["employee-1"]["point_balance"], users["manager-1"]["point_cap"]) == (120, 500)
+    assert "users.update_one" not in operations
+    assert fake_db.point_transactions.documents == fake_db.point_lots.documents == []
+
+
+def test_bootstrap_returns_every_initial_load(api):
+    (response,), _ = api((MANAGER, "GET", "/api/bootstrap", {}))
+
+    assert response.status_code == 200
+    payload = response.json()
+    assert payload["user"]["id"] == "manager-1"
+    assert {"password", "pending_expiries"}.isdisjoint(payload["user"])
+    assert [(task["id"], task["created_by_name"]) for task in payload["tasks"]] == [("task-1", "Grace")]
+    assert sorted(member["id"] for member in payload["team"]) == ["employee-1", "employee-2", "employee-3"]
+    assert all("password" not in member for member in payload["team"])
+    assert payload["badges"] == []
+    assert payload["stats"]
+
+
+def test_bootstrap_for_an_employee_has_their_badges_and_no_team(api):
+    (response,), _ = api((EMPLOYEES[0], "GET", "/api/bootstrap", {}))
+
+    payload = response.json()
+    assert [badge["badge"]["name"] for badge in payload["badges"]] == ["Starter"]
+    assert payload["team"] == []
+    assert payload["user"]["point_balance"] == 120
+
+
+def test_directory_page_is_one_read(api):
+    (first, second), (reads, _) = api(
+        (MANAGER, "GET", "/api/users/directory", {"params": {"q": "a", "limit": 1}}),
+        (MANAGER, "GET", "/api/users/directory", {"params": {"q": "A", "limit": 5}}),
+    )
+
+    assert [user["name"] for user in first.json()["users"]] == ["ada"]
+    assert first.json()["next_cursor"]
+    assert [user["name"] for user in second.json()["users"]] == ["ada", "Alan"]
+    assert second.json()["next_cursor"] is None
+    assert reads == ["users.find"]
+
+
+@pytest.mark.parametrize("employee, current, upcoming, remaining, percent", [
+    (EMPLOYEES[0], "Rising Star", "Legend", 380, 5),
+    (EMPLOYEES[1], "Starter", "Rising Star", 60, 33),
+    (EMPLOYEES[2], None, "Starter", 10, 0),
+])
+def test_badge_progress_reads_only_the_balance(api, employee, current, upcoming, remaining, percent):
+    (response,), (reads,) = api((employee, "GET", "/api/users/badges/progress", {}))
+
+    progress = response.json()
+    assert (progress["current_badge"] or {}).get("name") == current
+    assert (progress["next_badge"]["name"], progress["points_remaining"], progress["progress_percent"]) == (upcoming, remaining, percent)
+    assert reads == ["users.find_one"]
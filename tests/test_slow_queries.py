@@ -0,0 +1,91 @@
+"""Slow query shapes and explain summaries; no MongoDB needed."""
+import asyncio
+
+import server
+
+
+def test_shape_redacts_every_literal():
+    query = {
+        "$and": [
+            {"company_id": "company-1", "is_active": True},
+            {"$or": [{"email": {"$gte": "grace@company.example.com", "$lt": "grace@company.example.com\uffff"}}]},
+            {"id": {"$in": ["user-1", "user-2", "user-3"]}},
+        ]
+    }
+
+    assert server.query_shape(query) == {
+        "$and": [
+            {"company_id": "?", "is_active": "?"},
+            {"$or": [{"email": {"$gte": "?", "$lt": "?"}}]},
+            {"id": {"$in": "?"}},
+        ]
+    }
+
+
+def test_shape_keeps_pipeline_structure_and_sort_specs():
+    command = {
+        "aggregate": "point_transactions",
+        "pipeline": [{"$match": {"to_user_id": "user-1"}}, {"$group": {"_id": "$to_user_id", "total": {"$sum": "$amount"}}}],
+        "sort": {"created_at": -1},
+        "lsid": {"id": "session"},
+    }
+
+    assert server.command_shape(command) == {
+        "pipeline": [{"$match": {"to_user_id": "?"}}, {"$group": {"_id": "?", "total": {"$sum": "?"}}}],
+        "sort": {"created_at": -1},
+    }
+
+
+def test_collection_scan_is_detected():
+    summary = server.summarize_explain({
+        "queryPlanner": {"winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "COLLSCAN", "direction": "forward"}}},
+        "executionStats": {"nReturned": 1, "totalKeysExamined": 0, "totalDocsExamined": 52000, "executionTimeMillis": 140},
+    })
+
+    assert summary == {
+        "plan": ["COLLSCAN", "LIMIT"], "collection_scan": True,
+        "returned": 1, "keys_examined": 0, "docs_examined": 52000, "execution_ms": 140,
+    }
+
+
+def test_index_scan_is_not_a_collection_scan():
+    summary = server.summarize_explain({"queryPlanner": {"winningPlan": {"queryPlan": {
+        "stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "to_user_id_1_created_at_-1"}
+    }}}})
+
+    assert summary["plan"] == ["IXSCAN to_user_id_1_created_at_-1", "FETCH"]
+    assert summary["collection_scan"] is False
+
+
+def test_aggregation_plan_is_read_from_its_cursor_stage():
+    summary = server.summarize_explain({"stages": [
+        {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}, "executionStats": {"nReturned": 9}}},
+        {"$group": {"_id": "$to_user_id"}},
+    ]})
+
+    assert (summary["plan"], summary["collection_scan"], summary["returned"]) == (["COLLSCAN"], True, 9)
+
+
+def test_queries_differing_only_in_literals_share_a_shape_and_one_explain(monkeypatch, fake_db):
+    explained = []
+
+    async def explain_command(database, command):
+        explained.append(command)
+        return {"plan": ["COLLSCAN"], "collection_scan": True}
+
+    monkeypatch.setattr(server, "explain_command", explain_command)
+    monkeypatch.setattr(server, "SLOW_QUERY_EXPLAIN", True)
+    monkeypatch.setattr(server, "slow_query_explained_at", {})
+
+    for email in ("grace@company.example.com", "alan@company.example.com"):
+        asyncio.run(server.record_slow_query({
+            "command": "find", "collection": "users", "database": "effydoc", "duration_ms": 250,
+            "command_document": {"find": "users", "filter": {"email": email}},
+        }))
+
+    first, second = fake_db.slow_queries.documents
+    assert first["shape_hash"] == second["shape_hash"]
+    assert first["shape"] == '{"filter": {"email": "?"}}'
+    assert "company.example.com" not in repr(first) + repr(second)
+    assert len(explained) == 1
+    assert (first["explain"]["collection_scan"], second["explain"]) == (True, None)
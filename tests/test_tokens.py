@@ -0,0 +1,105 @@
+"""Access token validation and the revocation Bloom filter; no MongoDB needed."""
+import asyncio
+import calendar
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from bson import Timestamp
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+from tests.conftest import FakeDB
+
+USER = {"id": "user-1", "email": "ada@company.example.com", "name": "Ada", "role": "manager", "company_id": "company-1"}
+
+
+def authenticate(token):
+    return asyncio.run(server.get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)))
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """Fail the test if validation touches the database"""
+    monkeypatch.setattr(server, "db", None)
+    monkeypatch.setattr(server, "revocations", server.RevocationSet())
+
+
+def test_access_token_is_validated_from_its_claims(offline):
+    user = authenticate(server.create_jwt_token(USER))
+
+    assert (user.id, user.email, user.name, user.role, user.company_id) == (
+        "user-1", "ada@company.example.com", "Ada", server.UserRole.MANAGER, "company-1"
+    )
+
+
+def test_access_token_is_short_lived():
+    payload = jwt.decode(server.create_jwt_token(USER), server.JWT_SECRET, algorithms=[server.JWT_ALGORITHM])
+
+    assert payload["exp"] - payload["iat"] == server.ACCESS_TOKEN_TTL_SECONDS
+
+
+def test_malformed_token_is_rejected(offline):
+    with pytest.raises(HTTPException) as error:
+        authenticate("not-a-token")
+
+    assert (error.value.status_code, error.value.detail) == (401, "Invalid token")
+
+
+def test_expired_token_is_rejected(offline):
+    token = jwt.encode(
+        {"user_id": "user-1", "jti": "expired", "exp": datetime.utcnow() - timedelta(seconds=1)},
+        server.JWT_SECRET, algorithm=server.JWT_ALGORITHM
+    )
+
+    with pytest.raises(HTTPException) as error:
+        authenticate(token)
+
+    assert error.value.detail == "Token expired"
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = server.BloomFilter(10000, 0.001)
+    for i in range(10000):
+        bloom.add(f"token:{i}")
+
+    assert all(f"token:{i}" in bloom for i in range(10000))
+    false_positives = sum(f"user:{i}" in bloom for i in range(100000))
+    assert false_positives < 100000 * 0.003
+
+
+def test_user_revocation_covers_its_own_second(fake_db):
+    revoked_at = datetime(2026, 10, 19, 12, 0, 0, 750000)
+    fake_db.add("revocations", [{"_id": "user:user-1", "kind": "user", "revoked_at": revoked_at}])
+    revocation_set = server.RevocationSet()
+    revocation_set.bloom.add("user:user-1")
+    issued = lambda moment: {"user_id": "user-1", "jti": "j", "iat": calendar.timegm(moment.utctimetuple())}
+
+    assert asyncio.run(revocation_set.is_revoked(issued(revoked_at.replace(microsecond=0))))
+    assert asyncio.run(revocation_set.is_revoked(issued(revoked_at + timedelta(milliseconds=100))))
+    assert not asyncio.run(revocation_set.is_revoked(issued(revoked_at + timedelta(seconds=1))))
+
+
+def test_change_time_comes_from_the_event():
+    wall_time = datetime(2026, 10, 19, 12, 0, 0, 250000)
+
+    assert server.change_time({"wallTime": wall_time, "clusterTime": Timestamp(1, 1)}) == wall_time
+    assert server.change_time({"clusterTime": Timestamp(1792411200, 3)}) == datetime(2026, 10, 19, 12, 0)
+
+
+def test_field_dependency_loads_only_the_fields_a_route_reads(monkeypatch):
+    queries = []
+
+    class Users:
+        async def find_one(self, query, projection=None):
+            queries.append(projection)
+            return {"point_balance": 40, "is_active": True}
+
+    monkeypatch.setattr(server, "db", FakeDB(users=Users()))
+    claims = server.User(**USER)
+
+    user = asyncio.run(server.get_current_user_fields("point_balance")(claims))
+
+    assert queries == [{"_id": 0, "is_active": 1, "point_balance": 1}]
+    assert (user.id, user.name, user.point_balance) == ("user-1", "Ada", 40)